@@ -36,6 +36,7 @@ if 'google' in sys.modules and 'google.protobuf' not in sys.modules:
   del sys.modules['google']
 
 
+from concurrent import futures
 import os
 
 from absl import app
@@ -64,7 +65,6 @@ from google.protobuf import text_format
 from third_party.nucleus.io import fasta
 from third_party.nucleus.io import sam
 from third_party.nucleus.io import sharded_file_utils
-from third_party.nucleus.io import tfrecord
 from third_party.nucleus.io import vcf
 from third_party.nucleus.io.python import hts_verbose
 from third_party.nucleus.protos import reads_pb2
@@ -96,6 +96,13 @@ _RUN_INFO_FILE_EXTENSION = '.run_info.pbtxt'
 # across a variety of distributed filesystems!
 _DEFAULT_HTS_BLOCK_SIZE = 128 * (1024 * 1024)
 
+# Reads with fewer bases than this left after trimming to the alt-alignment
+# window are not used in alt-aligned pileups.
+_MIN_TRIMMED_READ_LENGTH = 15
+
+# Reads longer than this are never realigned.
+_MAX_READ_LENGTH_TO_REALIGN = 500
+
 flags.DEFINE_string(
     'ref', None,
     'Required. Genome reference to use. Must have an associated FAI index as '
@@ -185,6 +192,18 @@ flags.DEFINE_bool(
     'realign_reads', True,
     'If True, locally realign reads before calling variants. '
     'Reads longer than 500 bp are never realigned.')
+flags.DEFINE_bool(
+    'joint_realignment', False,
+    'If True, the realigner selects windows and assembles candidate haplotypes '
+    'once from the pooled reads of the child and parents, and aligns the reads '
+    'of each sample to these shared haplotypes. Otherwise each sample is '
+    'realigned on its own reads only. Has no effect without --realign_reads.')
+flags.DEFINE_integer(
+    'example_threads', 0,
+    'If > 1, the examples of the child and of each parent are created '
+    'concurrently on up to this many threads. The native pileup encoder runs '
+    'without holding the Python lock, so the images of the samples are built '
+    'in parallel.')
 flags.DEFINE_bool(
     'write_run_info', False,
     'If True, write out a MakeExamplesRunInfo proto besides our examples in '
@@ -326,6 +345,16 @@ flags.DEFINE_string(
     '"WGS" and "WES", which represent whole genome sequencing and whole exome '
     'sequencing, respectively. This flag is experimental and is not currently '
     'being used.')
+flags.DEFINE_integer(
+    'output_compression_threads', 0,
+    'If > 0, each gzipped TFRecord output is compressed in independent blocks '
+    'on this many threads, instead of on the thread writing it.')
+flags.DEFINE_integer(
+    'output_compression_level', -1,
+    'The zlib compression level of the gzipped TFRecord outputs, from 1 '
+    '(fastest) to 9 (smallest). 0 stores the records without compressing '
+    'them and -1 keeps the zlib default, as in zlib itself. Any level but -1 '
+    'compresses the outputs in blocks, see --output_compression_threads.')
 flags.DEFINE_bool(
     'sort_by_haplotypes', False,
     'If True, reads are sorted by haplotypes (using HP tag), '
@@ -619,8 +648,12 @@ def default_options(add_flags=True, flags_obj=None):
     options.realigner_enabled = flags_obj.realign_reads
     if options.realigner_enabled:
       options.realigner_options.CopyFrom(realigner.realigner_config(flags_obj))
+    options.joint_realignment = flags_obj.joint_realignment
+    options.example_threads = flags_obj.example_threads
 
     options.max_reads_per_partition = flags_obj.max_reads_per_partition
+    options.output_compression_threads = flags_obj.output_compression_threads
+    options.output_compression_level = flags_obj.output_compression_level
 
     if (options.mode == deeptrio_pb2.DeepTrioOptions.TRAINING and
         flags_obj.training_random_emit_ref_sites != NO_RANDOM_REF):
@@ -991,6 +1024,9 @@ class RegionProcessor(object):
     self.options = options
     self.initialized = False
     self.ref_reader = None
+    # Caches the reference around the region being processed. Set to
+    # ref_reader by _initialize().
+    self.region_reference_cache = None
     self.sam_reader = None
     self.in_memory_sam_reader = None
     self.realigner = None
@@ -999,10 +1035,17 @@ class RegionProcessor(object):
     self.variant_caller = None
     self.samples = {}
     self.sample_to_train = None
-
-  def _make_allele_counter_for_region(self, region):
-    return allelecounter.AlleleCounter(self.ref_reader.c_reader, region,
-                                       self.options.allele_counter_options)
+    # Reads and alt-alignments of each sample around the candidates of the
+    # region being processed, shared by the examples of all samples. See
+    # _cached_for_region().
+    self._region_cache = {}
+    # Creates the examples of the samples concurrently, if example_threads > 1.
+    self._example_executor = None
+
+  def _make_allele_counter_for_region(self, region, sample_names):
+    return allelecounter.MultiSampleAlleleCounter(
+        self.ref_reader.c_reader, region, self.options.allele_counter_options,
+        sample_names)
 
   def _encode_tensor(self, image_tensor):
     return image_tensor.tostring(), image_tensor.shape, 'raw'
@@ -1026,7 +1069,11 @@ class RegionProcessor(object):
     if self.initialized:
       raise ValueError('Cannot initialize this object twice')
 
-    self.ref_reader = fasta.IndexedFastaReader(self.options.reference_filename)
+    # The pileup image creators, the realigner and the labeler all query the
+    # reference around the region being processed, which we fetch only once.
+    self.region_reference_cache = make_examples_utils.RegionReferenceCache(
+        fasta.IndexedFastaReader(self.options.reference_filename))
+    self.ref_reader = self.region_reference_cache
 
     self.sam_reader = self._make_sam_reader(
         self.options.reads_filename, self.options.downsample_fraction_child)
@@ -1174,19 +1221,31 @@ class RegionProcessor(object):
     # Print some basic information about what we are doing.
     if not self.initialized:
       self._initialize()
+    if self.region_reference_cache is not None:
+      self.region_reference_cache.load(region)
 
     # Get reads in the region for each sample into its in-memory sam reader,
     # optionally realigning reads.
-    for sample in self.samples['child']:
-      if sample.in_memory_sam_reader is not None:
-        sample.in_memory_sam_reader.replace_reads(
-            self.region_reads(region, sample.sam_reader))
+    samples = [
+        sample for sample in self.samples['child']
+        if sample.in_memory_sam_reader is not None
+    ]
+    if self.options.realigner_enabled and self.options.joint_realignment:
+      reads_by_sample = self.joint_region_reads(
+          region, [sample.sam_reader for sample in samples])
+    else:
+      reads_by_sample = [
+          self.region_reads(region, sample.sam_reader) for sample in samples
+      ]
+    for sample, reads in zip(samples, reads_by_sample):
+      sample.in_memory_sam_reader.replace_reads(reads)
 
     # Candidates are created using both parents and child
     candidates_dict, gvcfs_dict = self.candidates_in_region(region)
-    examples_dict = {}
-    for sample, candidates in candidates_dict.items():
-      examples_dict[sample] = []
+
+    def candidates_and_examples(sample):
+      candidates = candidates_dict[sample]
+      examples = []
 
       if self.options.select_variant_types:
         candidates = list(
@@ -1196,20 +1255,59 @@ class RegionProcessor(object):
         for candidate, label in self.label_candidates(candidates, region):
           for example in self.create_pileup_examples(candidate, sample):
             self.add_label_to_example(example, label)
-            examples_dict[sample].append(example)
+            examples.append(example)
       else:
         for candidate in candidates:
           for example in self.create_pileup_examples(candidate, sample):
-            examples_dict[sample].append(example)
+            examples.append(example)
 
-      candidates_dict[sample] = candidates
       logging.vlog(
           2, 'Found %s candidates in %s [%d bp, sample %s] '
-          '[%0.2fs elapsed]', len(examples_dict[sample]),
-          ranges.to_literal(region), ranges.length(region), sample,
-          region_timer.Stop())
+          '[%0.2fs elapsed]', len(examples), ranges.to_literal(region),
+          ranges.length(region), sample, region_timer.Stop())
+      return candidates, examples
+
+    # The candidates of each sample are independent, so their examples can be
+    # created concurrently.
+    self._region_cache = {}
+    samples = list(candidates_dict)
+    if self.options.example_threads > 1 and len(samples) > 1:
+      if self._example_executor is None:
+        self._example_executor = futures.ThreadPoolExecutor(
+            max_workers=self.options.example_threads)
+      results = list(self._example_executor.map(candidates_and_examples,
+                                                samples))
+    else:
+      results = [candidates_and_examples(sample) for sample in samples]
+    self._region_cache = {}
+
+    examples_dict = {}
+    for sample, (candidates, examples) in zip(samples, results):
+      candidates_dict[sample] = candidates
+      examples_dict[sample] = examples
     return candidates_dict, examples_dict, gvcfs_dict
 
+  def _cached_for_region(self, key, compute):
+    """Returns compute(), cached under key until the end of the region.
+
+    The images of the child and of each parent show the same samples, so when
+    the samples share a candidate position, the reads and alt-alignments of
+    each sample around it are computed only once. If two threads miss the
+    cache at the same time, both compute the value, which is the same.
+
+    Args:
+      key: A hashable key identifying the value.
+      compute: A function computing the value.
+
+    Returns:
+      The value of compute().
+    """
+    value = self._region_cache.get(key)
+    if value is None:
+      value = compute()
+      self._region_cache[key] = value
+    return value
+
   def region_reads(self, region, sam_reader):
     """Update in_memory_sam_reader with read alignments overlapping the region.
 
@@ -1224,17 +1322,9 @@ class RegionProcessor(object):
     Returns:
       [genomics.deepvariant.core.genomics.Read], reads overlapping the region.
     """
-    if sam_reader is None:
-      return []
-    reads = sam_reader.query(region)
-    if self.options.max_reads_per_partition > 0:
-      random_for_region = np.random.RandomState(self.options.random_seed)
-      reads = utils.reservoir_sample(reads,
-                                     self.options.max_reads_per_partition,
-                                     random_for_region)
-    reads = list(reads)
+    reads = self._sampled_region_reads(region, sam_reader)
     if self.options.realigner_enabled:
-      max_read_length_to_realign = 500
+      max_read_length_to_realign = _MAX_READ_LENGTH_TO_REALIGN
       if max_read_length_to_realign > 0:
         long_reads = [
             read for read in reads
@@ -1256,6 +1346,56 @@ class RegionProcessor(object):
       _, reads = self.realigner.realign_reads(reads, region)
     return reads
 
+  def joint_region_reads(self, region, sam_readers):
+    """Returns the reads of each sample overlapping region, realigned jointly.
+
+    Like region_reads, but the realigner assembles the candidate haplotypes
+    once from the short reads of all samples and aligns the short reads of
+    each sample to them.
+
+    Args:
+      region: A nucleus.genomics.v1.Range object specifying the region we want
+        to realign reads.
+      sam_readers: list of sam.SamReader or None, one per sample.
+
+    Returns:
+      A list with the reads overlapping the region of each of sam_readers.
+    """
+    long_reads_by_sample = []
+    short_reads_by_sample = []
+    for sam_reader in sam_readers:
+      reads = self._sampled_region_reads(region, sam_reader)
+      long_reads_by_sample.append([
+          read for read in reads
+          if len(read.aligned_sequence) > _MAX_READ_LENGTH_TO_REALIGN
+      ])
+      short_reads_by_sample.append([
+          read for read in reads
+          if len(read.aligned_sequence) <= _MAX_READ_LENGTH_TO_REALIGN
+      ])
+
+    _, realigned_short_reads_by_sample = self.realigner.realign_reads_jointly(
+        short_reads_by_sample, region)
+
+    # As in region_reads, long reads are listed before short reads.
+    return [
+        long_reads + realigned_short_reads for long_reads,
+        realigned_short_reads in zip(long_reads_by_sample,
+                                     realigned_short_reads_by_sample)
+    ]
+
+  def _sampled_region_reads(self, region, sam_reader):
+    """Returns the reads overlapping region, sampled down if needed."""
+    if sam_reader is None:
+      return []
+    reads = sam_reader.query(region)
+    if self.options.max_reads_per_partition > 0:
+      random_for_region = np.random.RandomState(self.options.random_seed)
+      reads = utils.reservoir_sample(reads,
+                                     self.options.max_reads_per_partition,
+                                     random_for_region)
+    return list(reads)
+
   def candidates_in_region(self, region):
     """Finds candidate DeepVariantCall protos in region.
 
@@ -1280,35 +1420,17 @@ class RegionProcessor(object):
       # we need to return the gVCF records calculated by the caller below.
       return {}, {}
 
-    allele_counters = {}
-
-    # Instantiate allele counter for child sample
-    allele_counters[self.options.variant_caller_options_child
-                    .sample_name] = self._make_allele_counter_for_region(region)
-
-    # Add target sample reads to allele counter
-    for read in reads:
-      allele_counters[
-          self.options.variant_caller_options_child.sample_name].add(
-              read, self.options.variant_caller_options_child.sample_name)
-
-    # If parent1 is specified create allele counter and populate it with reads
+    # Count the alleles of the child and of each specified parent in one pass.
+    sample_names = [self.options.variant_caller_options_child.sample_name]
+    reads_for_samples = [list(reads)]
     if FLAGS.reads_parent1:
-      allele_counters[
-          FLAGS.sample_name_parent1] = self._make_allele_counter_for_region(
-              region)
-      for read in reads_parent1:
-        allele_counters[FLAGS.sample_name_parent1].add(
-            read, FLAGS.sample_name_parent1)
-
-    # If parent2 is specified create allele counter and populate it with reads
+      sample_names.append(FLAGS.sample_name_parent1)
+      reads_for_samples.append(list(reads_parent1))
     if FLAGS.reads_parent2:
-      allele_counters[
-          FLAGS.sample_name_parent2] = self._make_allele_counter_for_region(
-              region)
-      for read in reads_parent2:
-        allele_counters[FLAGS.sample_name_parent2].add(
-            read, FLAGS.sample_name_parent2)
+      sample_names.append(FLAGS.sample_name_parent2)
+      reads_for_samples.append(list(reads_parent2))
+    allele_counter = self._make_allele_counter_for_region(region, sample_names)
+    allele_counter.add_reads_for_samples(reads_for_samples)
 
     candidates = {}
     gvcfs = {}
@@ -1319,24 +1441,24 @@ class RegionProcessor(object):
     # look clean this way.
     if in_training_mode(self.options):
       candidates[self.sample_to_train], gvcfs[self.sample_to_train] = (
-          self.variant_caller_child.calls_and_gvcfs(
-              allele_counters, gvcf_output_enabled(self.options),
+          self.variant_caller_child.calls_and_gvcfs_from_multi_sample_counter(
+              allele_counter, gvcf_output_enabled(self.options),
               FLAGS.sample_name_to_call))
       return candidates, gvcfs
 
-    candidates['child'], gvcfs[
-        'child'] = self.variant_caller_child.calls_and_gvcfs(
-            allele_counters, gvcf_output_enabled(self.options),
-            FLAGS.sample_name)
+    candidates['child'], gvcfs['child'] = (
+        self.variant_caller_child.calls_and_gvcfs_from_multi_sample_counter(
+            allele_counter, gvcf_output_enabled(self.options),
+            FLAGS.sample_name))
     if FLAGS.reads_parent1:
       candidates['parent1'], gvcfs['parent1'] = (
-          self.variant_caller_parent1.calls_and_gvcfs(
-              allele_counters, gvcf_output_enabled(self.options),
+          self.variant_caller_parent1.calls_and_gvcfs_from_multi_sample_counter(
+              allele_counter, gvcf_output_enabled(self.options),
               FLAGS.sample_name_parent1))
     if FLAGS.reads_parent2:
       candidates['parent2'], gvcfs['parent2'] = (
-          self.variant_caller_parent2.calls_and_gvcfs(
-              allele_counters, gvcf_output_enabled(self.options),
+          self.variant_caller_parent2.calls_and_gvcfs_from_multi_sample_counter(
+              allele_counter, gvcf_output_enabled(self.options),
               FLAGS.sample_name_parent2))
     return candidates, gvcfs
 
@@ -1383,9 +1505,6 @@ class RegionProcessor(object):
         self.realigner.ref_reader.contig(contig).n_bases, ref_end + margin)
     alignment_region = ranges.make_range(contig, max(ref_start - margin, 0),
                                          valid_end)
-    trimmed_reads = [realigner.trim_read(r, alignment_region) for r in reads]
-    # Filter reads to a minimum read length of 15 bp after trimming.
-    reads = [r for r in trimmed_reads if len(r.aligned_sequence) >= 15]
     prefix = self.realigner.ref_reader.query(
         ranges.make_range(contig, max(ref_start - margin, 0), ref_start))
     suffix = self.realigner.ref_reader.query(
@@ -1402,7 +1521,10 @@ class RegionProcessor(object):
           suffix=suffix,
           reads=reads,
           contig=contig,
-          ref_start=ref_start - len(prefix))
+          ref_start=ref_start - len(prefix),
+          # Reads are trimmed to the alignment region by the aligner.
+          trim_region=alignment_region,
+          min_read_length=_MIN_TRIMMED_READ_LENGTH)
       # Sequence of the alt haplotype in the window:
       end_of_prefix = prefix[-window_half_width:]
       beginning_of_suffix = suffix[:max(window_half_width + 1 - len(hap), 0)]
@@ -1429,11 +1551,17 @@ class RegionProcessor(object):
     Returns:
       A list of tf.Example protos.
     """
+    variant = dv_call.variant
+    variant_key = (variant.reference_name, variant.start, variant.end)
+    # pylint: disable=g-long-lambda
     reads_for_samples = [
-        self.pics[samples_id].get_reads(
-            dv_call.variant, sam_reader=sample.in_memory_sam_reader)
+        self._cached_for_region(
+            ('reads', sample) + variant_key,
+            lambda sample=sample: self.pics[samples_id].get_reads(
+                variant, sam_reader=sample.in_memory_sam_reader))
         for sample in self.samples[samples_id]
     ]
+    # pylint: enable=g-long-lambda
     # Decide whether each candidate needs ALT-alignment.
     alt_align_this_variant = False
     if self.options.pic_options.alt_aligned_pileup != 'none':
@@ -1447,10 +1575,15 @@ class RegionProcessor(object):
     if alt_align_this_variant:
       # Align the reads against each alternate allele, saving the sequences of
       # those alleles along with the alignments for pileup images.
+      alt_key = variant_key + tuple(variant.alternate_bases)
+      # pylint: disable=g-long-lambda
       alt_info_for_samples = [
-          self.align_to_all_haplotypes(dv_call.variant, reads)
-          for reads in reads_for_samples
+          self._cached_for_region(
+              ('alt_alignments', sample) + alt_key,
+              lambda reads=reads: self.align_to_all_haplotypes(variant, reads))
+          for sample, reads in zip(self.samples[samples_id], reads_for_samples)
       ]
+      # pylint: enable=g-long-lambda
       # Each sample has different reads and thus different alt-alignments.
       haplotype_alignments_for_samples = [
           sample['alt_alignments'] for sample in alt_info_for_samples
@@ -1595,18 +1728,26 @@ class OutputsWriter(object):
     if options.candidates_filename:
       self._add_writer(
           'candidates',
-          tfrecord.Writer(
-              self._add_suffix(options.candidates_filename, suffix)))
+          self._make_writer(
+              options, self._add_suffix(options.candidates_filename, suffix)))
 
     if options.examples_filename:
       self._add_writer(
           'examples',
-          tfrecord.Writer(self._add_suffix(options.examples_filename, suffix)))
+          self._make_writer(
+              options, self._add_suffix(options.examples_filename, suffix)))
 
     if options.gvcf_filename:
       self._add_writer(
           'gvcfs',
-          tfrecord.Writer(self._add_suffix(options.gvcf_filename, suffix)))
+          self._make_writer(options,
+                            self._add_suffix(options.gvcf_filename, suffix)))
+
+  def _make_writer(self, options, path):
+    return make_examples_utils.make_tfrecord_writer(
+        path,
+        compression_threads=options.output_compression_threads,
+        compression_level=options.output_compression_level)
 
   def _add_suffix(self, file_path, suffix):
     """Adds suffix to file name."""
@@ -1304,6 +1304,46 @@ class RegionProcessorTest(parameterized.TestCase):
           mock.call(e3, l2),
       ], mock_alte.call_args_list)
 
+  def test_process_realigns_samples_jointly(self):
+    self.processor.options.realigner_enabled = True
+    self.processor.options.joint_realignment = True
+    reads = [[mock.Mock()], [mock.Mock()], [mock.Mock()]]
+    mock_rr = self.add_mock('region_reads')
+    mock_jrr = self.add_mock('joint_region_reads', retval=reads)
+    self.add_mock('candidates_in_region', retval=({'child': []}, {}))
+    self.add_mock('label_candidates', retval=[])
+
+    self.processor.process(self.region)
+
+    test_utils.assert_not_called_workaround(mock_rr)
+    mock_jrr.assert_called_once_with(
+        self.region,
+        [sample.sam_reader for sample in self.processor.samples['child']])
+    for sample, sample_reads in zip(self.processor.samples['child'], reads):
+      sample.in_memory_sam_reader.replace_reads.assert_called_once_with(
+          sample_reads)
+
+  def test_joint_region_reads(self):
+    self.processor.options.max_reads_per_partition = 0
+    self.processor.realigner = mock.Mock()
+    long_read = test_utils.make_read('A' * 501, start=10, cigar='501M')
+    short_reads = [
+        test_utils.make_read('ACGT', start=20, cigar='4M', name=str(i))
+        for i in range(3)
+    ]
+    sam_readers = [mock.Mock(), mock.Mock()]
+    sam_readers[0].query.return_value = [long_read, short_reads[0]]
+    sam_readers[1].query.return_value = short_reads[1:]
+    realigned = [[mock.Mock()], [mock.Mock(), mock.Mock()]]
+    self.processor.realigner.realign_reads_jointly.return_value = ([],
+                                                                    realigned)
+
+    self.assertEqual([[long_read] + realigned[0], realigned[1]],
+                     self.processor.joint_region_reads(self.region,
+                                                       sam_readers))
+    self.processor.realigner.realign_reads_jointly.assert_called_once_with(
+        [[short_reads[0]], short_reads[1:]], self.region)
+
   def test_create_pileup_examples_handles_none(self):
     self.processor.pics['child'] = mock.Mock()
     dv_call = mock.Mock()
@@ -1342,6 +1382,55 @@ class RegionProcessorTest(parameterized.TestCase):
       self.assertEqual(
           tf_utils.example_image_format(ex), six.b(self.default_format))
 
+  def test_create_pileup_examples_shares_reads_of_samples(self):
+    self.processor.pics['child'] = mock.Mock()
+    self.processor.pics['parent1'] = mock.Mock()
+    for pic in self.processor.pics.values():
+      pic.create_pileup_images.return_value = None
+    dv_call = deepvariant_pb2.DeepVariantCall(
+        variant=test_utils.make_variant(start=10, alleles=['A', 'C']))
+
+    self.processor.create_pileup_examples(dv_call, 'child')
+    self.processor.create_pileup_examples(dv_call, 'parent1')
+
+    # The reads of each sample are only fetched for the first image.
+    self.assertEqual(3, self.processor.pics['child'].get_reads.call_count)
+    self.processor.pics['parent1'].get_reads.assert_not_called()
+    self.assertEqual(
+        self.processor.pics['child'].create_pileup_images.call_args[1]
+        ['reads_for_samples'], self.processor.pics['parent1']
+        .create_pileup_images.call_args[1]['reads_for_samples'])
+
+  @parameterized.parameters(0, 3)
+  def test_process_creates_examples_of_samples_concurrently(
+      self, example_threads):
+    self.processor.options.mode = deeptrio_pb2.DeepTrioOptions.CALLING
+    self.processor.options.example_threads = example_threads
+    c1, c2, c3 = mock.Mock(), mock.Mock(), mock.Mock()
+    examples = {c1: [mock.Mock()], c2: [mock.Mock(), mock.Mock()], c3: []}
+    self.add_mock('region_reads', retval=[])
+    self.add_mock(
+        'candidates_in_region',
+        retval=({
+            'child': [c1],
+            'parent1': [c2],
+            'parent2': [c3]
+        }, {}))
+    self.add_mock(
+        'create_pileup_examples',
+        side_effect=lambda candidate, sample: examples[candidate])
+
+    candidates, examples_dict, _ = self.processor.process(self.region)
+
+    self.assertEqual({'child': [c1], 'parent1': [c2], 'parent2': [c3]},
+                     candidates)
+    self.assertEqual(
+        {
+            'child': examples[c1],
+            'parent1': examples[c2],
+            'parent2': examples[c3]
+        }, examples_dict)
+
   @parameterized.parameters(
       # Test that a het variant gets a label value of 1 assigned to the example.
       dict(
@@ -92,6 +92,47 @@ class WrapVariantCallingTest(absltest.TestCase):
     for candidate in candidates:
       self.assertIsInstance(candidate, deepvariant_pb2.DeepVariantCall)
 
+  def test_call_from_multi_sample_allele_counter(self):
+    ref = fasta.IndexedFastaReader(testdata.CHR20_FASTA)
+    sam_reader = sam.SamReader(testdata.CHR20_BAM)
+    size = 1000
+    region = ranges.make_range('chr20', 10000000, 10000000 + size)
+    options = deepvariant_pb2.AlleleCounterOptions(partition_size=size)
+    caller = variant_calling_deeptrio.VariantCaller(
+        deepvariant_pb2.VariantCallerOptions(
+            min_count_snps=2,
+            min_count_indels=2,
+            min_fraction_snps=0.12,
+            min_fraction_indels=0.12,
+            sample_name='child',
+            p_error=0.001,
+            max_gq=50,
+            gq_resolution=1,
+            ploidy=2))
+    reads = list(sam_reader.query(region))
+    reads_for_samples = {'child': reads[::2], 'parent': reads[1::2]}
+
+    allele_counter = _allelecounter.MultiSampleAlleleCounter(
+        ref.c_reader, region, options, ['child', 'parent'])
+    allele_counter.add_reads_for_samples(
+        [reads_for_samples['child'], reads_for_samples['parent']])
+    candidates = caller.calls_from_multi_sample_allele_counter(
+        allele_counter, 'child')
+
+    # The candidates are the same as those called from an AlleleCounter for
+    # each sample.
+    allele_counts = {}
+    for sample, sample_reads in reads_for_samples.items():
+      sample_counter = _allelecounter.AlleleCounter(ref.c_reader, region,
+                                                    options)
+      for read in sample_reads:
+        sample_counter.add(read, sample)
+      allele_counts[sample] = sample_counter.counts()
+    self.assertNotEmpty(candidates)
+    expected = caller.calls_from_allele_counts(allele_counts, 'child')
+    self.assertEqual([c.variant for c in expected],
+                     [c.variant for c in candidates])
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -368,6 +368,53 @@ class VariantCaller(object):
           self.make_gvcfs(allele_counters[target_sample].summary_counts()))
     return candidates, gvcfs
 
+  def calls_and_gvcfs_from_multi_sample_counter(self, allele_counter,
+                                                include_gvcfs, target_sample):
+    """Gets variant calls and gvcf records for all sites in allele_counter.
+
+    Like calls_and_gvcfs, but for the allele counts of all samples held in one
+    MultiSampleAlleleCounter.
+
+    Args:
+      allele_counter: MultiSampleAlleleCounter holding the allele counts of
+        all samples.
+      include_gvcfs: boolean. If True, we will compute gVCF records for all of
+        the AlleleCounts of target_sample.
+      target_sample: string. Sample id of sample for which variants are called.
+
+    Returns:
+      The same two values as calls_and_gvcfs.
+    """
+    candidates = self.get_candidates_from_multi_sample_counter(
+        allele_counter, target_sample)
+
+    gvcfs = []
+    if include_gvcfs:
+      gvcfs = list(
+          self.make_gvcfs(allele_counter.summary_counts(target_sample)))
+    return candidates, gvcfs
+
   @abc.abstractmethod
   def get_candidates(self, allele_counts, target_sample):
     raise NotImplementedError
+
+  def get_candidates_from_multi_sample_counter(self, allele_counter,
+                                               target_sample):
+    """Gets the candidates of target_sample from a MultiSampleAlleleCounter.
+
+    Subclasses that can read the counts in place should override this, which
+    by default copies the counts of each sample out for get_candidates.
+
+    Args:
+      allele_counter: MultiSampleAlleleCounter holding the allele counts of
+        all samples.
+      target_sample: string. Sample id of sample for which variants are called.
+
+    Returns:
+      A list of DeepVariantCall protos containing our candidate variants.
+    """
+    allele_counts = {
+        sample: allele_counter.counts(sample)
+        for sample in allele_counter.samples()
+    }
+    return self.get_candidates(allele_counts, target_sample)
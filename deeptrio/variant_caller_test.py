@@ -457,6 +457,27 @@ class VariantCallerTests(parameterized.TestCase):
     else:
       self.assertEmpty(gvcfs)
 
+  def test_calls_and_gvcfs_from_multi_sample_counter(self):
+    counts = [(0, 0, 'A'), (10, 10, 'G')]
+    sample_counter = self.fake_allele_counter(10, counts)
+    allele_counter = mock.Mock()
+    allele_counter.samples.return_value = ['child', 'parent']
+    allele_counter.counts.side_effect = lambda sample: [sample]
+    allele_counter.summary_counts.return_value = (
+        sample_counter.summary_counts.return_value)
+    caller = DummyVariantCaller(0.01, 100)
+
+    with mock.patch.object(caller, 'get_candidates') as mock_gc:
+      candidates, gvcfs = caller.calls_and_gvcfs_from_multi_sample_counter(
+          allele_counter, True, 'child')
+
+    # By default the counts of each sample are passed to get_candidates.
+    mock_gc.assert_called_once_with(
+        {'child': ['child'], 'parent': ['parent']}, 'child')
+    self.assertEqual(mock_gc.return_value, candidates)
+    allele_counter.summary_counts.assert_called_once_with('child')
+    self.assertLen(gvcfs, 2)
+
 
 _CACHE_COVERAGE = 20  # Outside class so we can refer to it in @Parameters.
 
@@ -411,6 +411,34 @@ std::vector<DeepVariantCall> VariantCaller::CallsFromAlleleCounts(
   return variants;
 }
 
+std::vector<DeepVariantCall> VariantCaller::CallsFromMultiSampleAlleleCounter(
+    const MultiSampleAlleleCounter& allele_counter,
+    const string& target_sample) const {
+  if (allele_counter.SampleIndex(target_sample) < 0) {
+    LOG(WARNING) << "allele_counter does not count the target sample!";
+    return std::vector<DeepVariantCall>();
+  }
+
+  const std::vector<string>& samples = allele_counter.Samples();
+  std::vector<DeepVariantCall> variants;
+
+  // The map is reused for all positions, so that assigning the counts of a
+  // position reuses the memory of the previous one.
+  std::unordered_map<std::string, AlleleCount> allele_counts_per_sample;
+  for (int pos = 0; pos < allele_counter.IntervalLength(); ++pos) {
+    for (size_t i = 0; i < samples.size(); ++i) {
+      allele_counts_per_sample[samples[i]] = allele_counter.Counts(i)[pos];
+    }
+    optional<DeepVariantCall> call =
+        CallVariant(allele_counts_per_sample, target_sample);
+    if (call) {
+      variants.push_back(*call);
+    }
+  }
+
+  return variants;
+}
+
 optional<DeepVariantCall> VariantCaller::CallVariant(
     const std::unordered_map<std::string, AlleleCount>& allele_counts,
     const string& target_sample) const {
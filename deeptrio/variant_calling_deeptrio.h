@@ -54,6 +54,7 @@ using learning::genomics::deepvariant::AlleleCount;
 using learning::genomics::deepvariant::AlleleCounter;
 using learning::genomics::deepvariant::AlleleType;
 using learning::genomics::deepvariant::DeepVariantCall;
+using learning::genomics::deepvariant::MultiSampleAlleleCounter;
 using learning::genomics::deepvariant::VariantCallerOptions;
 
 // The alternate allele string for the gVCF "any" alternate allele.
@@ -158,6 +159,12 @@ class VariantCaller {
           allele_counts_wrapper,
       const std::string& target_sample) const;
 
+  // Same as CallsFromAlleleCounts, for the samples of allele_counter. The
+  // counts are read in place, without being passed back in from Python.
+  std::vector<DeepVariantCall> CallsFromMultiSampleAlleleCounter(
+      const MultiSampleAlleleCounter& allele_counter,
+      const std::string& target_sample) const;
+
   // Primary interface function for calling variants.
   //
   // Looks at the alleles in the provided AlleleCount proto and returns
@@ -54,3 +54,8 @@ class VerySensitiveCaller(variant_caller.VariantCaller):
   def get_candidates(self, allele_counts, sample_name):
     return self.cpp_variant_caller.calls_from_allele_counts(
         allele_counts, sample_name)
+
+  def get_candidates_from_multi_sample_counter(self, allele_counter,
+                                               sample_name):
+    return self.cpp_variant_caller.calls_from_multi_sample_allele_counter(
+        allele_counter, sample_name)
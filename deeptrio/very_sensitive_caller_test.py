@@ -128,6 +128,27 @@ class VerySensitiveCallerTests(parameterized.TestCase):
         expected_allele_counts_param, 'sample_id')
     self.assertEqual(candidates, fake_candidates)
 
+  def test_calls_from_multi_sample_allele_counter(self):
+    allele_counter = mock.Mock()
+    fake_candidates = [
+        deepvariant_pb2.DeepVariantCall(
+            variant=test_utils.make_variant(alleles=['G', 'C'], start=11)),
+    ]
+
+    caller = self.make_test_caller(0.01, 100)
+    with mock.patch.object(caller, 'cpp_variant_caller') as mock_cpp:
+      mock_cpp.calls_from_multi_sample_allele_counter.return_value = (
+          fake_candidates)
+      candidates, gvcfs = caller.calls_and_gvcfs_from_multi_sample_counter(
+          allele_counter, False, 'sample_id')
+
+    # The counts are read by the native caller, not copied out in Python.
+    mock_cpp.calls_from_multi_sample_allele_counter.assert_called_once_with(
+        allele_counter, 'sample_id')
+    allele_counter.counts.assert_not_called()
+    self.assertEqual(candidates, fake_candidates)
+    self.assertEqual(gvcfs, [])
+
 
 if __name__ == '__main__':
   absltest.main()
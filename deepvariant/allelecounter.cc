@@ -330,14 +330,60 @@ void AlleleCounter::AddReadAlleles(const Read& read, const string& sample,
   }
 }
 
-void AlleleCounter::Add(const Read& read, const string& sample) {
-  // redacted
-  // Make sure our incoming read has a mapping quality above our min. threshold.
-  if (read.alignment().mapping_quality() <
-      options_.read_requirements().min_mapping_quality()) {
-    return;
+void AlleleCounter::RemoveReadAlleles(
+    const Read& read, const string& sample,
+    const std::vector<ReadAllele>& to_remove) {
+  for (size_t i = 0; i < to_remove.size(); ++i) {
+    const ReadAllele& to_remove_i = to_remove[i];
+
+    // Mirror the skipping logic of AddReadAlleles() exactly, so that we only
+    // undo the counts that were actually added.
+    if (to_remove_i.skip() || !IsValidRefOffset(to_remove_i.position())) {
+      continue;
+    }
+    if (i + 1 < to_remove.size() &&
+        to_remove_i.position() == to_remove[i + 1].position()) {
+      continue;
+    }
+
+    AlleleCount& allele_count = counts_[to_remove_i.position()];
+
+    if (to_remove_i.type() == AlleleType::REFERENCE) {
+      const int prev_count = allele_count.ref_supporting_read_count();
+      if (prev_count <= 0) {
+        LOG(WARNING) << "Not removing a reference allele of read "
+                     << ReadKey(read) << " that was never added at "
+                     << allele_count.position().ShortDebugString();
+        continue;
+      }
+      allele_count.set_ref_supporting_read_count(prev_count - 1);
+    } else {
+      allele_count.mutable_read_alleles()->erase(ReadKey(read));
+
+      // Remove a single matching allele for this sample, dropping the sample
+      // entirely once it no longer supports any alleles.
+      auto* sample_alleles = allele_count.mutable_sample_alleles();
+      auto sample_it = sample_alleles->find(sample);
+      if (sample_it == sample_alleles->end()) {
+        continue;
+      }
+      auto* alleles = sample_it->second.mutable_alleles();
+      for (int j = 0; j < alleles->size(); ++j) {
+        const Allele& allele = alleles->Get(j);
+        if (allele.bases() == to_remove_i.bases() &&
+            allele.type() == to_remove_i.type()) {
+          alleles->DeleteSubrange(j, 1);
+          break;
+        }
+      }
+      if (alleles->empty()) {
+        sample_alleles->erase(sample_it);
+      }
+    }
   }
+}
 
+std::vector<ReadAllele> AlleleCounter::ComputeReadAlleles(const Read& read) {
   const LinearAlignment& aln = read.alignment();
   std::vector<ReadAllele> to_add;
   to_add.reserve(read.aligned_quality_size());
@@ -397,10 +443,32 @@ void AlleleCounter::Add(const Read& read, const string& sample) {
     }
   }
 
-  AddReadAlleles(read, sample, to_add);
+  return to_add;
+}
+
+void AlleleCounter::Add(const Read& read, const string& sample) {
+  // redacted
+  // Make sure our incoming read has a mapping quality above our min. threshold.
+  if (read.alignment().mapping_quality() <
+      options_.read_requirements().min_mapping_quality()) {
+    return;
+  }
+
+  AddReadAlleles(read, sample, ComputeReadAlleles(read));
   ++n_reads_counted_;
 }
 
+void AlleleCounter::Remove(const Read& read, const string& sample) {
+  // Reads below our mapping quality threshold were never added by Add().
+  if (read.alignment().mapping_quality() <
+      options_.read_requirements().min_mapping_quality()) {
+    return;
+  }
+
+  RemoveReadAlleles(read, sample, ComputeReadAlleles(read));
+  --n_reads_counted_;
+}
+
 string AlleleCounter::ReadKey(const Read& read) {
   return StrCat(read.fragment_name(), kFragmentNameReadNumberSeparator,
                 read.read_number());
@@ -424,6 +492,50 @@ std::vector<AlleleCountSummary> AlleleCounter::SummaryCounts() const {
   return summaries;
 }
 
+MultiSampleAlleleCounter::MultiSampleAlleleCounter(
+    const GenomeReference* const ref, const Range& range,
+    const AlleleCounterOptions& options, const std::vector<string>& samples)
+    : samples_(samples) {
+  CHECK(!samples_.empty()) << "At least one sample is required";
+  counters_.reserve(samples_.size());
+  counters_.emplace_back(ref, range, options);
+  for (size_t i = 1; i < samples_.size(); ++i) {
+    counters_.push_back(counters_.front());
+  }
+}
+
+void MultiSampleAlleleCounter::Add(const Read& read, const int sample_index) {
+  CHECK_GE(sample_index, 0) << "Unknown sample index " << sample_index;
+  CHECK_LT(sample_index, static_cast<int>(samples_.size()))
+      << "Unknown sample index " << sample_index;
+  counters_[sample_index].Add(read, samples_[sample_index]);
+}
+
+void MultiSampleAlleleCounter::AddReadsForSamplesPython(
+    const std::vector<std::vector<nucleus::ConstProtoPtr<const Read>>>&
+        reads_for_samples) {
+  CHECK_EQ(reads_for_samples.size(), samples_.size())
+      << "Expected the reads of each of the " << samples_.size() << " samples";
+  for (size_t i = 0; i < reads_for_samples.size(); ++i) {
+    for (const auto& wrapped : reads_for_samples[i]) {
+      Add(*(wrapped.p_), i);
+    }
+  }
+}
+
+int MultiSampleAlleleCounter::SampleIndex(const string& sample) const {
+  const auto it = std::find(samples_.begin(), samples_.end(), sample);
+  return it == samples_.end() ? -1 : it - samples_.begin();
+}
+
+const AlleleCounter& MultiSampleAlleleCounter::Counter(
+    const int sample_index) const {
+  CHECK_GE(sample_index, 0) << "Unknown sample index " << sample_index;
+  CHECK_LT(sample_index, static_cast<int>(samples_.size()))
+      << "Unknown sample index " << sample_index;
+  return counters_[sample_index];
+}
+
 }  // namespace deepvariant
 }  // namespace genomics
 }  // namespace learning
@@ -236,6 +236,23 @@ class AlleleCounter {
     Add(*(wrapped.p_), sample);
   }
 
+  // Removes the alleles from read that a previous call to Add(read, sample)
+  // contributed to our AlleleCounts. This allows a caller to update counts
+  // incrementally when only a few reads change (e.g., after realignment)
+  // instead of recounting all of the reads. The read must have been added
+  // before with exactly the same alignment, otherwise the counts are
+  // undefined. Reference alleles that were never added are logged and left
+  // alone rather than making the counts negative.
+  void Remove(const ::nucleus::genomics::v1::Read& read, const string& sample);
+
+  // Simple wrapper around Remove() that allows us to efficiently pass large
+  // protobufs in from Python.
+  void RemovePython(const nucleus::ConstProtoPtr<
+                        const ::nucleus::genomics::v1::Read>& wrapped,
+                    const string& sample) {
+    Remove(*(wrapped.p_), sample);
+  }
+
   // Gets the options in use by this AlleleCounter
   const AlleleCounterOptions& Options() const { return options_; }
 
@@ -304,11 +321,22 @@ class AlleleCounter {
       const ::nucleus::genomics::v1::Read& read, int interval_offset,
       int read_offset, const ::nucleus::genomics::v1::CigarUnit& cigar);
 
+  // Computes the ReadAlleles implied by read's alignment to our interval, in
+  // the order expected by AddReadAlleles() and RemoveReadAlleles().
+  std::vector<ReadAllele> ComputeReadAlleles(
+      const ::nucleus::genomics::v1::Read& read);
+
   // Adds the ReadAlleles in to_add to our AlleleCounts.
   void AddReadAlleles(const ::nucleus::genomics::v1::Read& read,
                       const string& sample,
                       const std::vector<ReadAllele>& to_add);
 
+  // Removes the ReadAlleles in to_remove from our AlleleCounts, undoing a
+  // previous AddReadAlleles() with the same arguments.
+  void RemoveReadAlleles(const ::nucleus::genomics::v1::Read& read,
+                         const string& sample,
+                         const std::vector<ReadAllele>& to_remove);
+
   // Our GenomeReference, which we use to get information about the reference
   // bases in our interval.
   const nucleus::GenomeReference* const ref_;
@@ -331,6 +359,84 @@ class AlleleCounter {
   const string ref_bases_;
 };
 
+// Computes the AlleleCounts of several samples over the same interval.
+//
+// This gives the same counts as one AlleleCounter per sample, but the
+// reference bases and the AlleleCount positions of the interval are looked up
+// only once for all samples, and the reads of all samples are added in a
+// single pass, which saves a call from Python for every read. The counts
+// of sample i are in Counts(i), so for every position of the interval the
+// counts of all samples are at the same offset of their vectors, which lets
+// callers look at all samples at a position without copying their counts out
+// first (see the DeepTrio VariantCaller).
+class MultiSampleAlleleCounter {
+ public:
+  // Creates a MultiSampleAlleleCounter for samples, with the same arguments as
+  // AlleleCounter otherwise. Sample names must be unique.
+  MultiSampleAlleleCounter(const nucleus::GenomeReference* const ref,
+                           const ::nucleus::genomics::v1::Range& range,
+                           const AlleleCounterOptions& options,
+                           const std::vector<string>& samples);
+
+  // Adds the alleles from read to the AlleleCounts of samples()[sample_index].
+  void Add(const ::nucleus::genomics::v1::Read& read, int sample_index);
+
+  // Adds the reads of all samples, where reads_for_samples[i] are the reads of
+  // samples()[i]. Efficiently passes the reads in from Python, with one call
+  // for all of the reads.
+  void AddReadsForSamplesPython(
+      const std::vector<std::vector<
+          nucleus::ConstProtoPtr<const ::nucleus::genomics::v1::Read>>>&
+          reads_for_samples);
+
+  // Gets the names of the samples we are counting, in order.
+  const std::vector<string>& Samples() const { return samples_; }
+
+  // Returns the index of sample in Samples(), or -1 if we are not counting it.
+  int SampleIndex(const string& sample) const;
+
+  // Gets the interval we are counting alleles over.
+  const ::nucleus::genomics::v1::Range& Interval() const {
+    return counters_.front().Interval();
+  }
+
+  // Returns the number of basepairs in our interval.
+  int64 IntervalLength() const { return counters_.front().IntervalLength(); }
+
+  // Gets the AlleleCounts of samples()[sample_index], as AlleleCounter::Counts.
+  const std::vector<AlleleCount>& Counts(int sample_index) const {
+    return Counter(sample_index).Counts();
+  }
+
+  // Gets the AlleleCounts of sample, as AlleleCounter::Counts.
+  const std::vector<AlleleCount>& CountsForSample(const string& sample) const {
+    return Counter(SampleIndex(sample)).Counts();
+  }
+
+  // Gets the AlleleCountSummaries of sample, as AlleleCounter::SummaryCounts.
+  std::vector<AlleleCountSummary> SummaryCountsForSample(
+      const string& sample) const {
+    return Counter(SampleIndex(sample)).SummaryCounts();
+  }
+
+  // How many reads have been added for samples()[sample_index]?
+  int NCountedReads(int sample_index) const {
+    return Counter(sample_index).NCountedReads();
+  }
+
+ private:
+  // Gets the AlleleCounter of samples()[sample_index]. CHECK-fails if there is
+  // no such sample.
+  const AlleleCounter& Counter(int sample_index) const;
+
+  const std::vector<string> samples_;
+
+  // One AlleleCounter for each of samples_. All but the first are copies of
+  // the first made before any reads were added, so that they share its
+  // reference lookups.
+  std::vector<AlleleCounter> counters_;
+};
+
 }  // namespace deepvariant
 }  // namespace genomics
 }  // namespace learning
@@ -66,6 +66,7 @@ using tensorflow::strings::StrCat;
 using ::testing::Contains;
 using ::testing::Eq;
 using ::testing::IsEmpty;
+using ::testing::Pointwise;
 using ::testing::SizeIs;
 using ::testing::UnorderedPointwise;
 
@@ -560,6 +561,46 @@ TEST_F(AlleleCounterTest, TestMultipleReads) {
       });
 }
 
+TEST_F(AlleleCounterTest, TestRemoveUndoesAdd) {
+  // Tests that removing reads restores the counts we would get by only adding
+  // the remaining reads, for reference, substitution, and indel alleles.
+  const std::vector<Read> kept = {
+      MakeRead(chr_, start_, "TCCGT", {"5M"}),
+      MakeRead(chr_, start_ + 2, "CGT", {"3M"}),
+  };
+  const std::vector<Read> removed = {
+      MakeRead(chr_, start_, "TCGT", {"2M", "1D", "2M"}),
+      MakeRead(chr_, start_, "TCCAGT", {"3M", "1I", "2M"}),
+      MakeRead(chr_, start_, "TCAGT", {"5M"}),
+  };
+
+  auto expected = MakeCounter();
+  for (const auto& read : kept) expected->Add(read, "sample_id");
+
+  auto actual = MakeCounter();
+  for (const auto& read : kept) actual->Add(read, "sample_id");
+  for (const auto& read : removed) actual->Add(read, "sample_id");
+  for (const auto& read : removed) actual->Remove(read, "sample_id");
+
+  EXPECT_THAT(actual->NCountedReads(), Eq(expected->NCountedReads()));
+  EXPECT_THAT(actual->Counts(), Pointwise(EqualsProto(), expected->Counts()));
+}
+
+TEST_F(AlleleCounterTest, TestRemoveReadNeverAdded) {
+  // Tests that removing a read that was never added does not make the
+  // reference counts negative, and leaves the counts of other reads alone.
+  const Read kept = MakeRead(chr_, start_ + 2, "CGT", {"3M"});
+
+  auto expected = MakeCounter();
+  expected->Add(kept, "sample_id");
+
+  auto actual = MakeCounter();
+  actual->Add(kept, "sample_id");
+  actual->Remove(MakeRead(chr_, start_, "TC", {"2M"}), "sample_id");
+
+  EXPECT_THAT(actual->Counts(), Pointwise(EqualsProto(), expected->Counts()));
+}
+
 TEST_F(AlleleCounterTest, TestSoftClips1) {
   AddAndCheckReads(MakeRead(chr_, start_ + 2, "AACGT", {"2S", "3M"}),
                    {
@@ -995,6 +1036,47 @@ TEST_F(AlleleCounterTest, TestAlleleSamplSupport_one_sample_three_reads) {
   }
 }
 
+TEST_F(AlleleCounterTest, TestMultiSampleAlleleCounter) {
+  const std::vector<string> samples = {"parent1", "child", "parent2"};
+  const std::vector<std::vector<Read>> reads_for_samples = {
+      {MakeRead(chr_, start_, "TCCGT", {"5M"}),
+       MakeRead(chr_, start_, "TCTGT", {"5M"})},
+      {MakeRead(chr_, start_, "TCAGT", {"5M"})},
+      {MakeRead(chr_, start_ + 1, "CCAGT", {"2M1I2M"}),
+       MakeRead(chr_, start_, "TCCGT", {"5M"}),
+       MakeRead(chr_, start_, "TCGGT", {"5M"})},
+  };
+
+  MultiSampleAlleleCounter multi_sample_counter(
+      ref_.get(), MakeRange(chr_, start_, end_), options_, samples);
+  EXPECT_THAT(multi_sample_counter.Samples(), Eq(samples));
+  EXPECT_THAT(multi_sample_counter.SampleIndex("child"), Eq(1));
+  EXPECT_THAT(multi_sample_counter.SampleIndex("unknown"), Eq(-1));
+
+  for (size_t i = 0; i < samples.size(); ++i) {
+    for (const Read& read : reads_for_samples[i]) {
+      multi_sample_counter.Add(read, i);
+    }
+  }
+
+  // The counts of each sample are those of an AlleleCounter given only the
+  // reads of that sample.
+  for (size_t i = 0; i < samples.size(); ++i) {
+    auto allele_counter = MakeCounter();
+    for (const Read& read : reads_for_samples[i]) {
+      allele_counter->Add(read, samples[i]);
+    }
+    EXPECT_THAT(multi_sample_counter.NCountedReads(i),
+                Eq(allele_counter->NCountedReads()));
+    EXPECT_THAT(multi_sample_counter.Counts(i),
+                Pointwise(EqualsProto(), allele_counter->Counts()));
+    EXPECT_THAT(multi_sample_counter.CountsForSample(samples[i]),
+                Pointwise(EqualsProto(), allele_counter->Counts()));
+    EXPECT_THAT(multi_sample_counter.SummaryCountsForSample(samples[i]),
+                Pointwise(EqualsProto(), allele_counter->SummaryCounts()));
+  }
+}
+
 }  // namespace deepvariant
 }  // namespace genomics
 }  // namespace learning
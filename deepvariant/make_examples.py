@@ -36,7 +36,13 @@ if 'google' in sys.modules and 'google.protobuf' not in sys.modules:
   del sys.modules['google']
 
 
+import bisect
 import collections
+import contextlib
+import heapq
+import itertools
+import multiprocessing
+import threading
 import time
 
 
@@ -59,14 +65,15 @@ from deepvariant.labeler import customized_classes_labeler
 from deepvariant.labeler import haplotype_labeler
 from deepvariant.labeler import positional_labeler
 from deepvariant.protos import deepvariant_pb2
+from deepvariant.protos import resources_pb2
 from deepvariant.python import allelecounter
 from deepvariant.realigner import realigner
+from deepvariant.realigner import window_selector
 from deepvariant.vendor import timer
 from google.protobuf import text_format
 from third_party.nucleus.io import fasta
 from third_party.nucleus.io import sam
 from third_party.nucleus.io import sharded_file_utils
-from third_party.nucleus.io import tfrecord
 from third_party.nucleus.io import vcf
 from third_party.nucleus.io.python import hts_verbose
 from third_party.nucleus.protos import reads_pb2
@@ -88,6 +95,17 @@ NO_RANDOM_REF = 0.0
 # The name used for a sample if one is not specified or present in the reads.
 _UNKNOWN_SAMPLE = 'UNKNOWN'
 
+# The number of slowest regions whose per-stage metrics are kept in the
+# MakeExamplesRunInfo. Use --runtime_by_region to get all regions.
+_RUN_INFO_SLOWEST_REGIONS = 100
+
+# The stages of processing a region, in the order of the runtime_by_region
+# columns. The realigner contributes select_windows, assemble and align.
+_REGION_STAGES = ('query_reads', 'sample_reads', 'select_windows', 'assemble',
+                  'align', 'count_alleles', 'call_candidates',
+                  'annotate_allele_frequencies', 'label', 'encode_pileups',
+                  'write_outputs')
+
 # The extension we add to our examples path to write our MakeExamplesRunInfo
 # protobuf.
 _RUN_INFO_FILE_EXTENSION = '.run_info.pbtxt'
@@ -98,6 +116,25 @@ _RUN_INFO_FILE_EXTENSION = '.run_info.pbtxt'
 # across a variety of distributed filesystems!
 _DEFAULT_HTS_BLOCK_SIZE = 128 * (1024 * 1024)
 
+# Population VCF records are fetched and cached in blocks of this many bases,
+# and at most _POPULATION_VCF_CACHE_BLOCKS parsed blocks are kept in memory.
+# With the default partition size adjacent regions share a block, so most
+# regions are annotated without touching the population VCF at all.
+_POPULATION_VCF_BLOCK_SIZE = 10000
+_POPULATION_VCF_CACHE_BLOCKS = 32
+
+# Reads with fewer bases than this left after trimming to the alt-alignment
+# window are not used in alt-aligned pileups.
+_MIN_TRIMMED_READ_LENGTH = 15
+
+# Read counts for adaptive partitioning are estimated from the BAM index in
+# tiles of this many bases, the size of the smallest .bai bins, and prorated to
+# the partitions overlapping each tile. Dense partitions are never split into
+# pieces smaller than _MIN_ADAPTIVE_PARTITION_SIZE bases.
+_READ_COUNT_TILE_SIZE = 16384
+_READ_COUNT_CACHED_TILES = 64
+_MIN_ADAPTIVE_PARTITION_SIZE = 100
+
 flags.DEFINE_string(
     'ref', None,
     'Required. Genome reference to use. Must have an associated FAI index as '
@@ -160,6 +197,11 @@ flags.DEFINE_string(
     'Tabix-indexed VCF file containing the proposed positions and alts for '
     '`vcf_candidate_importer`. The GTs will be ignored.')
 flags.DEFINE_integer('task', 0, 'Task ID of this task')
+flags.DEFINE_integer(
+    'num_workers', 1,
+    'Number of worker processes used to process regions within this task. '
+    'Regions are farmed out to forked workers and their outputs are written '
+    'in genomic order by this process. 1 processes all regions serially.')
 flags.DEFINE_integer(
     'partition_size', 1000,
     'The maximum number of basepairs we will allow in a region before splitting'
@@ -175,10 +217,76 @@ flags.DEFINE_bool(
     'realign_reads', True,
     'If True, locally realign reads before calling variants. '
     'Reads longer than 500 bp are never realigned.')
+flags.DEFINE_bool(
+    'share_allele_counter_with_realigner', False,
+    'If True, count alleles once per region and share the counts between the '
+    'realigner window selector and candidate calling, updating them only for '
+    'the reads changed by realignment. Window selection then uses the reads '
+    'and read requirements of candidate calling instead of the --ws_min_mapq '
+    'and --ws_min_base_quality thresholds. Ignored if --norealign_reads.')
 flags.DEFINE_bool(
     'write_run_info', False,
     'If True, write out a MakeExamplesRunInfo proto besides our examples in '
     'text_format.')
+flags.DEFINE_string(
+    'runtime_by_region', None,
+    '[optional] Output filename for a TSV file with the wall time and item '
+    'counts of each stage of processing, one line per region. Can be sharded '
+    'like --examples.')
+flags.DEFINE_string(
+    'region_costs', None,
+    '[optional] Comma-separated paths, glob patterns or sharded file specs of '
+    '--runtime_by_region TSV files from a previous run. If set, regions are '
+    'assigned to shards so that each shard gets about the same total '
+    'estimated runtime, instead of assigning them round-robin. All tasks must '
+    'see the same files.')
+flags.DEFINE_integer(
+    'partition_read_budget', 0,
+    '[optional] If > 0, size partitions adaptively using read counts estimated '
+    'from the BAM index: a --partition_size partition with more estimated '
+    'reads than this is split, and consecutive partitions are coalesced while '
+    'they stay below this many reads and --max_adaptive_partition_size bp. '
+    'Capped at --max_reads_per_partition. Fixed partitions are used if any '
+    'reads file is not a BAM with a .bai index.')
+flags.DEFINE_integer(
+    'max_adaptive_partition_size', 10000,
+    'The maximum size in basepairs of a partition coalesced from low-coverage '
+    'partitions when --partition_read_budget is set.')
+flags.DEFINE_bool(
+    'skip_empty_partitions', True,
+    'If True, partitions that the BAM index shows have no reads are not '
+    'processed. With --gvcf they are still processed to emit their '
+    'no-coverage gVCF records, but without querying or realigning reads. Has '
+    'no effect unless all reads files are BAMs with a .bai index.')
+flags.DEFINE_integer(
+    'prefetch_regions', 0,
+    'If > 0, the reads of up to this many upcoming regions are queried on a '
+    'background thread while the current region is processed. Only used with '
+    '--num_workers=1.')
+flags.DEFINE_integer(
+    'prefetch_max_reads', 100000,
+    'Stop prefetching regions while at least this many reads are buffered '
+    'by --prefetch_regions. 0 means no limit.')
+flags.DEFINE_bool(
+    'reuse_boundary_reads', True,
+    'If True, the reads spanning the boundary between two abutting regions '
+    'are decoded once and reused for the second region. Ignored with '
+    '--downsample_fraction.')
+flags.DEFINE_integer(
+    'max_in_flight_examples', 0,
+    'If > 0, the examples of a region are created as they are written out, '
+    'in batches of at most this many examples, instead of all being held in '
+    'memory until the region is done. Only used with --num_workers=1.')
+flags.DEFINE_integer(
+    'output_compression_threads', 0,
+    'If > 0, each gzipped TFRecord output is compressed in independent blocks '
+    'on this many threads, instead of on the thread writing it.')
+flags.DEFINE_integer(
+    'output_compression_level', -1,
+    'The zlib compression level of the gzipped TFRecord outputs, from 1 '
+    '(fastest) to 9 (smallest). 0 stores the records without compressing '
+    'them and -1 keeps the zlib default, as in zlib itself. Any level but -1 '
+    'compresses the outputs in blocks, see --output_compression_threads.')
 flags.DEFINE_enum(
     'alt_aligned_pileup', 'none',
     ['none', 'base_channels', 'diff_channels', 'rows'],
@@ -515,16 +623,21 @@ def default_options(add_flags=True, flags_obj=None):
               .format(svt, ', '.join(_VARIANT_TYPE_SELECTORS)),
               errors.CommandLineError)
 
-    num_shards, examples, candidates, gvcf = (
+    num_shards, examples, candidates, gvcf, runtime_by_region = (
         sharded_file_utils.resolve_filespecs(flags_obj.task,
                                              flags_obj.examples or '',
                                              flags_obj.candidates or '',
-                                             flags_obj.gvcf or ''))
+                                             flags_obj.gvcf or '',
+                                             flags_obj.runtime_by_region or ''))
     options.examples_filename = examples
     options.candidates_filename = candidates
     options.gvcf_filename = gvcf
+    options.runtime_by_region_filename = runtime_by_region
+    if flags_obj.region_costs:
+      options.region_costs_filename = flags_obj.region_costs
     options.task_id = flags_obj.task
     options.num_shards = num_shards
+    options.n_cores = flags_obj.num_workers
     if flags_obj.use_original_quality_scores and not flags_obj.parse_sam_aux_fields:
       errors.log_and_raise(
           'If use_original_quality_scores is set then parse_sam_aux_fields '
@@ -556,8 +669,19 @@ def default_options(add_flags=True, flags_obj=None):
 
     options.realigner_enabled = flags_obj.realign_reads
     options.realigner_options.CopyFrom(realigner.realigner_config(flags_obj))
+    options.share_allele_counter_with_realigner = (
+        flags_obj.share_allele_counter_with_realigner)
 
     options.max_reads_per_partition = flags_obj.max_reads_per_partition
+    options.partition_read_budget = flags_obj.partition_read_budget
+    options.skip_empty_partitions = flags_obj.skip_empty_partitions
+    options.prefetch_regions = flags_obj.prefetch_regions
+    options.prefetch_max_reads = flags_obj.prefetch_max_reads
+    options.reuse_boundary_reads = flags_obj.reuse_boundary_reads
+    options.max_in_flight_examples = flags_obj.max_in_flight_examples
+    options.output_compression_threads = flags_obj.output_compression_threads
+    options.output_compression_level = flags_obj.output_compression_level
+    options.max_adaptive_partition_size = flags_obj.max_adaptive_partition_size
 
     if (options.mode == deepvariant_pb2.DeepVariantOptions.TRAINING and
         flags_obj.training_random_emit_ref_sites != NO_RANDOM_REF):
@@ -912,6 +1036,116 @@ def find_matching_allele_frequency(variant,
   return dict_allele_frequency
 
 
+class PopulationVariantIndex(object):
+  """An in-memory index over the population VCF records near a region.
+
+  find_matching_allele_frequency issues one population VCF query per
+  candidate, which means one index seek per candidate. This class instead
+  streams the records overlapping all candidates of a region once and answers
+  the per-candidate queries from memory. It implements the query() method of
+  VcfReader, so it can be passed to find_matching_allele_frequency in place of
+  the reader.
+
+  Records are fetched in fixed-size blocks, and the parsed blocks are kept in
+  an LRU cache so adjacent regions reuse the records they share instead of
+  reading and parsing them again.
+  """
+
+  def __init__(self,
+               population_vcf_reader,
+               block_size=_POPULATION_VCF_BLOCK_SIZE,
+               max_cached_blocks=_POPULATION_VCF_CACHE_BLOCKS):
+    """Creates a new PopulationVariantIndex.
+
+    Args:
+      population_vcf_reader: A VcfReader object for the population VCF.
+      block_size: int. The number of bases fetched per population VCF query.
+      max_cached_blocks: int. The maximum number of blocks kept in memory.
+    """
+    if block_size <= 0:
+      raise ValueError('block_size must be > 0 but got {}'.format(block_size))
+    self._reader = population_vcf_reader
+    self._block_size = block_size
+    self._max_cached_blocks = max_cached_blocks
+    self._blocks = collections.OrderedDict()
+    self._loaded_range = None
+    self._variants = []
+    self._starts = []
+    self._max_span = 0
+
+  def load(self, variants):
+    """Loads the population records overlapping any of variants.
+
+    Args:
+      variants: Iterable of Variant protos on a single contig, typically the
+        candidates of one region.
+
+    Returns:
+      self, so the call can be chained.
+    """
+    variants = list(variants)
+    if not variants:
+      self._loaded_range = None
+      self._variants, self._starts, self._max_span = [], [], 0
+      return self
+    chrom = variants[0].reference_name
+    start = min(v.start for v in variants)
+    end = max(v.end for v in variants)
+    first_block = start // self._block_size
+    last_block = (end - 1) // self._block_size
+
+    # A record overlapping several blocks is returned by the query of each of
+    # them, so we only keep it from the first loaded block it overlaps.
+    loaded = []
+    for block in range(first_block, last_block + 1):
+      block_start = block * self._block_size
+      for variant in self._block_records(chrom, block):
+        if block == first_block or variant.start >= block_start:
+          loaded.append(variant)
+
+    self._loaded_range = ranges.make_range(
+        chrom, first_block * self._block_size,
+        (last_block + 1) * self._block_size)
+    self._variants = loaded
+    self._starts = [v.start for v in loaded]
+    self._max_span = max([v.end - v.start for v in loaded] or [0])
+    return self
+
+  def query(self, region):
+    """Returns the loaded population records overlapping region.
+
+    Regions outside the range covered by the last load() call are queried
+    directly from the population VCF.
+
+    Args:
+      region: A nucleus.genomics.v1.Range proto.
+
+    Returns:
+      An iterable of Variant protos, in the order of the population VCF.
+    """
+    loaded = self._loaded_range
+    if (loaded is None or region.reference_name != loaded.reference_name or
+        region.start < loaded.start or region.end > loaded.end):
+      return self._reader.query(region)
+    lo = bisect.bisect_left(self._starts, region.start - self._max_span)
+    hi = bisect.bisect_left(self._starts, region.end)
+    return [v for v in self._variants[lo:hi] if v.end > region.start]
+
+  def _block_records(self, chrom, block):
+    """Returns the parsed records overlapping a block, using the LRU cache."""
+    key = (chrom, block)
+    if key in self._blocks:
+      self._blocks.move_to_end(key)
+      return self._blocks[key]
+    block_range = ranges.make_range(chrom, block * self._block_size,
+                                    (block + 1) * self._block_size)
+    records = list(self._reader.query(block_range))
+    self._blocks[key] = records
+    while len(self._blocks) > self._max_cached_blocks:
+      self._blocks.popitem(last=False)
+    return records
+
+
 # ---------------------------------------------------------------------------
 # Region processing
 # ---------------------------------------------------------------------------
@@ -1074,11 +1308,261 @@ def build_calling_regions(contigs, regions_to_include, regions_to_exclude):
   return regions
 
 
+def read_region_costs(filespec):
+  """Reads the wall time of each region from --runtime_by_region TSV files.
+
+  Args:
+    filespec: str. Comma-separated paths, glob patterns or sharded file specs
+      of TSV files written by RegionMetricsWriter.
+
+  Returns:
+    A dict from reference_name to a list of (start, end, wall_time_seconds)
+    tuples sorted by start.
+
+  Raises:
+    ValueError: if filespec doesn't match any file.
+  """
+  filenames = sharded_file_utils.glob_list_sharded_file_patterns(filespec)
+  if not filenames:
+    raise ValueError('No region costs files found for {}'.format(filespec))
+  costs = collections.defaultdict(list)
+  for filename in filenames:
+    with tf.io.gfile.GFile(filename) as f:
+      header = f.readline().rstrip('\n').split('\t')
+      region_index = header.index('region')
+      seconds_index = header.index('wall_time_seconds')
+      for line in f:
+        fields = line.rstrip('\n').split('\t')
+        region = ranges.parse_literal(fields[region_index])
+        costs[region.reference_name].append(
+            (region.start, region.end, float(fields[seconds_index])))
+  for contig_costs in costs.values():
+    contig_costs.sort()
+  return dict(costs)
+
+
+def _estimate_region_costs(regions, region_costs):
+  """Estimates the cost of processing each region from a previous run's costs.
+
+  Each region costs the sum of the costs of the previously processed regions
+  it overlaps, prorated by the fraction of each one it covers. Regions that
+  overlap none of them cost their length times the average cost per base.
+
+  Args:
+    regions: list of nucleus.genomics.v1.Range protos.
+    region_costs: dict returned by read_region_costs.
+
+  Returns:
+    A list of floats, the estimated cost of each of regions.
+  """
+  known_seconds = sum(c[2] for cs in region_costs.values() for c in cs)
+  known_bases = sum(c[1] - c[0] for cs in region_costs.values() for c in cs)
+  seconds_per_base = known_seconds / known_bases if known_bases else 1.0
+  starts = {
+      contig: [c[0] for c in contig_costs]
+      for contig, contig_costs in region_costs.items()
+  }
+
+  estimates = []
+  for region in regions:
+    contig_costs = region_costs.get(region.reference_name, [])
+    i = max(
+        bisect.bisect_right(starts.get(region.reference_name, []),
+                            region.start) - 1, 0)
+    estimate = 0.0
+    overlapped = False
+    while i < len(contig_costs) and contig_costs[i][0] < region.end:
+      start, end, seconds = contig_costs[i]
+      overlap = min(end, region.end) - max(start, region.start)
+      if overlap > 0:
+        estimate += seconds * overlap / (end - start)
+        overlapped = True
+      i += 1
+    if not overlapped:
+      estimate = ranges.length(region) * seconds_per_base
+    estimates.append(estimate)
+  return estimates
+
+
+def _balanced_shard_assignment(costs, num_shards):
+  """Assigns items to shards so that the total cost of each is about equal.
+
+  Items are handed out from the most to the least costly, each to the shard
+  with the lowest total cost so far. Ties are broken by index, so all tasks
+  compute the same assignment from the same costs.
+
+  Args:
+    costs: list of floats, the cost of each item.
+    num_shards: int > 0. The number of shards.
+
+  Returns:
+    A list with the shard of each item.
+  """
+  # (total cost, number of items, shard) so that zero cost items are spread.
+  loads = [(0.0, 0, shard) for shard in range(num_shards)]
+  assignment = [0] * len(costs)
+  for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+    load, n_items, shard = heapq.heappop(loads)
+    assignment[i] = shard
+    heapq.heappush(loads, (load + costs[i], n_items + 1, shard))
+  return assignment
+
+
+class ReadCountEstimator(object):
+  """Estimates the number of reads in regions from the BAM indices.
+
+  The reads in each _READ_COUNT_TILE_SIZE tile of the genome are estimated once
+  from the index of every reads file, and the estimate for a region is the sum
+  of the estimates of the tiles it overlaps, prorated by the overlap.
+  """
+
+  def __init__(self, sam_readers, tile_size=_READ_COUNT_TILE_SIZE):
+    """Creates a ReadCountEstimator.
+
+    Args:
+      sam_readers: list of sam.SamReader objects supporting estimate_num_reads.
+      tile_size: int > 0. The resolution of the estimates, in basepairs.
+    """
+    self._sam_readers = sam_readers
+    self._tile_size = tile_size
+    # Regions are mostly estimated in genomic order, so only the most recently
+    # used tiles are kept.
+    self._tile_reads = collections.OrderedDict()
+
+  def _reads_in_tile(self, reference_name, tile):
+    key = (reference_name, tile)
+    if key in self._tile_reads:
+      self._tile_reads.move_to_end(key)
+    else:
+      tile_range = ranges.make_range(reference_name, tile * self._tile_size,
+                                     (tile + 1) * self._tile_size)
+      self._tile_reads[key] = sum(
+          reader.estimate_num_reads(tile_range)
+          for reader in self._sam_readers)
+      if len(self._tile_reads) > _READ_COUNT_CACHED_TILES:
+        self._tile_reads.popitem(last=False)
+    return self._tile_reads[key]
+
+  def estimate(self, region):
+    """Returns the estimated number of reads in region, as a float.
+
+    The estimate is 0 only if no reads file has reads near region.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to estimate.
+    """
+    estimate = 0.0
+    first_tile = region.start // self._tile_size
+    last_tile = (region.end - 1) // self._tile_size
+    for tile in range(first_tile, last_tile + 1):
+      overlap = (
+          min(region.end, (tile + 1) * self._tile_size) -
+          max(region.start, tile * self._tile_size))
+      estimate += (
+          self._reads_in_tile(region.reference_name, tile) * overlap /
+          self._tile_size)
+    return estimate
+
+  def has_reads(self, region):
+    """Returns False if the indices show no reads overlapping region.
+
+    Unlike estimate, this queries the indices for region itself, so it is only
+    limited by the resolution of the index bins.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to check.
+    """
+    return any(
+        reader.estimate_num_reads(region) for reader in self._sam_readers)
+
+
+def make_read_count_estimator(options, sam_readers):
+  """Creates a ReadCountEstimator for options.reads_filenames.
+
+  Args:
+    options: deepvariant.DeepVariantOptions proto.
+    sam_readers: list of sam.SamReader objects for options.reads_filenames.
+      They must stay open as long as the estimator is used.
+
+  Returns:
+    A ReadCountEstimator, or None if any reads file can't be estimated from
+    its index (e.g. it is a CRAM or has no .bai).
+  """
+  for reads_filename, reader in zip(options.reads_filenames, sam_readers):
+    try:
+      reader.estimate_num_reads(
+          ranges.make_range(reader.header.contigs[0].name, 0, 1))
+    except (ValueError, IndexError) as e:
+      logging.warning('Cannot estimate read counts of %s from its index: %s',
+                      reads_filename, e)
+      return None
+  return ReadCountEstimator(sam_readers)
+
+
+def adaptive_partition(partitions, read_count_estimator, read_budget,
+                       max_partition_size):
+  """Evens out the estimated number of reads in each partition.
+
+  A partition with more than read_budget estimated reads is split into equal
+  pieces of about read_budget reads, but no smaller than
+  _MIN_ADAPTIVE_PARTITION_SIZE bases. Consecutive abutting partitions on a
+  contig are coalesced while their total estimated reads stay within
+  read_budget and their total length within max_partition_size. The returned
+  partitions cover exactly the same bases as partitions, in the same order.
+
+  Args:
+    partitions: iterable of nucleus.genomics.v1.Range protos in genomic order,
+      e.g. from RangeSet.partition.
+    read_count_estimator: ReadCountEstimator or an object with an equivalent
+      estimate(region) method.
+    read_budget: int > 0. The target maximum number of reads per partition.
+    max_partition_size: int > 0. The maximum length of a coalesced partition.
+
+  Yields:
+    nucleus.genomics.v1.Range protos.
+  """
+  pending = None
+  pending_reads = 0.0
+  for partition in partitions:
+    n_reads = read_count_estimator.estimate(partition)
+    if n_reads > read_budget:
+      if pending is not None:
+        yield pending
+        pending = None
+      n_pieces = min(
+          int(np.ceil(n_reads / read_budget)),
+          max(ranges.length(partition) // _MIN_ADAPTIVE_PARTITION_SIZE, 1))
+      piece_size = int(np.ceil(ranges.length(partition) / n_pieces))
+      for start in range(partition.start, partition.end, piece_size):
+        yield ranges.make_range(partition.reference_name, start,
+                                min(start + piece_size, partition.end))
+    elif (pending is not None and
+          pending.reference_name == partition.reference_name and
+          pending.end == partition.start and
+          pending_reads + n_reads <= read_budget and
+          partition.end - pending.start <= max_partition_size):
+      pending.end = partition.end
+      pending_reads += n_reads
+    else:
+      if pending is not None:
+        yield pending
+      pending = ranges.make_range(partition.reference_name, partition.start,
+                                  partition.end)
+      pending_reads = n_reads
+  if pending is not None:
+    yield pending
+
+
 def regions_to_process(contigs,
                        partition_size,
                        calling_regions=None,
                        task_id=None,
-                       num_shards=None):
+                       num_shards=None,
+                       region_costs=None,
+                       read_count_estimator=None,
+                       partition_read_budget=0,
+                       max_adaptive_partition_size=None,
+                       skip_empty_partitions=False):
   """Determines the regions to process and partitions them into pieces.
 
   This function divides the genomes into regions we should process by
@@ -1111,6 +1595,20 @@ def regions_to_process(contigs,
     num_shards: int >= 0 or None. The number of shards (i.e., the total number
       of tasks) we are running in parallel. Together with task_id determines the
       subset of regions we want to process.
+    region_costs: None or a dict returned by read_region_costs. If provided,
+      regions are assigned to shards to balance their estimated cost instead of
+      round-robin. The regions of each shard are still in genomic order.
+    read_count_estimator: None or a ReadCountEstimator. If provided together
+      with partition_read_budget > 0, the partitions are resized with
+      adaptive_partition before being assigned to shards.
+    partition_read_budget: int >= 0. The target maximum number of reads per
+      partition for adaptive_partition.
+    max_adaptive_partition_size: None or int. The maximum length of partitions
+      coalesced by adaptive_partition. Defaults to partition_size.
+    skip_empty_partitions: bool. If True and read_count_estimator is
+      provided, partitions without reads in the index are dropped after being
+      assigned to shards, so each shard gets the same partitions as without
+      skipping and only checks its own.
 
   Returns:
     An iterable of nucleus.genomics.v1.Range objects.
@@ -1132,11 +1630,25 @@ def regions_to_process(contigs,
   if calling_regions:
     regions = regions.intersection(calling_regions)
   partitioned = regions.partition(partition_size)
-
-  if num_shards:
-    return (r for i, r in enumerate(partitioned) if i % num_shards == task_id)
-  else:
-    return partitioned
+  if read_count_estimator is not None and partition_read_budget > 0:
+    partitioned = adaptive_partition(
+        partitioned, read_count_estimator, partition_read_budget,
+        max_adaptive_partition_size or partition_size)
+
+  if num_shards and region_costs is not None:
+    partitioned = list(partitioned)
+    assignment = _balanced_shard_assignment(
+        _estimate_region_costs(partitioned, region_costs), num_shards)
+    partitioned = (
+        r for r, shard in zip(partitioned, assignment) if shard == task_id)
+  elif num_shards:
+    partitioned = (
+        r for i, r in enumerate(partitioned) if i % num_shards == task_id)
+
+  if read_count_estimator is not None and skip_empty_partitions:
+    partitioned = (
+        r for r in partitioned if read_count_estimator.has_reads(r))
+  return partitioned
 
 
 def filter_regions_by_vcf(regions, variant_positions):
@@ -1188,6 +1700,51 @@ def filter_regions_by_vcf(regions, variant_positions):
 
   return filtered_regions
 
+
+def _vcf_has_index(vcf_reader):
+  """Returns True if the regions of vcf_reader can be looked up by index."""
+  contigs = vcf_reader.header.contigs
+  if not contigs:
+    return False
+  try:
+    vcf_reader.query(ranges.make_range(contigs[0].name, 0, 1))
+  except (ValueError, NotImplementedError):
+    return False
+  return True
+
+
+def filter_regions_by_indexed_vcf(regions, vcf_reader):
+  """Filter a list of regions to only those that contain variants.
+
+  Unlike filter_regions_by_vcf, this looks up each region in the index of the
+  VCF, so only the records around regions are read, and at most until the
+  first variant starting in each region. Regions on contigs missing from the
+  header of the VCF have no variants.
+
+  Args:
+    regions: a list of Range objects representing regions to filter on.
+    vcf_reader: a vcf.VcfReader for an indexed VCF, see _vcf_has_index.
+
+  Returns:
+    filtered_regions: a list of Range objects, each of which appeared in the
+        input regions and contains the start of at least one variant in
+        vcf_reader.
+
+  Raises:
+    ValueError: if vcf_reader has no index.
+  """
+  vcf_contigs = {contig.name for contig in vcf_reader.header.contigs}
+  filtered_regions = []
+  for region in regions:
+    if region.reference_name not in vcf_contigs:
+      continue
+    # Records are sorted by start, and any starting before region only
+    # overlaps it.
+    if any(variant.start >= region.start
+           for variant in vcf_reader.query(region)):
+      filtered_regions.append(region)
+  return filtered_regions
+
 # ---------------------------------------------------------------------------
 # Region processor
 # ---------------------------------------------------------------------------
@@ -1236,6 +1793,101 @@ def filter_candidates(candidates, select_variant_types):
         break
 
 
+class ReadPrefetcher(object):
+  """Queries the reads of upcoming regions on a background thread.
+
+  The native readers release the GIL while decoding, so the reads of the next
+  regions are decoded while the current one is realigned and encoded. Regions
+  must be consumed with get() in the order they were given. At most
+  max_regions regions are buffered, and once max_reads reads are buffered no
+  more regions are queried until some are consumed.
+  """
+
+  def __init__(self, query_fn, regions, max_regions, max_reads):
+    """Starts querying regions on a background thread.
+
+    Args:
+      query_fn: function taking a Range and returning its reads. Any exception
+        it raises is raised again by get() for that region.
+      regions: iterable of nucleus.genomics.v1.Range protos to query, in order.
+      max_regions: int > 0. The maximum number of regions buffered.
+      max_reads: int > 0. No more regions are queried while at least this many
+        reads are buffered.
+    """
+    self._query_fn = query_fn
+    self._max_regions = max_regions
+    self._max_reads = max_reads
+    # (region, reads, exception) for each queried region not yet consumed.
+    self._buffer = collections.deque()
+    self._buffered_reads = 0
+    self._done = False
+    self._closed = False
+    self._condition = threading.Condition()
+    self._thread = threading.Thread(target=self._run, args=(iter(regions),))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _has_room(self):
+    return (len(self._buffer) < self._max_regions and
+            self._buffered_reads < self._max_reads)
+
+  def _run(self, regions):
+    for region in regions:
+      with self._condition:
+        self._condition.wait_for(lambda: self._closed or self._has_room())
+        if self._closed:
+          break
+      reads, error = None, None
+      try:
+        reads = self._query_fn(region)
+      except Exception as e:  # pylint: disable=broad-except
+        error = e
+      with self._condition:
+        self._buffer.append((region, reads, error))
+        self._buffered_reads += len(reads or [])
+        self._condition.notify_all()
+      if error is not None:
+        break
+    with self._condition:
+      self._done = True
+      self._condition.notify_all()
+
+  def get(self, region):
+    """Returns the reads of region, waiting for them to be queried if needed.
+
+    Args:
+      region: nucleus.genomics.v1.Range. Must be the next region given to the
+        constructor that has not been consumed yet.
+
+    Returns:
+      What query_fn returned for region.
+
+    Raises:
+      ValueError: if region isn't the next region to consume.
+    """
+    with self._condition:
+      self._condition.wait_for(lambda: self._buffer or self._done)
+      if not self._buffer:
+        raise ValueError('No more prefetched regions, expected {}'.format(
+            ranges.to_literal(region)))
+      prefetched_region, reads, error = self._buffer.popleft()
+      self._buffered_reads -= len(reads or [])
+      self._condition.notify_all()
+    if error is not None:
+      raise error
+    if prefetched_region != region:
+      raise ValueError('Expected prefetched region {} but got {}'.format(
+          ranges.to_literal(region), ranges.to_literal(prefetched_region)))
+    return reads
+
+  def close(self):
+    """Stops querying regions and waits for the background thread to end."""
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+    self._thread.join()
+
+
 class RegionProcessor(object):
   """Creates DeepVariant example protos for a single region on the genome.
 
@@ -1267,7 +1919,20 @@ class RegionProcessor(object):
     self.options = options
     self.initialized = False
     self.ref_reader = None
+    # Caches the reference around the region being processed. Set to
+    # ref_reader by _initialize().
+    self.region_reference_cache = None
     self.sam_readers = None
+    # ReadCountEstimator for sam_readers if skip_empty_partitions is set and
+    # all reads files support it, otherwise None.
+    self.read_count_estimator = None
+    # ReadPrefetcher querying sam_readers ahead of process, see
+    # start_prefetching.
+    self.read_prefetcher = None
+    # (region, list of the reads of each of sam_readers) from the last call to
+    # query_reads, used to reuse the reads spanning into the next region. None
+    # if reuse_boundary_reads is off.
+    self.boundary_reads = None
     self.in_memory_sam_reader = None
     self.realigner = None
     self.pic = None
@@ -1275,6 +1940,33 @@ class RegionProcessor(object):
     self.variant_caller = None
     self.samples = []
     self.population_vcf_readers = None
+    # PopulationVariantIndex for each population VcfReader, created lazily.
+    self.population_variant_indices = {}
+    # AlleleCounter shared between the realigner and candidate calling for the
+    # region being processed, see share_allele_counter_with_realigner.
+    self.region_allele_counter = None
+    # Wall time and item counts of each stage for the region being processed.
+    self.stage_timer = resources.StageTimer()
+    # RegionMetrics of the last region processed.
+    self.region_metrics = None
+    # Sum of the LabelingMetrics of the regions processed by worker processes,
+    # see process_regions. None if no worker returned labeling metrics.
+    self.worker_labeling_metrics = None
+
+  @property
+  def labeling_metrics(self):
+    """Returns the LabelingMetrics of the regions processed so far.
+
+    Returns:
+      The LabelingMetrics added up from worker processes if there are any,
+      otherwise those of our labeler. None if the labeler does not collect
+      metrics or no region has been labeled yet.
+    """
+    if self.worker_labeling_metrics is not None:
+      return self.worker_labeling_metrics
+    if self.labeler is None:
+      return None
+    return self.labeler.metrics
 
   def _make_allele_counter_for_region(self, region):
     return allelecounter.AlleleCounter(self.ref_reader.c_reader, region,
@@ -1349,14 +2041,28 @@ class RegionProcessor(object):
 
     return population_vcf_readers
 
+  def _population_variant_index(self, population_vcf_reader):
+    """Returns the PopulationVariantIndex for population_vcf_reader."""
+    if population_vcf_reader not in self.population_variant_indices:
+      self.population_variant_indices[population_vcf_reader] = (
+          PopulationVariantIndex(population_vcf_reader))
+    return self.population_variant_indices[population_vcf_reader]
+
   def _initialize(self):
     """Initialize the resources needed for this work in the current env."""
     if self.initialized:
       raise ValueError('Cannot initialize this object twice')
 
-    self.ref_reader = fasta.IndexedFastaReader(self.options.reference_filename)
+    # The pileup image creators, the realigner and the labeler all query the
+    # reference around the region being processed, which we fetch only once.
+    self.region_reference_cache = make_examples_utils.RegionReferenceCache(
+        fasta.IndexedFastaReader(self.options.reference_filename))
+    self.ref_reader = self.region_reference_cache
 
     self.sam_readers = self._make_sam_readers()
+    if self.options.skip_empty_partitions:
+      self.read_count_estimator = make_read_count_estimator(
+          self.options, self.sam_readers)
     self.in_memory_sam_reader = sam.InMemorySamReader([])
 
     if self.options.use_allele_frequency:
@@ -1447,27 +2153,36 @@ class RegionProcessor(object):
     else:
       raise ValueError('Unexpected variant_caller', self.options.variant_caller)
 
-  def process(self, region):
+  def process(self, region, stream_examples=False):
     """Finds candidates and creates corresponding examples in a region.
 
     Args:
       region: A nucleus.genomics.v1.Range proto. Specifies the region on the
         genome we should process.
+      stream_examples: bool. If True, the examples are returned as a generator
+        that creates them as they are consumed, so that only a few of them are
+        in memory at a time. The generator must be exhausted before process is
+        called again, and self.region_metrics is only complete once it is.
 
     Returns:
       Three values. First is a list of the found candidates, which are
-      deepvariant.DeepVariantCall objects. The second value is a list of filled
-      in tf.Example protos. For example, these will include the candidate
-      variant, the pileup image, and, if in training mode, the truth variants
-      and labels needed for training. The third value is a list of
-      nucleus.genomics.v1.Variant protos containing gVCF information for all
-      reference sites, if gvcf generation is enabled, otherwise returns [].
+      deepvariant.DeepVariantCall objects. The second value is a list (or a
+      generator, see stream_examples) of filled in tf.Example protos. For
+      example, these will include the candidate variant, the pileup image, and,
+      if in training mode, the truth variants and labels needed for training.
+      The third value is a list of nucleus.genomics.v1.Variant protos containing
+      gVCF information for all reference sites, if gvcf generation is enabled,
+      otherwise returns []. The time spent in each stage is left in
+      self.region_metrics.
     """
     region_timer = timer.TimerStart()
+    self.stage_timer = resources.StageTimer()
 
     # Print some basic information about what we are doing.
     if not self.initialized:
       self._initialize()
+    if self.region_reference_cache is not None:
+      self.region_reference_cache.load(region)
 
     self.in_memory_sam_reader.replace_reads(self.region_reads(region))
     candidates, gvcfs = self.candidates_in_region(region)
@@ -1487,46 +2202,135 @@ class RegionProcessor(object):
       else:
         population_vcf_reader = self.population_vcf_readers.get(
             region.reference_name, None)
-      candidates = list(
-          self.add_allele_frequencies_to_candidates(candidates,
-                                                    population_vcf_reader))
+      with self.stage_timer.time('annotate_allele_frequencies'):
+        if population_vcf_reader:
+          # Read the population records for all candidates in one pass instead
+          # of querying the VCF once per candidate.
+          population_vcf_reader = self._population_variant_index(
+              population_vcf_reader).load(c.variant for c in candidates)
+        candidates = list(
+            self.add_allele_frequencies_to_candidates(candidates,
+                                                      population_vcf_reader))
+      self.stage_timer.add('annotate_allele_frequencies', count=len(candidates))
 
     # pylint: disable=g-complex-comprehension
     if in_training_mode(self.options):
-      examples = [
+      with self.stage_timer.time('label'):
+        labeled_candidates = list(self.label_candidates(candidates, region))
+      self.stage_timer.add('label', count=len(labeled_candidates))
+      examples = (
           self.add_label_to_example(example, label)
-          for candidate, label in self.label_candidates(candidates, region)
-          for example in self.create_pileup_examples(candidate)
-      ]
+          for candidate, label in labeled_candidates
+          for example in self.create_pileup_examples(candidate))
     else:
-      examples = [
+      examples = (
           example for candidate in candidates
-          for example in self.create_pileup_examples(candidate)
-      ]
+          for example in self.create_pileup_examples(candidate))
     # pylint: enable=g-complex-comprehension
-    logging.vlog(2, 'Found %s candidates in %s [%d bp] [%0.2fs elapsed]',
-                 len(examples), ranges.to_literal(region),
-                 ranges.length(region), region_timer.Stop())
+    self.region_metrics = deepvariant_pb2.RegionMetrics(region=region)
+    examples = self._encode_examples(examples, self.region_metrics,
+                                     region_timer.Stop())
+    if not stream_examples:
+      examples = list(examples)
     return candidates, examples, gvcfs
 
-  def region_reads(self, region):
-    """Update in_memory_sam_reader with read alignments overlapping the region.
+  def _encode_examples(self, examples, region_metrics, elapsed):
+    """Yields examples, then fills in region_metrics once all are created.
 
-    If self.options.realigner_enabled is set, uses realigned reads, otherwise
-    original reads are returned.
+    Args:
+      examples: iterable of tf.Example protos, created as they are iterated.
+      region_metrics: RegionMetrics proto of the region of examples.
+      elapsed: float. The seconds spent on the region before creating examples.
+
+    Yields:
+      The tf.Example protos of examples.
+    """
+    stage_timer = self.stage_timer
+    n_examples = 0
+    examples = iter(examples)
+    while True:
+      start = time.time()
+      example = next(examples, None)
+      encode_seconds = time.time() - start
+      stage_timer.add('encode_pileups', wall_time_seconds=encode_seconds)
+      elapsed += encode_seconds
+      if example is None:
+        break
+      n_examples += 1
+      yield example
+    stage_timer.add('encode_pileups', count=n_examples)
+    # The time spent by the consumer between examples is not the region's.
+    region_metrics.wall_time_seconds = elapsed
+    region_metrics.stages.extend(stage_timer.metrics())
+    logging.vlog(2, 'Found %s candidates in %s [%d bp] [%0.2fs elapsed]',
+                 n_examples, ranges.to_literal(region_metrics.region),
+                 ranges.length(region_metrics.region), elapsed)
+
+  def start_prefetching(self, regions):
+    """Queries the reads of regions ahead of processing them, if enabled.
+
+    If options.prefetch_regions > 0, the reads of the next prefetch_regions
+    regions are queried on a background thread while the current one is
+    processed. process must then be called on exactly these regions in order,
+    until stop_prefetching is called.
+
+    Args:
+      regions: list of nucleus.genomics.v1.Range protos to be processed.
+    """
+    if self.options.prefetch_regions <= 0:
+      return
+    if not self.initialized:
+      self._initialize()
+    self.read_prefetcher = ReadPrefetcher(
+        self.query_reads,
+        regions,
+        max_regions=self.options.prefetch_regions,
+        max_reads=self.options.prefetch_max_reads or float('inf'))
+
+  def stop_prefetching(self):
+    """Stops the ReadPrefetcher started by start_prefetching, if any."""
+    if self.read_prefetcher is not None:
+      self.read_prefetcher.close()
+      self.read_prefetcher = None
+
+  def query_reads(self, region):
+    """Returns the reads overlapping region from all of self.sam_readers.
+
+    This only touches the readers, so it can run on the background thread of
+    a ReadPrefetcher.
 
     Args:
       region: A nucleus.genomics.v1.Range object specifying the region we want
-        to realign reads.
+        to query reads for.
 
     Returns:
-      [genomics.deepvariant.core.genomics.Read], reads overlapping the region.
+      A list of the reads overlapping region, or None if the index shows there
+      are none (see skip_empty_partitions).
     """
+    if (self.read_count_estimator is not None and
+        not self.read_count_estimator.has_reads(region)):
+      self._update_boundary_reads(region, [[] for _ in self.sam_readers])
+      return None
     reads = []
     if self.sam_readers is not None:
+      sample_natively = self._sample_reads_natively(region)
+      reads_by_reader = []
       for sam_reader_index, sam_reader in enumerate(self.sam_readers):
         try:
-          reads.extend(sam_reader.query(region))
+          carried_reads = self._carried_boundary_reads(sam_reader_index, region)
+          if sample_natively:
+            reader_reads = list(
+                sam_reader.query(
+                    region,
+                    max_reads=self.options.max_reads_per_partition,
+                    random_seed=self.options.random_seed))
+          elif carried_reads is None:
+            reader_reads = list(sam_reader.query(region))
+          else:
+            reader_reads = carried_reads + list(
+                sam_reader.query_starting_at(region, region.start))
+          reads_by_reader.append(reader_reads)
+          reads.extend(reader_reads)
         except ValueError as err:
           error_message = str(err)
           if error_message.startswith('Data loss:'):
@@ -1550,14 +2354,110 @@ class RegionProcessor(object):
           else:
             # By default, raise the ValueError as is for now.
             raise err
+      if sample_natively:
+        # The reads spanning into the next region may not have been sampled.
+        self.boundary_reads = None
+      else:
+        self._update_boundary_reads(region, reads_by_reader)
+    return reads
+
+  def _sample_reads_natively(self, region):
+    """Returns True if the reads of region should be sampled by the reader.
+
+    The reader then keeps only max_reads_per_partition reads while decoding,
+    exactly those that reservoir sampling in region_reads would keep, so this
+    only saves time and memory. It is used only with a single reads file, as
+    region_reads samples the reads of all files together, and only for regions
+    expected to have more reads than that, as it precludes reusing the reads
+    spanning into the next region.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region about to be queried.
+    """
+    max_reads = self.options.max_reads_per_partition
+    if max_reads <= 0 or len(self.sam_readers) != 1:
+      return False
+    return (self.read_count_estimator is None or
+            self.read_count_estimator.estimate(region) > max_reads)
+
+  def _carried_boundary_reads(self, sam_reader_index, region):
+    """Returns the reads of the last region that start before region.
+
+    Reads are sorted by start, so the reads of region that start before it,
+    which are also in the last region if it contains region.start, followed by
+    the reads starting in region are exactly what a query of region returns.
+
+    Args:
+      sam_reader_index: int. The index of the reader in self.sam_readers.
+      region: nucleus.genomics.v1.Range. The region about to be queried.
+
+    Returns:
+      A list of reads, or None if region can't reuse the last region's reads.
+    """
+    if self.boundary_reads is None:
+      return None
+    last_region, reads_by_reader = self.boundary_reads
+    if (last_region.reference_name != region.reference_name or
+        not last_region.start <= region.start <= last_region.end):
+      return None
+    return [
+        read for read in reads_by_reader[sam_reader_index]
+        if read.alignment.position.position < region.start and
+        utils.read_end(read) > region.start
+    ]
+
+  def _update_boundary_reads(self, region, reads_by_reader):
+    # Reads are sampled per query when downsampling, so they can't be reused.
+    if (self.options.reuse_boundary_reads and
+        not self.options.downsample_fraction):
+      self.boundary_reads = (region, reads_by_reader)
+
+  def region_reads(self, region):
+    """Update in_memory_sam_reader with read alignments overlapping the region.
+
+    If self.options.realigner_enabled is set, uses realigned reads, otherwise
+    original reads are returned.
+
+    Args:
+      region: A nucleus.genomics.v1.Range object specifying the region we want
+        to realign reads.
+
+    Returns:
+      [genomics.deepvariant.core.genomics.Read], reads overlapping the region.
+    """
+    with self.stage_timer.time('query_reads'):
+      if self.read_prefetcher is not None:
+        reads = self.read_prefetcher.get(region)
+      else:
+        reads = self.query_reads(region)
+    # Without reads there is nothing to sample or realign, but the caller still
+    # emits the no-coverage gVCF records of the region.
+    if reads is None:
+      self.stage_timer.add('query_reads')
+      return []
+    self.stage_timer.add('query_reads', count=len(reads))
 
     if self.options.max_reads_per_partition > 0:
-      random_for_region = np.random.RandomState(self.options.random_seed)
-      reads = utils.reservoir_sample(reads,
-                                     self.options.max_reads_per_partition,
-                                     random_for_region)
+      with self.stage_timer.time('sample_reads'):
+        random_for_region = np.random.RandomState(self.options.random_seed)
+        reads = utils.reservoir_sample(reads,
+                                       self.options.max_reads_per_partition,
+                                       random_for_region)
     reads = list(reads)
+    self.stage_timer.add('sample_reads', count=len(reads))
     if self.options.realigner_enabled:
+      allele_counter = None
+      if self.options.share_allele_counter_with_realigner:
+        with self.stage_timer.time('count_alleles'):
+          allele_counter = self._make_allele_counter_for_region(
+              window_selector.allele_counting_region(
+                  self.options.realigner_options.ws_config, self.ref_reader,
+                  region))
+          for read in reads:
+            allele_counter.add(read,
+                               self.options.variant_caller_options.sample_name)
+        self.stage_timer.add('count_alleles', count=len(reads))
+
       max_read_length_to_realign = 500
       if max_read_length_to_realign > 0:
         long_reads = [
@@ -1571,15 +2471,56 @@ class RegionProcessor(object):
         ]
 
         _, realigned_short_reads = self.realigner.realign_reads(
-            short_reads, region)
+            short_reads,
+            region,
+            allele_counter=allele_counter,
+            stage_timer=self.stage_timer)
+        with self.stage_timer.time('count_alleles'):
+          self._update_region_allele_counter(allele_counter, short_reads,
+                                             realigned_short_reads)
 
         # Long reads will be listed before short reads when both are present.
         # Examples with only short or only long reads will be unaffected.
         return long_reads + realigned_short_reads
 
-      _, reads = self.realigner.realign_reads(reads, region)
+      _, realigned_reads = self.realigner.realign_reads(
+          reads,
+          region,
+          allele_counter=allele_counter,
+          stage_timer=self.stage_timer)
+      with self.stage_timer.time('count_alleles'):
+        self._update_region_allele_counter(allele_counter, reads,
+                                           realigned_reads)
+      return realigned_reads
     return reads
 
+  def _update_region_allele_counter(self, allele_counter, reads,
+                                    realigned_reads):
+    """Updates allele_counter for reads changed by realignment and keeps it.
+
+    The realigner returns the reads it did not realign as the same objects, so
+    only reads missing from realigned_reads are removed from the counts and
+    only new reads in realigned_reads are added.
+
+    Args:
+      allele_counter: AlleleCounter holding the counts of reads, or None if
+        the allele counter isn't shared with the realigner.
+      reads: list of reads passed to the realigner.
+      realigned_reads: list of reads returned by the realigner.
+    """
+    self.region_allele_counter = allele_counter
+    if allele_counter is None:
+      return
+    sample_name = self.options.variant_caller_options.sample_name
+    original_ids = set(id(read) for read in reads)
+    realigned_ids = set(id(read) for read in realigned_reads)
+    for read in reads:
+      if id(read) not in realigned_ids:
+        allele_counter.remove(read, sample_name)
+    for read in realigned_reads:
+      if id(read) not in original_ids:
+        allele_counter.add(read, sample_name)
+
   def candidates_in_region(self, region):
     """Finds candidate DeepVariantCall protos in region.
 
@@ -1593,18 +2534,38 @@ class RegionProcessor(object):
       nucleus.genomics.v1.Variant protos containing gVCF information for all
       reference sites, if gvcf generation is enabled, otherwise returns [].
     """
-    reads = self.in_memory_sam_reader.query(region)
+    # Take ownership of the counter shared with the realigner, if any, so it is
+    # never reused for another region.
+    shared_allele_counter = self.region_allele_counter
+    self.region_allele_counter = None
+
+    reads = list(self.in_memory_sam_reader.query(region))
     if not reads and not gvcf_output_enabled(self.options):
       # If we are generating gVCF output we cannot safely abort early here as
       # we need to return the gVCF records calculated by the caller below.
       return [], []
 
-    allele_counter = self._make_allele_counter_for_region(region)
-    for read in reads:
-      allele_counter.add(read, self.options.variant_caller_options.sample_name)
-
-    candidates, gvcfs = self.variant_caller.calls_and_gvcfs(
-        allele_counter, gvcf_output_enabled(self.options))
+    if shared_allele_counter is not None:
+      # The shared counter spans more than region, so restrict its calls.
+      with self.stage_timer.time('call_candidates'):
+        candidates, gvcfs = self.variant_caller.calls_and_gvcfs(
+            shared_allele_counter,
+            gvcf_output_enabled(self.options),
+            region=region)
+      self.stage_timer.add('call_candidates', count=len(candidates))
+      return candidates, gvcfs
+
+    with self.stage_timer.time('count_alleles'):
+      allele_counter = self._make_allele_counter_for_region(region)
+      for read in reads:
+        allele_counter.add(read,
+                           self.options.variant_caller_options.sample_name)
+    self.stage_timer.add('count_alleles', count=len(reads))
+
+    with self.stage_timer.time('call_candidates'):
+      candidates, gvcfs = self.variant_caller.calls_and_gvcfs(
+          allele_counter, gvcf_output_enabled(self.options))
+    self.stage_timer.add('call_candidates', count=len(candidates))
     return candidates, gvcfs
 
   def align_to_all_haplotypes(self, variant, reads):
@@ -1650,9 +2611,6 @@ class RegionProcessor(object):
         self.realigner.ref_reader.contig(contig).n_bases, ref_end + margin)
     alignment_region = ranges.make_range(contig, max(ref_start - margin, 0),
                                          valid_end)
-    trimmed_reads = [realigner.trim_read(r, alignment_region) for r in reads]
-    # Filter reads to a minimum read length of 15 bp after trimming.
-    reads = [r for r in trimmed_reads if len(r.aligned_sequence) >= 15]
     prefix = self.realigner.ref_reader.query(
         ranges.make_range(contig, max(ref_start - margin, 0), ref_start))
     suffix = self.realigner.ref_reader.query(
@@ -1669,7 +2627,10 @@ class RegionProcessor(object):
           suffix=suffix,
           reads=reads,
           contig=contig,
-          ref_start=ref_start - len(prefix))
+          ref_start=ref_start - len(prefix),
+          # Reads are trimmed to the alignment region by the aligner.
+          trim_region=alignment_region,
+          min_read_length=_MIN_TRIMMED_READ_LENGTH)
       # Sequence of the alt haplotype in the window:
       end_of_prefix = prefix[-window_half_width:]
       beginning_of_suffix = suffix[:max(window_half_width + 1 - len(hap), 0)]
@@ -1883,14 +2844,41 @@ def processing_regions_from_options(options):
                      'resulting in set of empty region to process. This also '
                      'happens if you use "chr20" for a BAM where contig names '
                      'don\'t have "chr"s (or vice versa).')
-  regions = regions_to_process(
-      contigs=contigs,
-      partition_size=options.allele_counter_options.partition_size,
-      calling_regions=calling_regions,
-      task_id=options.task_id,
-      num_shards=options.num_shards)
-
-  region_list = list(regions)
+  region_costs = None
+  if options.region_costs_filename:
+    region_costs = read_region_costs(options.region_costs_filename)
+  # Partitions without reads produce no output, except no-coverage gVCF
+  # records and labeling metrics, so those are skipped later in RegionProcessor.
+  skip_empty_partitions = (
+      options.skip_empty_partitions and not gvcf_output_enabled(options) and
+      not in_training_mode(options))
+  partition_read_budget = options.partition_read_budget
+  if partition_read_budget > 0:
+    # Larger partitions would lose reads to max_reads_per_partition sampling.
+    if options.max_reads_per_partition > 0:
+      partition_read_budget = min(partition_read_budget,
+                                  options.max_reads_per_partition)
+  # The readers of the estimator are closed once the regions are computed.
+  with contextlib.ExitStack() as estimator_readers:
+    read_count_estimator = None
+    if partition_read_budget > 0 or skip_empty_partitions:
+      read_count_estimator = make_read_count_estimator(options, [
+          estimator_readers.enter_context(sam.SamReader(reads_filename))
+          for reads_filename in options.reads_filenames
+      ])
+    region_list = list(
+        regions_to_process(
+            contigs=contigs,
+            partition_size=options.allele_counter_options.partition_size,
+            calling_regions=calling_regions,
+            task_id=options.task_id,
+            num_shards=options.num_shards,
+            region_costs=region_costs,
+            read_count_estimator=read_count_estimator,
+            partition_read_budget=partition_read_budget,
+            max_adaptive_partition_size=options.max_adaptive_partition_size,
+            skip_empty_partitions=skip_empty_partitions))
+
   # When processing many regions, check for a VCF to narrow down the regions.
   if not gvcf_output_enabled(options) and len(region_list) > 10000:
     if in_training_mode(options):
@@ -1906,12 +2894,20 @@ def processing_regions_from_options(options):
             'variants in the --proposed_variants VCF.')
     if filter_vcf:
       before = time.time()
-      variant_positions = []
       with vcf.VcfReader(filter_vcf) as vcf_reader:
-        for variant in vcf_reader:
-          variant_positions.append(variant_utils.variant_position(variant))
-
-      filtered_regions = filter_regions_by_vcf(region_list, variant_positions)
+        use_index = _vcf_has_index(vcf_reader)
+        if use_index:
+          filtered_regions = filter_regions_by_indexed_vcf(
+              region_list, vcf_reader)
+      if not use_index:
+        # Without an index we have to read the whole VCF.
+        with vcf.VcfReader(filter_vcf) as vcf_reader:
+          variant_positions = [
+              variant_utils.variant_position(variant)
+              for variant in vcf_reader
+          ]
+        filtered_regions = filter_regions_by_vcf(region_list,
+                                                 variant_positions)
       time_elapsed = time.time() - before
       logging_with_options(
           options,
@@ -1932,13 +2928,21 @@ class OutputsWriter(object):
 
     if options.candidates_filename:
       self._add_writer('candidates',
-                       tfrecord.Writer(options.candidates_filename))
+                       self._make_writer(options, options.candidates_filename))
 
     if options.examples_filename:
-      self._add_writer('examples', tfrecord.Writer(options.examples_filename))
+      self._add_writer('examples',
+                       self._make_writer(options, options.examples_filename))
 
     if options.gvcf_filename:
-      self._add_writer('gvcfs', tfrecord.Writer(options.gvcf_filename))
+      self._add_writer('gvcfs',
+                       self._make_writer(options, options.gvcf_filename))
+
+  def _make_writer(self, options, path):
+    return make_examples_utils.make_tfrecord_writer(
+        path,
+        compression_threads=options.output_compression_threads,
+        compression_level=options.output_compression_level)
 
   def write_examples(self, *examples):
     self._write('examples', *examples)
@@ -1977,6 +2981,194 @@ class OutputsWriter(object):
         writer.write(proto)
 
 
+# The RegionProcessor used by each worker process of process_regions. It is
+# inherited through fork and initialized lazily inside every worker.
+_worker_region_processor = None
+
+
+def _init_region_worker(region_processor):
+  global _worker_region_processor
+  _worker_region_processor = region_processor
+
+
+def _add_labeling_metrics(total, metrics, scale=1):
+  """Adds scale times each count of LabelingMetrics metrics to total."""
+  for field, value in metrics.ListFields():
+    setattr(total, field.name, getattr(total, field.name) + scale * value)
+
+
+def _copy_labeling_metrics(metrics):
+  if metrics is None:
+    return None
+  copied = deepvariant_pb2.LabelingMetrics()
+  copied.CopyFrom(metrics)
+  return copied
+
+
+def _process_region_in_worker(region):
+  """Returns the outputs, RegionMetrics and LabelingMetrics of region.
+
+  The LabelingMetrics are what labeling region added to those of the worker,
+  so the parent process can add up the metrics of all workers. They are None
+  if the labeler does not collect metrics.
+  """
+  labeling_metrics_before = _copy_labeling_metrics(
+      _worker_region_processor.labeling_metrics)
+  result = _worker_region_processor.process(region)
+  labeling_metrics = _copy_labeling_metrics(
+      _worker_region_processor.labeling_metrics)
+  if labeling_metrics is not None and labeling_metrics_before is not None:
+    _add_labeling_metrics(labeling_metrics, labeling_metrics_before, scale=-1)
+  return result, _worker_region_processor.region_metrics, labeling_metrics
+
+
+def process_regions(region_processor,
+                    regions,
+                    num_workers=1,
+                    stream_examples=False):
+  """Yields the output of region_processor.process for each region in order.
+
+  When num_workers > 1, regions are processed by a pool of forked worker
+  processes, each with its own lazily initialized copy of region_processor
+  (see RegionProcessor docs), while the results are still yielded in the order
+  of regions so that a single writer can emit them in genomic order. The
+  labeling metrics of the workers are then added up into
+  region_processor.worker_labeling_metrics.
+
+  Args:
+    region_processor: RegionProcessor. Must not be initialized yet if
+      num_workers > 1, as readers cannot be shared across processes.
+    regions: Iterable of nucleus.genomics.v1.Range protos to process.
+    num_workers: int. The number of worker processes to use.
+    stream_examples: bool. If True and num_workers <= 1, the examples of each
+      region are a generator, see RegionProcessor.process. It must be
+      exhausted before the next region is requested, and only then is the
+      region_metrics of the region complete. Worker processes always return
+      lists, which have to be sent back whole.
+
+  Yields:
+    A (result, region_metrics) pair for each region in regions, where result
+    is the (candidates, examples, gvcfs) tuple from RegionProcessor.process and
+    region_metrics is the RegionMetrics proto for the region.
+
+  Raises:
+    ValueError: if num_workers > 1 and region_processor is initialized.
+  """
+  if num_workers <= 1:
+    regions = list(regions)
+    region_processor.start_prefetching(regions)
+    try:
+      for region in regions:
+        result = region_processor.process(
+            region, stream_examples=stream_examples)
+        yield result, region_processor.region_metrics
+    finally:
+      region_processor.stop_prefetching()
+    return
+
+  if region_processor.initialized:
+    raise ValueError('region_processor must not be initialized before it is '
+                     'shared with worker processes.')
+  pool = multiprocessing.get_context('fork').Pool(
+      num_workers,
+      initializer=_init_region_worker,
+      initargs=(region_processor,))
+  try:
+    for result, region_metrics, labeling_metrics in pool.imap(
+        _process_region_in_worker, regions):
+      if labeling_metrics is not None:
+        if region_processor.worker_labeling_metrics is None:
+          region_processor.worker_labeling_metrics = (
+              deepvariant_pb2.LabelingMetrics())
+        _add_labeling_metrics(region_processor.worker_labeling_metrics,
+                              labeling_metrics)
+      yield result, region_metrics
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def _batches(iterable, batch_size):
+  """Yields lists of up to batch_size consecutive elements of iterable.
+
+  Args:
+    iterable: The iterable to split into batches.
+    batch_size: int. The maximum length of a batch. If <= 0, all elements are
+      yielded as a single batch.
+
+  Yields:
+    Non-empty lists of elements of iterable, in order.
+  """
+  if batch_size <= 0:
+    batch = list(iterable)
+    if batch:
+      yield batch
+    return
+  iterator = iter(iterable)
+  while True:
+    batch = list(itertools.islice(iterator, batch_size))
+    if not batch:
+      return
+    yield batch
+
+
+class RegionMetricsWriter(object):
+  """Collects the RegionMetrics of all regions processed by make_examples.
+
+  Keeps the per-stage totals and the slowest regions for the
+  MakeExamplesRunInfo, and optionally writes every region as a line of a TSV
+  file.
+  """
+
+  def __init__(self, runtime_by_region_filename=None):
+    self.stage_totals = resources.StageTimer()
+    # Min-heap of (wall_time_seconds, index, RegionMetrics).
+    self._slowest = []
+    self._n_regions = 0
+    self._tsv = None
+    if runtime_by_region_filename:
+      self._tsv = tf.io.gfile.GFile(runtime_by_region_filename, 'w')
+      header = ['region', 'wall_time_seconds']
+      for stage in _REGION_STAGES:
+        header.extend([stage + '_seconds', stage + '_count'])
+      self._tsv.write('\t'.join(header) + '\n')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+  def close(self):
+    if self._tsv is not None:
+      self._tsv.close()
+      self._tsv = None
+
+  def add(self, region_metrics):
+    """Records the RegionMetrics proto of one region."""
+    self.stage_totals.merge(region_metrics.stages)
+    item = (region_metrics.wall_time_seconds, self._n_regions, region_metrics)
+    self._n_regions += 1
+    if len(self._slowest) < _RUN_INFO_SLOWEST_REGIONS:
+      heapq.heappush(self._slowest, item)
+    else:
+      heapq.heappushpop(self._slowest, item)
+    if self._tsv is not None:
+      stages = {m.stage: m for m in region_metrics.stages}
+      row = [
+          ranges.to_literal(region_metrics.region),
+          '%.6f' % region_metrics.wall_time_seconds
+      ]
+      for stage in _REGION_STAGES:
+        m = stages.get(stage, resources_pb2.StageMetrics())
+        row.extend(['%.6f' % m.wall_time_seconds, str(m.count)])
+      self._tsv.write('\t'.join(row) + '\n')
+
+  def slowest_regions(self):
+    """Returns the RegionMetrics of the slowest regions, slowest first."""
+    return [item[2] for item in sorted(self._slowest, reverse=True)]
+
+
 def make_examples_runner(options):
   """Runs examples creation stage of deepvariant."""
   resource_monitor = resources.ResourceMonitor().start()
@@ -1997,14 +3189,18 @@ def make_examples_runner(options):
 
   n_regions, n_candidates, n_examples = 0, 0, 0
   last_reported = 0
-  with OutputsWriter(options) as writer:
+  with OutputsWriter(options) as writer, RegionMetricsWriter(
+      options.runtime_by_region_filename) as metrics_writer:
     running_timer = timer.TimerStart()
-    for region in regions:
-      candidates, examples, gvcfs = region_processor.process(region)
+    for (candidates, examples, gvcfs), region_metrics in process_regions(
+        region_processor,
+        regions,
+        num_workers=options.n_cores,
+        stream_examples=options.max_in_flight_examples > 0):
       n_candidates += len(candidates)
-      n_examples += len(examples)
       n_regions += 1
 
+      write_timer = timer.TimerStart()
       writer.write_candidates(*candidates)
 
       # If we have any gvcf records, write them out. This if also serves to
@@ -2013,7 +3209,23 @@ def make_examples_runner(options):
       # we'll never execute the write.
       if gvcfs:
         writer.write_gvcfs(*gvcfs)
-      writer.write_examples(*examples)
+      write_seconds = write_timer.Stop()
+
+      # Streamed examples are created while they are drained here, so at most
+      # max_in_flight_examples of them are held in memory at once.
+      n_region_examples = 0
+      for batch in _batches(examples, options.max_in_flight_examples):
+        write_timer = timer.TimerStart()
+        writer.write_examples(*batch)
+        write_seconds += write_timer.Stop()
+        n_region_examples += len(batch)
+      n_examples += n_region_examples
+      region_metrics.wall_time_seconds += write_seconds
+      region_metrics.stages.add(
+          stage='write_outputs',
+          wall_time_seconds=write_seconds,
+          count=n_region_examples)
+      metrics_writer.add(region_metrics)
 
       # Output timing for every N candidates.
       # redacted
@@ -2027,10 +3239,13 @@ def make_examples_runner(options):
   # Construct and then write out our MakeExamplesRunInfo proto.
   if options.run_info_filename:
     run_info = deepvariant_pb2.MakeExamplesRunInfo(
-        options=options, resource_metrics=resource_monitor.metrics())
+        options=options,
+        resource_metrics=resource_monitor.metrics(),
+        stage_metrics=metrics_writer.stage_totals.metrics(),
+        slowest_regions=metrics_writer.slowest_regions())
     if in_training_mode(options):
-      if region_processor.labeler.metrics is not None:
-        run_info.labeling_metrics.CopyFrom(region_processor.labeler.metrics)
+      if region_processor.labeling_metrics is not None:
+        run_info.labeling_metrics.CopyFrom(region_processor.labeling_metrics)
       else:
         logging.warning(
             'Labeling metrics requested but the selected labeling '
@@ -2071,10 +3286,10 @@ def main(argv=()):
     if not options.examples_filename:
       errors.log_and_raise('examples argument is required.',
                            errors.CommandLineError)
-    if options.n_cores != 1:
+    if options.n_cores < 1:
       errors.log_and_raise(
-          'Currently only supports n_cores == 1 but got {}.'.format(
-              options.n_cores), errors.CommandLineError)
+          '--num_workers must be >= 1 but got {}.'.format(options.n_cores),
+          errors.CommandLineError)
 
     # Check for argument issues specific to different modes.
     if in_training_mode(options):
@@ -40,6 +40,7 @@ import copy
 import enum
 import errno
 import platform
+import shutil
 import sys
 
 
@@ -53,6 +54,7 @@ import six
 
 from tensorflow.python.platform import gfile
 from third_party.nucleus.io import fasta
+from third_party.nucleus.io import sam
 from third_party.nucleus.io import tfrecord
 from third_party.nucleus.io import vcf
 from third_party.nucleus.protos import reads_pb2
@@ -70,6 +72,7 @@ from deepvariant import tf_utils
 from deepvariant.labeler import variant_labeler
 from deepvariant.protos import deepvariant_pb2
 from deepvariant.protos import realigner_pb2
+from deepvariant.protos import resources_pb2
 from deepvariant.testing import flagsaver
 
 FLAGS = flags.FLAGS
@@ -170,10 +173,22 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       # golden sets version for ssw realigner.
       dict(mode='calling', num_shards=0),
       dict(mode='calling', num_shards=3),
+      # Multiple worker processes must produce the same outputs, in order.
+      dict(mode='calling', num_shards=0, num_workers=2),
+      dict(mode='calling', num_shards=3, num_workers=2),
+      # Without gVCF output, partitions without reads are skipped.
+      dict(mode='calling', num_shards=0, write_gvcf=False),
+      dict(mode='calling', num_shards=3, write_gvcf=False),
       dict(
           mode='training', num_shards=0, labeler_algorithm='haplotype_labeler'),
       dict(
           mode='training', num_shards=3, labeler_algorithm='haplotype_labeler'),
+      # Labeling metrics are added up from the worker processes.
+      dict(
+          mode='training',
+          num_shards=0,
+          labeler_algorithm='haplotype_labeler',
+          num_workers=2),
       dict(
           mode='training', num_shards=0,
           labeler_algorithm='positional_labeler'),
@@ -205,7 +220,9 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
                                  num_shards,
                                  test_condition=TestConditions.USE_BAM,
                                  labeler_algorithm=None,
-                                 use_fast_pass_aligner=True):
+                                 use_fast_pass_aligner=True,
+                                 num_workers=1,
+                                 write_gvcf=True):
     self.assertIn(mode, {'calling', 'training'})
     region = ranges.parse_literal('chr20:10,000,000-10,010,000')
     FLAGS.write_run_info = True
@@ -227,12 +244,14 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     FLAGS.mode = mode
     FLAGS.gvcf_gq_binsize = 5
     FLAGS.use_fast_pass_aligner = use_fast_pass_aligner
+    FLAGS.num_workers = num_workers
     if labeler_algorithm is not None:
       FLAGS.labeler_algorithm = labeler_algorithm
 
     if mode == 'calling':
-      FLAGS.gvcf = test_utils.test_tmpfile(
-          _sharded('gvcf.tfrecord', num_shards))
+      if write_gvcf:
+        FLAGS.gvcf = test_utils.test_tmpfile(
+            _sharded('gvcf.tfrecord', num_shards))
     else:
       FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
       FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
@@ -250,6 +269,11 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       # (b) run_info.resource_metrics is present and contains our hostname.
       self.assertTrue(run_info.HasField('resource_metrics'))
       self.assertEqual(run_info.resource_metrics.host_name, platform.node())
+      # (c) per-stage metrics were collected for the processed regions.
+      stages = {m.stage: m for m in run_info.stage_metrics}
+      self.assertIn('query_reads', stages)
+      self.assertIn('write_outputs', stages)
+      self.assertNotEmpty(run_info.slowest_regions)
 
     # Test that our candidates are reasonable, calling specific helper functions
     # to check lots of properties of the output.
@@ -285,6 +309,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       nist_variants = list(nist_reader.query(region))
       self.verify_nist_concordance(example_variants, nist_variants)
 
+    if mode == 'calling' and write_gvcf:
       # Check the quality of our generated gvcf file.
       gvcfs = variant_utils.sorted_variants(
           tfrecord.read_tfrecords(FLAGS.gvcf, proto=variants_pb2.Variant))
@@ -691,6 +716,59 @@ class MakeExamplesUnitTest(parameterized.TestCase):
         _read_lines(testdata.GOLDEN_MAKE_EXAMPLES_RUN_INFO),
         _read_lines(tmp_output))
 
+  @parameterized.parameters(
+      (0, [[1, 2, 3, 4, 5]]),
+      (2, [[1, 2], [3, 4], [5]]),
+      (5, [[1, 2, 3, 4, 5]]),
+      (10, [[1, 2, 3, 4, 5]]),
+  )
+  def test_batches(self, batch_size, expected):
+    self.assertEqual(
+        expected,
+        list(make_examples._batches(iter([1, 2, 3, 4, 5]), batch_size)))
+    self.assertEqual([], list(make_examples._batches([], batch_size)))
+
+  def test_region_metrics_writer(self):
+
+    def _region_metrics(region, seconds, n_reads):
+      return deepvariant_pb2.RegionMetrics(
+          region=ranges.parse_literal(region),
+          wall_time_seconds=seconds,
+          stages=[
+              resources_pb2.StageMetrics(
+                  stage='query_reads',
+                  wall_time_seconds=seconds,
+                  count=n_reads)
+          ])
+
+    tsv_path = test_utils.test_tmpfile('runtime_by_region.tsv')
+    with make_examples.RegionMetricsWriter(tsv_path) as metrics_writer:
+      metrics_writer.add(_region_metrics('chr20:1-1000', 1.0, 10))
+      metrics_writer.add(_region_metrics('chr20:1001-2000', 3.0, 20))
+      metrics_writer.add(_region_metrics('chr20:2001-3000', 2.0, 30))
+
+    self.assertEqual(['chr20:1001-2000', 'chr20:2001-3000', 'chr20:1-1000'], [
+        ranges.to_literal(m.region)
+        for m in metrics_writer.slowest_regions()
+    ])
+    totals = metrics_writer.stage_totals.metrics()
+    self.assertLen(totals, 1)
+    self.assertEqual(totals[0].wall_time_seconds, 6.0)
+    self.assertEqual(totals[0].count, 60)
+
+    with open(tsv_path) as f:
+      rows = [line.rstrip('\n').split('\t') for line in f]
+    self.assertLen(rows, 4)
+    self.assertEqual(rows[0][:4], [
+        'region', 'wall_time_seconds', 'query_reads_seconds',
+        'query_reads_count'
+    ])
+    self.assertEqual(rows[1][0], 'chr20:1-1000')
+    self.assertEqual(rows[1][3], '10')
+    # Stages that did not run for a region are reported as zeros.
+    self.assertEqual(rows[1][-1], '0')
+    self.assertTrue(all(len(row) == len(rows[0]) for row in rows))
+
   @parameterized.parameters(
       dict(
           flag_value='CALLING',
@@ -1123,6 +1201,135 @@ class MakeExamplesUnitTest(parameterized.TestCase):
       sharded_regions.extend(task_regions)
     six.assertCountEqual(self, unsharded_regions, sharded_regions)
 
+  @parameterized.parameters([2, 3, 7])
+  def test_regions_to_process_sharding_with_region_costs(self, num_shards):
+    contigs = _make_contigs([('z', 100), ('a', 100)])
+    # A previous run at the same partition size where z:1-10 was very slow.
+    tsv_path = test_utils.test_tmpfile(
+        'region_costs_{}.tsv'.format(num_shards))
+    with make_examples.RegionMetricsWriter(tsv_path) as metrics_writer:
+      for region in make_examples.regions_to_process(contigs, 10):
+        seconds = 100.0 if ranges.to_literal(region) == 'z:1-10' else 1.0
+        metrics_writer.add(
+            deepvariant_pb2.RegionMetrics(
+                region=region, wall_time_seconds=seconds))
+    region_costs = make_examples.read_region_costs(tsv_path)
+
+    def get_regions(task_id):
+      return list(
+          make_examples.regions_to_process(
+              contigs=contigs,
+              partition_size=10,
+              task_id=task_id,
+              num_shards=num_shards,
+              region_costs=region_costs))
+
+    sharded_regions = [get_regions(task_id) for task_id in range(num_shards)]
+    six.assertCountEqual(
+        self, list(make_examples.regions_to_process(contigs, 10)),
+        [r for task_regions in sharded_regions for r in task_regions])
+    # The slow region gets a shard of its own.
+    slow_shard = [
+        task_regions for task_regions in sharded_regions
+        if ranges.parse_literal('z:1-10') in task_regions
+    ][0]
+    self.assertLen(slow_shard, 1)
+    # The same assignment is computed every time.
+    self.assertEqual(sharded_regions[0], get_regions(0))
+
+  def test_estimate_region_costs(self):
+    region_costs = {'z': [(0, 10, 10.0), (10, 20, 2.0)]}
+    regions = [
+        ranges.make_range('z', 5, 15),
+        ranges.make_range('z', 0, 20),
+        # Not in the previous run, so costs the average 0.6s per base.
+        ranges.make_range('a', 0, 10),
+    ]
+    self.assertEqual([6.0, 12.0, 6.0],
+                     make_examples._estimate_region_costs(
+                         regions, region_costs))
+
+  def test_adaptive_partition(self):
+    # 'z' has 1 read per base in [20, 40) and none elsewhere, 'a' has 0.2.
+    def estimate(region):
+      if region.reference_name == 'a':
+        return 0.2 * ranges.length(region)
+      return max(min(region.end, 40) - max(region.start, 20), 0)
+
+    estimator = mock.Mock(estimate=mock.Mock(side_effect=estimate))
+    partitions = _from_literals_list([
+        'z:1-10', 'z:11-20', 'z:21-30', 'z:31-40', 'z:41-50', 'z:51-60',
+        'z:61-70', 'a:1-10', 'a:11-20', 'a:21-30', 'a:41-50'
+    ])
+    with mock.patch.object(make_examples, '_MIN_ADAPTIVE_PARTITION_SIZE', 2):
+      actual = list(
+          make_examples.adaptive_partition(
+              partitions, estimator, read_budget=4, max_partition_size=20))
+    self.assertEqual(
+        _from_literals_list([
+            # Empty partitions are coalesced.
+            'z:1-20',
+            # Partitions with 10 reads are split in 3.
+            'z:21-24', 'z:25-28', 'z:29-30', 'z:31-34', 'z:35-38', 'z:39-40',
+            # Coalescing is limited by max_partition_size...
+            'z:41-60', 'z:61-70',
+            # ...by the read budget and to abutting partitions.
+            'a:1-20', 'a:21-30', 'a:41-50'
+        ]), actual)
+
+  def test_regions_to_process_skips_empty_partitions(self):
+    estimator = mock.Mock()
+    estimator.has_reads.side_effect = lambda r: r.reference_name != 'a'
+    self.assertEqual(
+        _from_literals_list(['z:1-50', 'z:51-100', 'n:1-50', 'n:51-100']),
+        list(
+            make_examples.regions_to_process(
+                contigs=_make_contigs([('z', 100), ('a', 100), ('n', 100)]),
+                partition_size=50,
+                read_count_estimator=estimator,
+                skip_empty_partitions=True)))
+
+  def test_regions_to_process_skips_empty_partitions_of_shard(self):
+    contigs = _make_contigs([('z', 100), ('a', 100), ('n', 100)])
+    estimator = mock.Mock()
+    estimator.has_reads.side_effect = lambda r: r.reference_name != 'a'
+
+    # Shards get the same partitions as without skipping, and each shard only
+    # checks its own partitions.
+    for task_id in range(3):
+      estimator.has_reads.reset_mock()
+      expected = list(
+          make_examples.regions_to_process(
+              contigs=contigs, partition_size=50, task_id=task_id,
+              num_shards=3))
+      actual = list(
+          make_examples.regions_to_process(
+              contigs=contigs,
+              partition_size=50,
+              task_id=task_id,
+              num_shards=3,
+              read_count_estimator=estimator,
+              skip_empty_partitions=True))
+      self.assertEqual([r for r in expected if r.reference_name != 'a'],
+                       actual)
+      self.assertEqual([mock.call(r) for r in expected],
+                       estimator.has_reads.call_args_list)
+
+  def test_read_count_estimator(self):
+    reader = sam.SamReader(testdata.CHR20_BAM)
+    estimator = make_examples.ReadCountEstimator([reader, reader])
+    region = ranges.parse_literal('chr20:10,000,001-10,001,000')
+    n_reads = estimator.estimate(region)
+    self.assertGreater(n_reads, 0)
+    # Each reads file contributes its own estimate.
+    self.assertAlmostEqual(
+        n_reads, 2 * make_examples.ReadCountEstimator([reader]).estimate(region))
+    self.assertEqual(
+        0, estimator.estimate(ranges.parse_literal('chr20:1-1,000')))
+    self.assertTrue(estimator.has_reads(region))
+    self.assertFalse(
+        estimator.has_reads(ranges.parse_literal('chr20:1-1,000')))
+
   @parameterized.parameters(
       # Providing one of task id and num_shards but not the other is bad.
       (None, 0),
@@ -1172,6 +1379,37 @@ class MakeExamplesUnitTest(parameterized.TestCase):
     list_expected = [regions[i] for i in regions_to_keep]
     self.assertEqual(list_output, list_expected)
 
+  def test_filter_regions_by_indexed_vcf(self):
+    regions = list(
+        _from_literals(['chr20:10,000,001-10,010,000']).partition(100))
+    with vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF) as vcf_reader:
+      variant_positions = [
+          variant_utils.variant_position(v) for v in vcf_reader.iterate()
+      ]
+      filtered_regions = make_examples.filter_regions_by_indexed_vcf(
+          regions, vcf_reader)
+    self.assertNotEmpty(filtered_regions)
+    self.assertLess(len(filtered_regions), len(regions))
+    self.assertEqual(
+        make_examples.filter_regions_by_vcf(regions, variant_positions),
+        filtered_regions)
+
+  def test_filter_regions_by_indexed_vcf_unknown_contig(self):
+    regions = _from_literals_list(
+        ['chr20:10,000,001-10,010,000', 'not_in_vcf:1-100'])
+    with vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF) as vcf_reader:
+      self.assertEqual(
+          regions[:1],
+          make_examples.filter_regions_by_indexed_vcf(regions, vcf_reader))
+
+  def test_vcf_has_index(self):
+    unindexed_vcf = test_utils.test_tmpfile('unindexed.vcf.gz')
+    shutil.copy(testdata.TRUTH_VARIANTS_VCF, unindexed_vcf)
+    with vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF) as vcf_reader:
+      self.assertTrue(make_examples._vcf_has_index(vcf_reader))
+    with vcf.VcfReader(unindexed_vcf) as vcf_reader:
+      self.assertFalse(make_examples._vcf_has_index(vcf_reader))
+
   def test_catches_bad_argv(self):
     with mock.patch.object(logging, 'error') as mock_logging,\
         mock.patch.object(sys, 'exit') as mock_exit:
@@ -1645,6 +1883,53 @@ class MakeExamplesUnitTest(parameterized.TestCase):
 
   # pylint: enable=unused-argument
 
+  @parameterized.parameters(
+      dict(block_size=10000, max_cached_blocks=32),
+      dict(block_size=7, max_cached_blocks=2),
+  )
+  def test_population_variant_index_matches_vcf_reader(self, block_size,
+                                                       max_cached_blocks):
+    ref_reader = fasta.IndexedFastaReader(testdata.CHR20_GRCH38_FASTA)
+    vcf_reader = vcf.VcfReader(testdata.VCF_WITH_ALLELE_FREQUENCIES)
+    candidates = [
+        variants_pb2.Variant(
+            reference_name='chr20',
+            start=60279,
+            end=60285,
+            reference_bases='TTTCCA',
+            alternate_bases=['T']),
+        variants_pb2.Variant(
+            reference_name='chr20',
+            start=60295,
+            end=60301,
+            reference_bases='TTCCAT',
+            alternate_bases=['T']),
+        variants_pb2.Variant(
+            reference_name='chr20',
+            start=61065,
+            end=61066,
+            reference_bases='T',
+            alternate_bases=['C']),
+        variants_pb2.Variant(
+            reference_name='chr20',
+            start=62022,
+            end=62023,
+            reference_bases='G',
+            alternate_bases=['C', 'T']),
+    ]
+    index = make_examples.PopulationVariantIndex(
+        vcf_reader, block_size=block_size, max_cached_blocks=max_cached_blocks)
+    index.load(candidates)
+    for candidate in candidates:
+      query = ranges.make_range('chr20', candidate.start, candidate.end)
+      self.assertEqual(
+          list(index.query(query)), list(vcf_reader.query(query)))
+      self.assertEqual(
+          make_examples.find_matching_allele_frequency(candidate, index,
+                                                       ref_reader),
+          make_examples.find_matching_allele_frequency(candidate, vcf_reader,
+                                                       ref_reader))
+
 
 class RegionProcessorTest(parameterized.TestCase):
 
@@ -1793,6 +2078,156 @@ class RegionProcessorTest(parameterized.TestCase):
           mock.call(e3, l2),
       ], mock_alte.call_args_list)
 
+  def test_process_streams_examples(self):
+    self.processor.options.mode = deepvariant_pb2.DeepVariantOptions.CALLING
+    c1, c2 = mock.Mock(), mock.Mock()
+    e1, e2, e3 = mock.Mock(), mock.Mock(), mock.Mock()
+    self.processor.in_memory_sam_reader = mock.Mock()
+    self.add_mock('region_reads', retval=[])
+    self.add_mock('candidates_in_region', retval=([c1, c2], []))
+    mock_cpe = self.add_mock(
+        'create_pileup_examples', side_effect=[[e1], [e2, e3]])
+
+    candidates, examples, gvcfs = self.processor.process(
+        self.region, stream_examples=True)
+    self.assertEqual([c1, c2], candidates)
+    self.assertEqual([], gvcfs)
+    # Examples are only created as they are consumed.
+    test_utils.assert_not_called_workaround(mock_cpe)
+    self.assertEqual(e1, next(examples))
+    self.assertEqual([mock.call(c1)], mock_cpe.call_args_list)
+    self.assertEmpty(self.processor.region_metrics.stages)
+
+    self.assertEqual([e2, e3], list(examples))
+    self.assertEqual([mock.call(c1), mock.call(c2)], mock_cpe.call_args_list)
+    encode_pileups = [
+        m for m in self.processor.region_metrics.stages
+        if m.stage == 'encode_pileups'
+    ]
+    self.assertLen(encode_pileups, 1)
+    self.assertEqual(3, encode_pileups[0].count)
+
+  def test_region_reads_with_prefetching(self):
+    self.processor.options.prefetch_regions = 2
+    self.processor.options.realigner_enabled = False
+    self.processor.options.max_reads_per_partition = 0
+    regions = _from_literals_list(
+        ['chr20:1-10', 'chr20:11-20', 'chr20:21-30', 'chr20:31-40'])
+    self.processor.sam_readers = [mock.Mock()]
+    self.processor.sam_readers[0].query.side_effect = (
+        lambda region: [region.start])
+
+    self.processor.start_prefetching(regions)
+    self.assertEqual([[r.start] for r in regions],
+                     [self.processor.region_reads(r) for r in regions])
+    self.processor.stop_prefetching()
+    self.assertIsNone(self.processor.read_prefetcher)
+    self.assertEqual([mock.call(r) for r in regions],
+                     self.processor.sam_readers[0].query.call_args_list)
+
+  def test_read_prefetcher_raises_query_errors_in_order(self):
+    regions = _from_literals_list(['chr20:1-10', 'chr20:11-20', 'chr20:21-30'])
+
+    def query(region):
+      if region.start == 10:
+        raise ValueError('Bad region')
+      return [region.start]
+
+    prefetcher = make_examples.ReadPrefetcher(
+        query, regions, max_regions=1, max_reads=1)
+    self.assertEqual([0], prefetcher.get(regions[0]))
+    with six.assertRaisesRegex(self, ValueError, 'Bad region'):
+      prefetcher.get(regions[1])
+    # Regions after an error are not queried.
+    with six.assertRaisesRegex(self, ValueError, 'No more prefetched regions'):
+      prefetcher.get(regions[2])
+    prefetcher.close()
+
+  def test_read_prefetcher_requires_regions_in_order(self):
+    regions = _from_literals_list(['chr20:1-10', 'chr20:11-20'])
+    prefetcher = make_examples.ReadPrefetcher(
+        lambda region: [], regions, max_regions=2, max_reads=10)
+    with six.assertRaisesRegex(self, ValueError, 'Expected prefetched region'):
+      prefetcher.get(regions[1])
+    prefetcher.close()
+
+  @parameterized.parameters(
+      dict(downsample_fraction=0.0, expect_reuse=True),
+      dict(downsample_fraction=0.5, expect_reuse=False),
+  )
+  def test_query_reads_reuses_boundary_reads(self, downsample_fraction,
+                                             expect_reuse):
+    self.processor.options.reuse_boundary_reads = True
+    self.processor.options.downsample_fraction = downsample_fraction
+    region1, region2, region3 = _from_literals_list(
+        ['chr20:1-10', 'chr20:11-20', 'chr20:31-40'])
+    r1 = test_utils.make_read('ACGT', start=5, cigar='4M', chrom='chr20')
+    # Spans the boundary between region1 and region2.
+    r2 = test_utils.make_read('ACGTACGT', start=8, cigar='8M', chrom='chr20')
+    r3 = test_utils.make_read('ACGT', start=12, cigar='4M', chrom='chr20')
+    reader = mock.Mock()
+    reads_by_start = {0: [r1, r2], 10: [r2, r3], 30: []}
+    reader.query.side_effect = lambda region: reads_by_start[region.start]
+    reader.query_starting_at.return_value = [r3]
+    self.processor.sam_readers = [reader]
+
+    self.assertEqual([r1, r2], self.processor.query_reads(region1))
+    self.assertEqual([r2, r3], self.processor.query_reads(region2))
+    # region3 doesn't abut region2, so all its reads are queried.
+    self.assertEqual([], self.processor.query_reads(region3))
+    if expect_reuse:
+      self.assertEqual([mock.call(region1), mock.call(region3)],
+                       reader.query.call_args_list)
+      reader.query_starting_at.assert_called_once_with(region2, 10)
+    else:
+      self.assertEqual(
+          [mock.call(region1), mock.call(region2), mock.call(region3)],
+          reader.query.call_args_list)
+      test_utils.assert_not_called_workaround(reader.query_starting_at)
+
+  @parameterized.parameters(
+      dict(n_readers=1, estimate=None, expect_native=True),
+      dict(n_readers=1, estimate=1000, expect_native=True),
+      dict(n_readers=1, estimate=10, expect_native=False),
+      dict(n_readers=2, estimate=None, expect_native=False),
+  )
+  def test_query_reads_samples_natively(self, n_readers, estimate,
+                                        expect_native):
+    self.processor.options.max_reads_per_partition = 100
+    self.processor.options.random_seed = 123
+    self.processor.options.reuse_boundary_reads = True
+    if estimate is not None:
+      self.processor.read_count_estimator = mock.Mock()
+      self.processor.read_count_estimator.estimate.return_value = estimate
+    self.processor.sam_readers = [mock.Mock() for _ in range(n_readers)]
+    for reader in self.processor.sam_readers:
+      reader.query.return_value = []
+
+    self.assertEqual([], self.processor.query_reads(self.region))
+    for reader in self.processor.sam_readers:
+      if expect_native:
+        reader.query.assert_called_once_with(
+            self.region, max_reads=100, random_seed=123)
+      else:
+        reader.query.assert_called_once_with(self.region)
+    # Reads spanning into the next region are only kept if all were queried.
+    self.assertEqual(expect_native, self.processor.boundary_reads is None)
+
+  def test_region_reads_skips_regions_without_reads(self):
+    self.processor.options.realigner_enabled = True
+    self.processor.realigner = mock.Mock()
+    self.processor.sam_readers = [mock.Mock()]
+    self.processor.read_count_estimator = mock.Mock()
+    self.processor.read_count_estimator.has_reads.return_value = False
+
+    self.assertEqual([], self.processor.region_reads(self.region))
+    self.processor.read_count_estimator.has_reads.assert_called_once_with(
+        self.region)
+    test_utils.assert_not_called_workaround(
+        self.processor.sam_readers[0].query)
+    test_utils.assert_not_called_workaround(
+        self.processor.realigner.realign_reads)
+
   def test_process_with_realigner(self):
     self.processor.options.mode = deepvariant_pb2.DeepVariantOptions.CALLING
     self.processor.options.realigner_enabled = True
@@ -1815,10 +2250,17 @@ class RegionProcessorTest(parameterized.TestCase):
     self.assertEqual(([c1, c2], [e1, e2, e3], []),
                      self.processor.process(self.region))
     self.processor.sam_readers[0].query.assert_called_once_with(self.region)
-    self.processor.realigner.realign_reads.assert_called_once_with([],
-                                                                   self.region)
+    self.processor.realigner.realign_reads.assert_called_once_with(
+        [],
+        self.region,
+        allele_counter=None,
+        stage_timer=self.processor.stage_timer)
     self.processor.in_memory_sam_reader.replace_reads.assert_called_once_with(
         [])
+    self.assertEqual(self.processor.region_metrics.region, self.region)
+    self.assertEqual(
+        ['query_reads', 'sample_reads', 'encode_pileups'],
+        [m.stage for m in self.processor.region_metrics.stages])
     self.assertEqual([mock.call(c1), mock.call(c2)], mock_cpe.call_args_list)
     test_utils.assert_not_called_workaround(mock_lc)
 
@@ -1870,6 +2312,42 @@ class RegionProcessorTest(parameterized.TestCase):
     # the gvcf records.
     self.assertEqual(expected_calls, actual)
 
+  @parameterized.parameters(
+      dict(read_starts=[], expected_starts=[]),
+      dict(
+          read_starts=[10000010, 10000050],
+          expected_starts=[10000010, 10000050]),
+      # The read outside of the region isn't counted.
+      dict(read_starts=[10000010, 10000500], expected_starts=[10000010]),
+  )
+  def test_candidates_in_region_in_memory_sam_reader(self, read_starts,
+                                                     expected_starts):
+    reads = [
+        test_utils.make_read('ACGT', start=start, cigar='4M', chrom='chr20')
+        for start in read_starts
+    ]
+    self.processor.in_memory_sam_reader = sam.InMemorySamReader(reads)
+    mock_ac = mock.Mock()
+    mock_make_ac = self.add_mock(
+        '_make_allele_counter_for_region', retval=mock_ac)
+    mock_vc = mock.Mock()
+    mock_vc.calls_and_gvcfs.return_value = (['variant'], [])
+    self.processor.variant_caller = mock_vc
+
+    actual = self.processor.candidates_in_region(self.region)
+
+    if expected_starts:
+      self.assertEqual((['variant'], []), actual)
+      mock_make_ac.assert_called_once_with(self.region)
+      self.assertEqual(
+          expected_starts,
+          [c[0][0].alignment.position.position
+           for c in mock_ac.add.call_args_list])
+    else:
+      # A region with no reads returns early, without an AlleleCounter.
+      self.assertEqual(([], []), actual)
+      test_utils.assert_not_called_workaround(mock_make_ac)
+
   def test_create_pileup_examples_handles_none(self):
     self.processor.pic = mock.Mock()
     dv_call = mock.Mock()
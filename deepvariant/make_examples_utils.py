@@ -28,6 +28,39 @@
 # POSSIBILITY OF SUCH DAMAGE.
 """Shareable functionality for make_examples."""
 
+import threading
+
+from third_party.nucleus.io import tfrecord
+from third_party.nucleus.util import ranges
+
+# Number of bases fetched on each side of a region by RegionReferenceCache.
+# This covers the window selector's region expansion, the realigner's
+# alignment margins and the pileup window around candidates near the edges.
+_REGION_REFERENCE_MARGIN = 1000
+
+
+def make_tfrecord_writer(path, compression_threads=0, compression_level=-1):
+  """Returns a writer of the TFRecords of a make_examples output.
+
+  Args:
+    path: str. The path of the output. Outputs ending in .gz are gzipped.
+    compression_threads: int. If > 0, the output is compressed in independent
+      blocks on this many threads instead of on the writing thread.
+    compression_level: int in [-1, 9]. The zlib compression level: -1 keeps
+      the zlib default level, 1 (fastest) to 9 (smallest) set it and 0 stores
+      the records without compressing them. Any level but -1 also compresses
+      in blocks, on one thread if compression_threads is 0.
+
+  Returns:
+    A GenomicsWriter of TFRecords.
+  """
+  if compression_threads <= 0 and compression_level == -1:
+    return tfrecord.Writer(path)
+  return tfrecord.ParallelWriter(
+      path,
+      compression_level=compression_level,
+      num_threads=max(1, compression_threads))
+
 
 class Sample(object):
   """Sample organizes sample-level properties and sam readers."""
@@ -53,3 +86,57 @@ class Sample(object):
 
   def __repr__(self):
     return '<Sample {}>'.format(str(self.__dict__))
+
+
+class RegionReferenceCache(object):
+  """A reference reader serving the bases around one region from memory.
+
+  While processing a region, the pileup image creator, the realigner and the
+  alt-allele alignment all query short, overlapping slices of the reference
+  around that region. RegionReferenceCache wraps a reference reader, fetches
+  the region plus a margin once in load(), and answers query() for any range
+  inside it by slicing the cached bases. Queries outside the cached range and
+  all other methods (is_valid, contig, c_reader, ...) go to the wrapped reader,
+  so the cache can be used anywhere a reference reader is expected. Queries
+  may be made from several threads; those that miss the cache take turns on
+  the wrapped reader.
+  """
+
+  def __init__(self, ref_reader, margin=_REGION_REFERENCE_MARGIN):
+    """Creates a new RegionReferenceCache.
+
+    Args:
+      ref_reader: The reference reader to wrap, e.g. a fasta.IndexedFastaReader.
+      margin: int. The number of bases cached on each side of a loaded region.
+    """
+    self._ref_reader = ref_reader
+    self._margin = margin
+    # (range, bases) of the loaded region, or None. Replaced as a whole by
+    # load(), so a query never sees the bases of one range with another.
+    self._cached = None
+    self._lock = threading.Lock()
+
+  def __getattr__(self, attr):
+    return getattr(self._ref_reader, attr)
+
+  def load(self, region):
+    """Caches the reference bases of region plus the margin on each side."""
+    n_bases = self._ref_reader.contig(region.reference_name).n_bases
+    cached_range = ranges.make_range(region.reference_name,
+                                     max(region.start - self._margin, 0),
+                                     min(region.end + self._margin, n_bases))
+    with self._lock:
+      bases = self._ref_reader.query(cached_range)
+    self._cached = (cached_range, bases)
+
+  def query(self, region):
+    """Returns the reference bases (as a string) in the given region."""
+    cached = self._cached
+    if cached is not None:
+      cached_range, bases = cached
+      if (region.reference_name == cached_range.reference_name and
+          cached_range.start <= region.start <= region.end <= cached_range.end):
+        return bases[region.start - cached_range.start:region.end -
+                     cached_range.start]
+    with self._lock:
+      return self._ref_reader.query(region)
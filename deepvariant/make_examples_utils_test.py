@@ -32,6 +32,17 @@ from absl.testing import absltest
 from absl.testing import parameterized
 
 from deepvariant import make_examples_utils
+from deepvariant import testdata
+from tensorflow.core.example import example_pb2
+from third_party.nucleus.io import fasta
+from third_party.nucleus.io import genomics_writer
+from third_party.nucleus.io import tfrecord
+from third_party.nucleus.testing import test_utils
+from third_party.nucleus.util import ranges
+
+
+def setUpModule():
+  testdata.init()
 
 
 class MakeExamplesUtilsTest(parameterized.TestCase):
@@ -57,6 +68,61 @@ class MakeExamplesUtilsTest(parameterized.TestCase):
     self.assertIn('pileup_height', sample.__repr__())
     self.assertIn('200', sample.__repr__())
 
+  @parameterized.parameters(
+      (0, -1, genomics_writer.TFRecordWriter),
+      (4, -1, genomics_writer.ParallelTFRecordWriter),
+      (0, 1, genomics_writer.ParallelTFRecordWriter),
+      (2, 0, genomics_writer.ParallelTFRecordWriter),
+  )
+  def test_make_tfrecord_writer(self, threads, level, expected_class):
+    path = test_utils.test_tmpfile('examples.tfrecord.gz')
+    example = example_pb2.Example()
+    example.features.feature['x'].int64_list.value.append(1)
+    with make_examples_utils.make_tfrecord_writer(
+        path, compression_threads=threads,
+        compression_level=level) as writer:
+      self.assertIsInstance(writer, expected_class)
+      writer.write(example)
+    self.assertEqual([example], list(tfrecord.read_tfrecords(path)))
+
+
+class RegionReferenceCacheTest(parameterized.TestCase):
+
+  def setUp(self):
+    super(RegionReferenceCacheTest, self).setUp()
+    self.ref_reader = fasta.IndexedFastaReader(testdata.CHR20_FASTA)
+    self.cache = make_examples_utils.RegionReferenceCache(
+        self.ref_reader, margin=10)
+    self.cache.load(ranges.make_range('chr20', 10000000, 10000100))
+
+  @parameterized.parameters(
+      # Inside the region.
+      ('chr20', 10000010, 10000020),
+      # Inside the margins, including the exact cached bounds.
+      ('chr20', 9999990, 10000000),
+      ('chr20', 10000100, 10000110),
+      ('chr20', 9999990, 10000110),
+      # Empty range.
+      ('chr20', 10000050, 10000050),
+      # Partially or fully outside the cached range.
+      ('chr20', 9999980, 10000005),
+      ('chr20', 10000105, 10000120),
+      ('chr20', 1000, 1010),
+  )
+  def test_query_matches_reader(self, chrom, start, end):
+    region = ranges.make_range(chrom, start, end)
+    self.assertEqual(self.cache.query(region), self.ref_reader.query(region))
+
+  def test_load_clips_to_contig(self):
+    self.cache.load(ranges.make_range('chr20', 5, 15))
+    region = ranges.make_range('chr20', 0, 25)
+    self.assertEqual(self.cache.query(region), self.ref_reader.query(region))
+
+  def test_delegates_other_methods(self):
+    self.assertEqual(
+        self.cache.contig('chr20'), self.ref_reader.contig('chr20'))
+    self.assertIs(self.cache.c_reader, self.ref_reader.c_reader)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -319,32 +319,16 @@ class PileupImageCreator(object):
     Raises:
       ValueError: if any arguments are invalid.
     """
-    if len(refbases) != self.width:
-      raise ValueError('refbases is {} long but width is {}'.format(
-          len(refbases), self.width))
-
-    if not alt_alleles:
-      raise ValueError('alt_alleles cannot be empty')
-    if any(alt not in dv_call.variant.alternate_bases for alt in alt_alleles):
-      raise ValueError(
-          'all elements of alt_alleles must be the alternate bases'
-          ' of dv_call.variant', alt_alleles, dv_call.variant)
-    if len(self._samples) != len(reads_for_samples):
-      raise ValueError(
-          'The number of self._samples ({}) must be the same as the number of '
-          'reads_for_samples ({}).'.format(
-              len(self._samples), len(reads_for_samples)))
+    self._check_pileup_args(dv_call, refbases, reads_for_samples, alt_alleles,
+                            custom_ref)
+    if self._builds_images_natively():
+      return self._build_pileups_natively(dv_call, refbases, reads_for_samples,
+                                          [alt_alleles])[0]
 
     image_start_pos = dv_call.variant.start - self.half_width
-    if not custom_ref and (refbases[self.half_width] !=
-                           dv_call.variant.reference_bases[0]):
-      raise ValueError('The middle base of reference sequence in the window '
-                       "({} at base {}) doesn't match first "
-                       'character of variant.reference_bases ({}).'.format(
-                           refbases[self.half_width], self.half_width,
-                           dv_call.variant.reference_bases))
+    sample_heights = [self._pileup_height(sample) for sample in self._samples]
 
-    def build_pileup_for_one_sample(reads, sample):
+    def build_pileup_for_one_sample(reads, pileup_height):
       """Create read pileup image section for one sample."""
       # We start with n copies of our encoded reference bases.
       rows = ([self._encoder.encode_reference(refbases)] *
@@ -389,12 +373,6 @@ class PileupImageCreator(object):
       # their alignment position.
       random_for_image = np.random.RandomState(self._options.random_seed)
 
-      # Use sample height or default to pic height.
-      if sample.pileup_height is not None:
-        pileup_height = sample.pileup_height
-      else:
-        pileup_height = self.height
-
       max_reads = pileup_height - self.reference_band_height
       pileup_of_reads = sorted(
           utils.reservoir_sample(
@@ -412,14 +390,117 @@ class PileupImageCreator(object):
       return rows
 
     sample_sections = []
-    for i, sample in enumerate(self._samples):
-      sample_sections.extend(
-          build_pileup_for_one_sample(reads_for_samples[i], sample))
+    for reads, pileup_height in zip(reads_for_samples, sample_heights):
+      sample_sections.extend(build_pileup_for_one_sample(reads, pileup_height))
 
     # Vertically stack the image rows to create a single
     # h x w x DEFAULT_NUM_CHANNEL image.
     return np.vstack(sample_sections)
 
+  def build_pileups(self,
+                    dv_call,
+                    refbases,
+                    reads_for_samples,
+                    alt_allele_combinations,
+                    custom_ref=False):
+    """Creates the pileup tensors for several sets of alt alleles of dv_call.
+
+    This is equivalent to calling build_pileup for each element of
+    alt_allele_combinations, but with the native encoder each read is only
+    encoded once: only the channels showing whether a read supports the alt
+    alleles differ between the images.
+
+    Args:
+      dv_call: learning.genomics.deepvariant.DeepVariantCall object with
+        information on our candidate call and allele support information.
+      refbases: A string options.width in length containing the reference base
+        sequence to encode. See build_pileup.
+      reads_for_samples: list by sample of Iterable of
+        third_party.nucleus.protos.Read objects. See build_pileup.
+      alt_allele_combinations: A list of collections of alternative_bases from
+        dv_call.variant. One image is built for each of them, treating its
+        elements as "alt".
+      custom_ref: True if refbases should not be checked for matching against
+        variant's reference_bases.
+
+    Returns:
+      A list of uint8 Tensor images, one for each element of
+      alt_allele_combinations, each of the shape returned by build_pileup.
+
+    Raises:
+      ValueError: if any arguments are invalid.
+    """
+    if not self._builds_images_natively():
+      return [
+          self.build_pileup(dv_call, refbases, reads_for_samples, alt_alleles,
+                            custom_ref)
+          for alt_alleles in alt_allele_combinations
+      ]
+    for alt_alleles in alt_allele_combinations:
+      self._check_pileup_args(dv_call, refbases, reads_for_samples, alt_alleles,
+                              custom_ref)
+    return self._build_pileups_natively(dv_call, refbases, reads_for_samples,
+                                        alt_allele_combinations)
+
+  def _check_pileup_args(self, dv_call, refbases, reads_for_samples,
+                         alt_alleles, custom_ref):
+    """Raises a ValueError if the arguments of build_pileup are invalid."""
+    if len(refbases) != self.width:
+      raise ValueError('refbases is {} long but width is {}'.format(
+          len(refbases), self.width))
+
+    if not alt_alleles:
+      raise ValueError('alt_alleles cannot be empty')
+    if any(alt not in dv_call.variant.alternate_bases for alt in alt_alleles):
+      raise ValueError(
+          'all elements of alt_alleles must be the alternate bases'
+          ' of dv_call.variant', alt_alleles, dv_call.variant)
+    if len(self._samples) != len(reads_for_samples):
+      raise ValueError(
+          'The number of self._samples ({}) must be the same as the number of '
+          'reads_for_samples ({}).'.format(
+              len(self._samples), len(reads_for_samples)))
+
+    if not custom_ref and (refbases[self.half_width] !=
+                           dv_call.variant.reference_bases[0]):
+      raise ValueError('The middle base of reference sequence in the window '
+                       "({} at base {}) doesn't match first "
+                       'character of variant.reference_bases ({}).'.format(
+                           refbases[self.half_width], self.half_width,
+                           dv_call.variant.reference_bases))
+
+  def _builds_images_natively(self):
+    """Returns True if our encoder can build whole images natively.
+
+    Only the native encoder builds whole images, other encoders (e.g., test
+    doubles) are driven one row at a time by build_pileup.
+    """
+    return isinstance(self._encoder,
+                      pileup_image_native.PileupImageEncoderNative)
+
+  def _build_pileups_natively(self, dv_call, refbases, reads_for_samples,
+                              alt_allele_combinations):
+    """Builds the images for alt_allele_combinations with one native call."""
+    sample_heights = [self._pileup_height(sample) for sample in self._samples]
+    if any(h < self.reference_band_height for h in sample_heights):
+      raise ValueError('All pileup heights must be >= reference_band_height',
+                       sample_heights, self.reference_band_height)
+    images = self._encoder.build_pileups(
+        dv_call, refbases, [list(reads) for reads in reads_for_samples],
+        dv_call.variant.start - self.half_width,
+        [list(alt_alleles) for alt_alleles in alt_allele_combinations],
+        sample_heights)
+    # The images come back stacked on top of each other.
+    return list(
+        images.reshape((len(alt_allele_combinations), sum(sample_heights),
+                        self.width, self.num_channels)))
+
+  def _pileup_height(self, sample):
+    """Returns the pileup height of sample, defaulting to our height."""
+    if sample.pileup_height is not None:
+      return sample.pileup_height
+    return self.height
+
   def _empty_image_row(self):
     """Creates an empty image row as an uint8 np.array."""
     return np.zeros((1, self.width, self.num_channels), dtype=np.uint8)
@@ -456,59 +537,70 @@ class PileupImageCreator(object):
       return None
 
     alt_aligned_representation = self._options.alt_aligned_pileup
-
-    def _pileup_for_pair_of_alts(alt_alleles):
-      """Create pileup image for one combination of alt alleles."""
-      # Always create the ref-aligned pileup image.
-      ref_image = self.build_pileup(
-          dv_call=dv_call,
-          refbases=ref_bases,
-          reads_for_samples=reads_for_samples,
-          alt_alleles=alt_alleles)
-      # Optionally also create pileup images with reads aligned to alts.
-      if alt_aligned_representation != 'none':
-        if haplotype_alignments_for_samples is None or haplotype_sequences is None:
-          # Use sample height or default to pic height.
-          sample_heights = [sample.pileup_height for sample in self._samples]
-          if None not in sample_heights:
-            pileup_height = sum(sample_heights)
-          else:
-            pileup_height = self.height
-          pileup_shape = (pileup_height, self.width, self.num_channels)
-          alt_images = [
-              np.zeros(pileup_shape, dtype=np.uint8) for alt in alt_alleles
-          ]
-        else:
-          alt_images = []
-          for alt in alt_alleles:
-            if len(haplotype_sequences[alt]) != self.width:
-              logging.warning(
-                  'haplotype_sequences[alt] is %d long but pileup '
-                  'image width is %d. Giving up on this image',
-                  len(haplotype_sequences[alt]), self.width)
-              return None
-            alt_image = self.build_pileup(
-                dv_call=dv_call,
-                refbases=haplotype_sequences[alt],
-                reads_for_samples=[
-                    sample[alt] for sample in haplotype_alignments_for_samples
-                ],
-                alt_alleles=alt_alleles,
-                custom_ref=True)
-            alt_images.append(alt_image)
-        composite_image = _represent_alt_aligned_pileups(
-            alt_aligned_representation, ref_image, alt_images)
-        return composite_image
+    alt_allele_combinations = list(self._alt_allele_combinations(variant))
+
+    # Always create the ref-aligned pileup images. The images of all alt allele
+    # combinations are built together, so each read is only encoded once.
+    ref_images = self.build_pileups(
+        dv_call=dv_call,
+        refbases=ref_bases,
+        reads_for_samples=reads_for_samples,
+        alt_allele_combinations=alt_allele_combinations)
+    if alt_aligned_representation == 'none':
+      return list(zip(alt_allele_combinations, ref_images))
+
+    # Optionally also create pileup images with reads aligned to alts.
+    if haplotype_alignments_for_samples is None or haplotype_sequences is None:
+      # Use sample height or default to pic height.
+      sample_heights = [sample.pileup_height for sample in self._samples]
+      if None not in sample_heights:
+        pileup_height = sum(sample_heights)
       else:
-        return ref_image
-
-    retval = []
-    for alts in self._alt_allele_combinations(variant):
-      pileup = _pileup_for_pair_of_alts(alts)
-      # If the pileup is None, this can mean that we're near the edge of the
-      # contig, so one pileup width is invalid.
-      # Return None to indicate we couldn't process this variant.
-      if pileup is None:
-        return None
-      retval.append((alts, pileup))
-    return retval
+        pileup_height = self.height
+      pileup_shape = (pileup_height, self.width, self.num_channels)
+      alt_images_for_combinations = [
+          [np.zeros(pileup_shape, dtype=np.uint8) for alt in alt_alleles]
+          for alt_alleles in alt_allele_combinations
+      ]
+    else:
+      # The reads aligned to one alt are shared by all combinations containing
+      # that alt, so build the images of those combinations together.
+      alt_images = {}
+      for alt in variant.alternate_bases:
+        indices = [
+            i for i, alt_alleles in enumerate(alt_allele_combinations)
+            if alt in alt_alleles
+        ]
+        if not indices:
+          continue
+        if len(haplotype_sequences[alt]) != self.width:
+          logging.warning(
+              'haplotype_sequences[alt] is %d long but pileup '
+              'image width is %d. Giving up on this image',
+              len(haplotype_sequences[alt]), self.width)
+          # This can mean that we're near the edge of the contig, so return
+          # None to indicate we couldn't process this variant.
+          return None
+        images = self.build_pileups(
+            dv_call=dv_call,
+            refbases=haplotype_sequences[alt],
+            reads_for_samples=[
+                sample[alt] for sample in haplotype_alignments_for_samples
+            ],
+            alt_allele_combinations=[
+                alt_allele_combinations[i] for i in indices
+            ],
+            custom_ref=True)
+        for i, image in zip(indices, images):
+          alt_images[(alt, i)] = image
+      alt_images_for_combinations = [
+          [alt_images[(alt, i)] for alt in alt_alleles]
+          for i, alt_alleles in enumerate(alt_allele_combinations)
+      ]
+
+    return [(alt_alleles,
+             _represent_alt_aligned_pileups(alt_aligned_representation,
+                                            ref_image, alt_aligned_images))
+            for alt_alleles, ref_image, alt_aligned_images in zip(
+                alt_allele_combinations, ref_images,
+                alt_images_for_combinations)]
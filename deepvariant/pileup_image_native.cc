@@ -37,17 +37,21 @@
 #include <functional>
 #include <iterator>
 #include <memory>
+#include <random>
 #include <string>
+#include <utility>
 #include <vector>
 
 #include "third_party/nucleus/protos/cigar.pb.h"
 #include "third_party/nucleus/protos/position.pb.h"
 #include "third_party/nucleus/protos/reads.pb.h"
+#include "third_party/nucleus/protos/struct.pb.h"
 #include "third_party/nucleus/protos/variants.pb.h"
 #include "tensorflow/core/platform/logging.h"
 
 using nucleus::genomics::v1::Read;
 using nucleus::genomics::v1::CigarUnit;
+using nucleus::genomics::v1::Value;
 using std::vector;
 
 using learning::genomics::deepvariant::DeepVariantCall;
@@ -60,72 +64,92 @@ using tensorflow::uint8;
 
 namespace {
 
-// Does this read support ref, one of the alternative alleles, or an allele we
-// aren't considering?
-inline int ReadSupportsAlt(const DeepVariantCall& dv_call, const Read& read,
-                           const std::vector<string>& alt_alleles) {
-  string key = (read.fragment_name() + "/" +
-                std::to_string(read.read_number()));
-
-  // Iterate over all alts, not just alt_alleles.
-  for (const string& alt_allele : dv_call.variant().alternate_bases()) {
-    const auto& allele_support = dv_call.allele_support();
-    const bool alt_allele_present_in_call =
-        allele_support.find(alt_allele) != allele_support.cend();
-
-    if (alt_allele_present_in_call) {
-      const auto& supp_read_names = allele_support.at(alt_allele).read_names();
-      for (const string& read_name : supp_read_names) {
-        const bool alt_in_alt_alleles =
-            std::find(alt_alleles.begin(), alt_alleles.end(), alt_allele) !=
-            alt_alleles.end();
-        // Read can support an alt we are currently considering (1), a different
-        // alt not present in alt_alleles (2), or ref (0).
-        if (read_name == key && alt_in_alt_alleles) {
-          return 1;
-        } else if (read_name == key && !alt_in_alt_alleles) {
-          return 2;
-        }
-      }
+// Returns the indices in dv_call.variant().alternate_bases() of the alt
+// alleles listing read among their supporting reads, in increasing order.
+vector<int> SupportedAltIndices(const DeepVariantCall& dv_call,
+                                const Read& read) {
+  const string key = (read.fragment_name() + "/" +
+                      std::to_string(read.read_number()));
+  const auto& allele_support = dv_call.allele_support();
+  const auto& alternate_bases = dv_call.variant().alternate_bases();
+  vector<int> supported_alts;
+  for (int i = 0; i < alternate_bases.size(); ++i) {
+    const auto it = allele_support.find(alternate_bases[i]);
+    if (it == allele_support.end()) continue;
+    const auto& supp_read_names = it->second.read_names();
+    if (std::find(supp_read_names.begin(), supp_read_names.end(), key) !=
+        supp_read_names.end()) {
+      supported_alts.push_back(i);
     }
   }
-  return 0;
+  return supported_alts;
+}
+
+inline bool IsInAltAlleles(const string& alt_allele,
+                           const vector<string>& alt_alleles) {
+  return std::find(alt_alleles.begin(), alt_alleles.end(), alt_allele) !=
+         alt_alleles.end();
+}
+
+// Does this read support ref, one of the alternative alleles, or an allele we
+// aren't considering? Only the first alt allele the read supports counts.
+inline int ReadSupportsAlt(const DeepVariantCall& dv_call,
+                           const vector<int>& supported_alts,
+                           const vector<string>& alt_alleles) {
+  if (supported_alts.empty()) return 0;
+  const string& alt_allele =
+      dv_call.variant().alternate_bases(supported_alts.front());
+  // Read can support an alt we are currently considering (1), a different alt
+  // not present in alt_alleles (2), or ref (0).
+  return IsInAltAlleles(alt_allele, alt_alleles) ? 1 : 2;
 }
 
-// Get the allele frequency of the alt allele that is carried by a read.
+// Get the allele frequency of the first alt allele in alt_alleles that is
+// carried by a read.
 inline float ReadAlleleFrequency(const DeepVariantCall& dv_call,
-                                 const Read& read,
-                                 const std::vector<string>& alt_alleles) {
-  string key = (read.fragment_name() + "/" +
-                std::to_string(read.read_number()));
-
-  // Iterate over all alts, not just alt_alleles.
-  for (const string& alt_allele : dv_call.variant().alternate_bases()) {
-    const auto& allele_support = dv_call.allele_support();
-    auto it_read = allele_support.find(alt_allele);
-
-    if (it_read != allele_support.end()){
-      const auto& supp_read_names = it_read->second.read_names();
-      for (const string& read_name : supp_read_names) {
-        const bool alt_in_alt_alleles =
-              std::find(alt_alleles.begin(), alt_alleles.end(), alt_allele) !=
-              alt_alleles.end();
-        // If the read supports an alt we are currently considering, return the
-        // associated allele frequency.
-        if (read_name == key && alt_in_alt_alleles) {
-          auto it = dv_call.allele_frequency().find(alt_allele);
-          if (it != dv_call.allele_frequency().end())
-            return it->second;
-          else
-            return 0;
-        }
-      }
+                                 const vector<int>& supported_alts,
+                                 const vector<string>& alt_alleles) {
+  for (int alt_index : supported_alts) {
+    const string& alt_allele = dv_call.variant().alternate_bases(alt_index);
+    if (IsInAltAlleles(alt_allele, alt_alleles)) {
+      auto it = dv_call.allele_frequency().find(alt_allele);
+      if (it != dv_call.allele_frequency().end())
+        return it->second;
+      else
+        return 0;
     }
   }
   // If cannot find the matching variant, set the frequency to 0.
   return 0;
 }
 
+// Returns an integer uniformly distributed in [0, n). The values are drawn
+// from rng exactly like numpy.random.RandomState.randint(0, n) draws them from
+// its own Mersenne Twister, so that seeding rng like the RandomState yields
+// the same sequence of values.
+uint32_t NumpyCompatibleRandInt(std::mt19937* rng, uint32_t n) {
+  const uint32_t max_value = n - 1;
+  if (max_value == 0) return 0;
+  uint32_t mask = max_value;
+  mask |= mask >> 1;
+  mask |= mask >> 2;
+  mask |= mask >> 4;
+  mask |= mask >> 8;
+  mask |= mask >> 16;
+  uint32_t value;
+  do {
+    value = (*rng)() & mask;
+  } while (value > max_value);
+  return value;
+}
+
+// An encoded read along with the keys it is sorted by in the pileup.
+struct PileupRow {
+  int haplotype;
+  int64_t position;
+  std::unique_ptr<EncodedRead> read;
+};
+
 }  // namespace
 
 
@@ -151,6 +175,31 @@ ImageRow::ImageRow(int width,
       use_allele_frequency(use_allele_frequency)
 {}
 
+PileupImage::PileupImage(int height, int width, int num_channels)
+    : height(height),
+      width(width),
+      num_channels(num_channels),
+      data(static_cast<size_t>(height) * width * num_channels, 0) {}
+
+void PileupImage::SetRow(int row, const ImageRow& img_row) {
+  CHECK_EQ(img_row.Width(), width);
+  CHECK_EQ(img_row.num_channels, num_channels);
+  CHECK(0 <= row && row < height) << "Row " << row << " is out of bounds";
+  unsigned char* cur =
+      data.data() + static_cast<size_t>(row) * width * num_channels;
+  for (int i = 0; i < width; i++) {
+    *cur++ = img_row.base[i];
+    *cur++ = img_row.base_quality[i];
+    *cur++ = img_row.mapping_quality[i];
+    *cur++ = img_row.on_positive_strand[i];
+    *cur++ = img_row.supports_alt[i];
+    *cur++ = img_row.matches_ref[i];
+    if (img_row.use_allele_frequency) {
+      *cur++ = img_row.allele_frequency[i];
+    }
+  }
+}
+
 int ImageRow::Width() const {
   CHECK(base.size() == base_quality.size() &&
         base.size() == mapping_quality.size() &&
@@ -250,23 +299,33 @@ PileupImageEncoderNative::EncodeRead(const DeepVariantCall& dv_call,
                                      const Read& read,
                                      int image_start_pos,
                                      const vector<string>& alt_alleles) {
-  ImageRow img_row(ref_bases.size(),
-                   options_.num_channels(),
-                   options_.use_allele_frequency());
-  const int supports_alt = ReadSupportsAlt(dv_call, read, alt_alleles);
+  std::unique_ptr<EncodedRead> encoded_read =
+      EncodeAlleleIndependentChannels(dv_call, ref_bases, read,
+                                      image_start_pos);
+  if (encoded_read == nullptr) {
+    return nullptr;
+  }
+  SetAlleleDependentChannels(dv_call, alt_alleles, encoded_read.get());
+  return std::move(encoded_read->row);
+}
+
+std::unique_ptr<EncodedRead>
+PileupImageEncoderNative::EncodeAlleleIndependentChannels(
+    const DeepVariantCall& dv_call, const string& ref_bases, const Read& read,
+    int image_start_pos) {
+  auto encoded_read = std::unique_ptr<EncodedRead>(new EncodedRead());
+  encoded_read->row = std::unique_ptr<ImageRow>(new ImageRow(
+      ref_bases.size(), options_.num_channels(),
+      options_.use_allele_frequency()));
+  ImageRow& img_row = *encoded_read->row;
   const int mapping_quality = read.alignment().mapping_quality();
   const bool is_forward_strand = !read.alignment().position().reverse_strand();
-  const uint8 alt_color = SupportsAltColor(supports_alt);
   const uint8 mapping_color = MappingQualityColor(mapping_quality);
   const uint8 strand_color = StrandColor(is_forward_strand);
   const int min_base_quality = options_.read_requirements().min_base_quality();
   const int min_mapping_quality =
       options_.read_requirements().min_mapping_quality();
 
-  const float allele_frequency = (options_.use_allele_frequency())?
-      ReadAlleleFrequency(dv_call, read, alt_alleles) : 0;
-  const uint8 allele_frequency_color = AlleleFrequencyColor(allele_frequency);
-
   // Bail early if this read's mapping quality is too low.
   if (mapping_quality < min_mapping_quality) {
     return nullptr;
@@ -309,11 +368,10 @@ PileupImageEncoderNative::EncodeRead(const DeepVariantCall& dv_call,
       img_row.base_quality[col]       = BaseQualityColor(base_quality);
       img_row.mapping_quality[col]    = mapping_color;
       img_row.on_positive_strand[col] = strand_color;
-      img_row.supports_alt[col]       = alt_color;
       img_row.matches_ref[col]        = MatchesRefColor(matches_ref);
-      if (img_row.use_allele_frequency) {
-        img_row.allele_frequency[col] = allele_frequency_color;
-      }
+      // supports_alt and allele_frequency are drawn for these columns by
+      // SetAlleleDependentChannels.
+      encoded_read->columns.push_back(col);
     }
     return true;
   };
@@ -401,7 +459,28 @@ PileupImageEncoderNative::EncodeRead(const DeepVariantCall& dv_call,
     }
   }
 
-  return std::unique_ptr<ImageRow>(new ImageRow(img_row));
+  encoded_read->supported_alts = SupportedAltIndices(dv_call, read);
+  return encoded_read;
+}
+
+void PileupImageEncoderNative::SetAlleleDependentChannels(
+    const DeepVariantCall& dv_call, const vector<string>& alt_alleles,
+    EncodedRead* encoded_read) const {
+  const uint8 alt_color = SupportsAltColor(
+      ReadSupportsAlt(dv_call, encoded_read->supported_alts, alt_alleles));
+  const float allele_frequency =
+      (options_.use_allele_frequency())
+          ? ReadAlleleFrequency(dv_call, encoded_read->supported_alts,
+                                alt_alleles)
+          : 0;
+  const uint8 allele_frequency_color = AlleleFrequencyColor(allele_frequency);
+  ImageRow& img_row = *encoded_read->row;
+  for (int col : encoded_read->columns) {
+    img_row.supports_alt[col] = alt_color;
+    if (img_row.use_allele_frequency) {
+      img_row.allele_frequency[col] = allele_frequency_color;
+    }
+  }
 }
 
 
@@ -434,6 +513,113 @@ PileupImageEncoderNative::EncodeReference(const string& ref_bases) {
   return std::unique_ptr<ImageRow>(new ImageRow(img_row));
 }
 
+int PileupImageEncoderNative::HaplotypeSortKey(const Read& read) const {
+  // By default, reads with no HP are set to 0.
+  const auto hp = read.info().find("HP");
+  if (hp == read.info().end() || hp->second.values_size() == 0) {
+    return 0;
+  }
+  const Value& hp_field = hp->second.values(0);
+  if (hp_field.kind_case() != Value::kIntValue) {
+    return 0;
+  }
+  const int hp_value = hp_field.int_value();
+  const int target_hp_tag = options_.sort_by_haplotypes_sample_hp_tag();
+  if (target_hp_tag > 0 && hp_value == target_hp_tag) {
+    // Reads with the target HP tag are sorted on top of the pileup image.
+    return -1;
+  } else if (hp_value < 0) {
+    // Reads with HP < 0 are treated as untagged.
+    return 0;
+  } else {
+    return hp_value;
+  }
+}
+
+std::unique_ptr<PileupImage> PileupImageEncoderNative::BuildPileup(
+    const DeepVariantCall& dv_call, const string& ref_bases,
+    const vector<vector<nucleus::ConstProtoPtr<const Read>>>&
+        reads_for_samples,
+    int image_start_pos, const vector<string>& alt_alleles,
+    const vector<int>& sample_heights) {
+  return BuildPileups(dv_call, ref_bases, reads_for_samples, image_start_pos,
+                      {alt_alleles}, sample_heights);
+}
+
+std::unique_ptr<PileupImage> PileupImageEncoderNative::BuildPileups(
+    const DeepVariantCall& dv_call, const string& ref_bases,
+    const vector<vector<nucleus::ConstProtoPtr<const Read>>>&
+        reads_for_samples,
+    int image_start_pos, const vector<vector<string>>& alt_allele_combinations,
+    const vector<int>& sample_heights) {
+  CHECK_EQ(reads_for_samples.size(), sample_heights.size());
+  const int ref_band_height = options_.reference_band_height();
+  int image_height = 0;
+  for (int sample_height : sample_heights) {
+    CHECK_GE(sample_height, ref_band_height)
+        << "Pileup height must be at least reference_band_height";
+    image_height += sample_height;
+  }
+  std::unique_ptr<PileupImage> images(new PileupImage(
+      image_height * alt_allele_combinations.size(), ref_bases.size(),
+      options_.num_channels()));
+  const std::unique_ptr<ImageRow> ref_row = EncodeReference(ref_bases);
+
+  int sample_start = 0;
+  for (size_t sample = 0; sample < reads_for_samples.size(); ++sample) {
+    // Reservoir sample the encodable reads (Algorithm R), using a fresh random
+    // number generator for every sample like the Python implementation. Which
+    // reads are encodable doesn't depend on the alt alleles, so the same reads
+    // are kept for every combination.
+    const size_t max_reads = sample_heights[sample] - ref_band_height;
+    std::mt19937 rng(options_.random_seed());
+    vector<PileupRow> sampled;
+    sampled.reserve(std::min(max_reads, reads_for_samples[sample].size()));
+    uint32_t n_encoded = 0;
+    for (const auto& wrapped_read : reads_for_samples[sample]) {
+      const Read& read = *(wrapped_read.p_);
+      std::unique_ptr<EncodedRead> encoded_read =
+          EncodeAlleleIndependentChannels(dv_call, ref_bases, read,
+                                          image_start_pos);
+      if (encoded_read == nullptr) continue;
+      PileupRow pileup_row{
+          options_.sort_by_haplotypes() ? HaplotypeSortKey(read) : 0,
+          read.alignment().position().position(), std::move(encoded_read)};
+      if (sampled.size() < max_reads) {
+        sampled.push_back(std::move(pileup_row));
+      } else {
+        const uint32_t j = NumpyCompatibleRandInt(&rng, n_encoded + 1);
+        if (j < max_reads) {
+          sampled[j] = std::move(pileup_row);
+        }
+      }
+      ++n_encoded;
+    }
+
+    std::stable_sort(sampled.begin(), sampled.end(),
+                     [](const PileupRow& a, const PileupRow& b) {
+                       return std::make_pair(a.haplotype, a.position) <
+                              std::make_pair(b.haplotype, b.position);
+                     });
+
+    // Only the supports_alt and allele_frequency channels differ between the
+    // images of different alt allele combinations.
+    for (size_t i = 0; i < alt_allele_combinations.size(); ++i) {
+      int row = i * image_height + sample_start;
+      for (int j = 0; j < ref_band_height; ++j) {
+        images->SetRow(row++, *ref_row);
+      }
+      for (PileupRow& pileup_row : sampled) {
+        SetAlleleDependentChannels(dv_call, alt_allele_combinations[i],
+                                   pileup_row.read.get());
+        images->SetRow(row++, *pileup_row.read->row);
+      }
+      // The remaining rows of this sample stay empty (all zero).
+    }
+    sample_start += sample_heights[sample];
+  }
+  return images;
+}
 
 }  // namespace deepvariant
 }  // namespace genomics
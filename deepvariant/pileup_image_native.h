@@ -67,6 +67,33 @@ struct ImageRow {
                     bool use_allele_frequency);
 };
 
+// The allele-independent encoding of a read. The image row of the read for any
+// set of alt alleles is obtained by filling in the supports_alt and
+// allele_frequency channels of `row` at `columns`.
+struct EncodedRead {
+  std::unique_ptr<ImageRow> row;
+  // The image columns drawn for this read.
+  std::vector<int> columns;
+  // Indices in the candidate's alternate_bases of the alt alleles this read
+  // supports, in increasing order.
+  std::vector<int> supported_alts;
+};
+
+// A whole pileup image. The pixels are stored contiguously in row-major
+// [height, width, num_channels] order, the layout of the numpy array the
+// image is converted to.
+struct PileupImage {
+  int height;
+  int width;
+  int num_channels;
+  std::vector<unsigned char> data;
+
+  explicit PileupImage(int height, int width, int num_channels);
+
+  // Writes img_row into row `row` of this image.
+  void SetRow(int row, const ImageRow& img_row);
+};
+
 class PileupImageEncoderNative {
  public:
   // Essential API methods.
@@ -96,6 +123,57 @@ class PileupImageEncoderNative {
   // Encode the reference bases into a single row of pixels.
   std::unique_ptr<ImageRow> EncodeReference(const string& ref_bases);
 
+  // Builds the complete pileup image for dv_call in one call. For each sample,
+  // in order, the image has reference_band_height rows of encoded reference,
+  // then the encoded reads, and then empty rows up to that sample's height in
+  // sample_heights. If a sample has more encodable reads than rows, a
+  // reservoir sample of them is drawn with the same random numbers as
+  // utils.reservoir_sample using numpy.random.RandomState(random_seed). The
+  // kept reads are sorted by haplotype (if sort_by_haplotypes is set) and then
+  // by alignment position, exactly like PileupImageCreator.build_pileup.
+  std::unique_ptr<PileupImage> BuildPileup(
+      const learning::genomics::deepvariant::DeepVariantCall& dv_call,
+      const string& ref_bases,
+      const std::vector<std::vector<
+          nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>>&
+          reads_for_samples,
+      int image_start_pos, const std::vector<string>& alt_alleles,
+      const std::vector<int>& sample_heights);
+
+  // Builds the pileup images of dv_call for each of alt_allele_combinations,
+  // like BuildPileup does for a single set of alt alleles. The images are
+  // stacked vertically in the order of alt_allele_combinations. Each read is
+  // encoded and sampled only once: the combinations only differ in the
+  // supports_alt and allele_frequency channels, which are filled in per
+  // combination.
+  std::unique_ptr<PileupImage> BuildPileups(
+      const learning::genomics::deepvariant::DeepVariantCall& dv_call,
+      const string& ref_bases,
+      const std::vector<std::vector<
+          nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>>&
+          reads_for_samples,
+      int image_start_pos,
+      const std::vector<std::vector<string>>& alt_allele_combinations,
+      const std::vector<int>& sample_heights);
+
+  // Wrapper around BuildPileups that unwraps the ConstProtoPtr DeepVariantCall
+  // passed in from Python.
+  std::unique_ptr<PileupImage> BuildPileupsPython(
+      const nucleus::ConstProtoPtr<
+          const learning::genomics::deepvariant::DeepVariantCall>&
+          wrapped_dv_call,
+      const string& ref_bases,
+      const std::vector<std::vector<
+          nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>>&
+          reads_for_samples,
+      int image_start_pos,
+      const std::vector<std::vector<string>>& alt_allele_combinations,
+      const std::vector<int>& sample_heights) {
+    return BuildPileups(*(wrapped_dv_call.p_), ref_bases, reads_for_samples,
+                        image_start_pos, alt_allele_combinations,
+                        sample_heights);
+  }
+
  public:
   // Get the pixel color (int) for a base.
   int BaseColor(char base) const;
@@ -115,6 +193,24 @@ class PileupImageEncoderNative {
   int MappingQualityColor(int mapping_qual) const;
 
  private:
+  // Encodes all channels of read except supports_alt and allele_frequency,
+  // which depend on the alt alleles. Returns nullptr if the read can't be
+  // encoded, just like EncodeRead.
+  std::unique_ptr<EncodedRead> EncodeAlleleIndependentChannels(
+      const learning::genomics::deepvariant::DeepVariantCall& dv_call,
+      const string& ref_bases, const nucleus::genomics::v1::Read& read,
+      int image_start_pos);
+
+  // Fills in the supports_alt and allele_frequency channels of encoded_read
+  // for alt_alleles.
+  void SetAlleleDependentChannels(
+      const learning::genomics::deepvariant::DeepVariantCall& dv_call,
+      const std::vector<string>& alt_alleles, EncodedRead* encoded_read) const;
+
+  // Returns the key used to sort reads in the pileup by haplotype, following
+  // sort_by_haplotypes_sample_hp_tag.
+  int HaplotypeSortKey(const nucleus::genomics::v1::Read& read) const;
+
   const PileupImageOptions options_;
 };
 
@@ -1101,6 +1101,116 @@ class PileupImageForTrioCreatorEncodePileupTest(parameterized.TestCase):
                             'read2', 'read4', 'ref', 'ref', 'read2_parent2')
 
 
+class PileupImageCreatorNativeBuildPileupTest(parameterized.TestCase):
+  """Tests that the native build_pileup matches the row-by-row build."""
+
+  def _make_reads(self, n_reads):
+    reads = []
+    for i in range(n_reads):
+      bases = 'CCCCC' + ('C' if i % 3 else 'A') + 'CCCCC'
+      read = test_utils.make_read(
+          bases,
+          start=5 + (i * 7) % 4 - 2,
+          cigar='11M',
+          quals=[30 + i % 5] * len(bases),
+          mapq=40 + i % 7,
+          name='read{}'.format(i))
+      if i % 4:
+        read.info['HP'].values.add().int_value = i % 4 - 1
+      reads.append(read)
+    # A read below the mapping quality threshold can't be encoded.
+    reads.append(
+        test_utils.make_read(
+            'CCCCCACCCCC', start=5, cigar='11M', mapq=0, name='unmapped'))
+    return reads
+
+  @parameterized.parameters(
+      dict(n_reads=0, sort_by_haplotypes=False, hp_tag=0, heights=[None]),
+      dict(n_reads=3, sort_by_haplotypes=False, hp_tag=0, heights=[None]),
+      dict(n_reads=50, sort_by_haplotypes=False, hp_tag=0, heights=[None]),
+      dict(n_reads=50, sort_by_haplotypes=True, hp_tag=0, heights=[None]),
+      dict(n_reads=50, sort_by_haplotypes=True, hp_tag=2, heights=[None]),
+      dict(n_reads=50, sort_by_haplotypes=False, hp_tag=0, heights=[8, 2, 5]),
+  )
+  def test_native_build_pileup_matches_python(self, n_reads,
+                                              sort_by_haplotypes, hp_tag,
+                                              heights):
+    samples = [make_examples_utils.Sample(pileup_height=h) for h in heights]
+    pic = _make_image_creator(
+        ref_reader=None,
+        samples=samples,
+        width=11,
+        height=10,
+        reference_band_height=2,
+        sort_by_haplotypes=sort_by_haplotypes,
+        sort_by_haplotypes_sample_hp_tag=hp_tag)
+    dv_call = _make_dv_call()
+    refbases = 'CCCCCACCCCC'
+    reads_for_samples = [self._make_reads(n_reads) for _ in samples]
+
+    native_image = pic.build_pileup(
+        dv_call=dv_call,
+        refbases=refbases,
+        reads_for_samples=reads_for_samples,
+        alt_alleles=['C'])
+    # Only the native encoder builds whole images, so wrapping it makes
+    # build_pileup encode the reads one row at a time.
+    pic._encoder = mock.Mock(
+        wraps=pic._encoder, spec=['encode_read', 'encode_reference'])
+    python_image = pic.build_pileup(
+        dv_call=dv_call,
+        refbases=refbases,
+        reads_for_samples=reads_for_samples,
+        alt_alleles=['C'])
+
+    self.assertEqual(native_image.dtype, np.uint8)
+    self.assertEqual(native_image.shape, python_image.shape)
+    npt.assert_equal(native_image, python_image)
+
+  @parameterized.parameters(False, True)
+  def test_build_pileups_matches_build_pileup(self, use_allele_frequency):
+    options = dict(width=11, height=10, reference_band_height=2)
+    if use_allele_frequency:
+      options.update(
+          use_allele_frequency=True,
+          num_channels=pileup_image.default_options().num_channels + 1)
+    pic = _make_image_creator(
+        ref_reader=None, samples=[make_examples_utils.Sample()], **options)
+    dv_call = deepvariant_pb2.DeepVariantCall(
+        variant=variants_pb2.Variant(
+            reference_name='chr1',
+            start=10,
+            end=11,
+            reference_bases='A',
+            alternate_bases=['C', 'G', 'T']),
+        allele_support={
+            'C': _supporting_reads('read1/1', 'read4/1'),
+            'G': _supporting_reads('read2/1', 'read4/1'),
+            'T': _supporting_reads('read3/1', 'read5/1'),
+        },
+        allele_frequency=dict(A=0.4, C=0.1, G=0.2, T=0.3))
+    reads_for_samples = [self._make_reads(8)]
+    combinations = list(pic._alt_allele_combinations(dv_call.variant))
+
+    images = pic.build_pileups(
+        dv_call=dv_call,
+        refbases='CCCCCACCCCC',
+        reads_for_samples=reads_for_samples,
+        alt_allele_combinations=combinations)
+    self.assertLen(images, len(combinations))
+    # Compare with images encoded one read and one combination at a time.
+    pic._encoder = mock.Mock(
+        wraps=pic._encoder, spec=['encode_read', 'encode_reference'])
+    for alt_alleles, image in zip(combinations, images):
+      npt.assert_equal(
+          image,
+          pic.build_pileup(
+              dv_call=dv_call,
+              refbases='CCCCCACCCCC',
+              reads_for_samples=reads_for_samples,
+              alt_alleles=alt_alleles))
+
+
 class PileupImageCreatorTest(parameterized.TestCase):
 
   def setUp(self):
@@ -1186,8 +1296,8 @@ class PileupImageCreatorTest(parameterized.TestCase):
     self.dv_call.variant.alternate_bases[:] = ['C', 'T']
 
     with mock.patch.object(
-        self.pic, 'build_pileup', autospec=True) as mock_encoder:
-      mock_encoder.side_effect = ['mi1', 'mi2', 'mi3']
+        self.pic, 'build_pileups', autospec=True) as mock_encoder:
+      mock_encoder.return_value = ['mi1', 'mi2', 'mi3']
 
       output = self.pic.create_pileup_images(
           dv_call=self.dv_call, reads_for_samples=self.reads_for_samples)
@@ -1197,19 +1307,12 @@ class PileupImageCreatorTest(parameterized.TestCase):
           (['C', 'T'], 'mi3'),
       ], output)
 
-      def _expected_call(alts):
-        return mock.call(
-            dv_call=self.dv_call,
-            refbases=self.mock_ref_reader.query.return_value,
-            reads_for_samples=[self.mock_sam_reader.query.return_value],
-            alt_alleles=alts)
-
-      self.assertEqual(mock_encoder.call_count, 3)
-      mock_encoder.assert_has_calls([
-          _expected_call(['C']),
-          _expected_call(['T']),
-          _expected_call(['C', 'T']),
-      ])
+      # The images of all alt allele combinations are built in one call.
+      mock_encoder.assert_called_once_with(
+          dv_call=self.dv_call,
+          refbases=self.mock_ref_reader.query.return_value,
+          reads_for_samples=[self.mock_sam_reader.query.return_value],
+          alt_allele_combinations=[['C'], ['T'], ['C', 'T']])
 
   def test_create_pileup_images_with_alt_align(self):
     self.dv_call.variant.alternate_bases[:] = ['C', 'T']
@@ -1219,12 +1322,17 @@ class PileupImageCreatorTest(parameterized.TestCase):
     haplotype_alignments = {'C': 'reads for C', 'T': 'reads for T'}
 
     with mock.patch.object(
-        self.pic, 'build_pileup', autospec=True) as mock_encoder:
+        self.pic, 'build_pileups', autospec=True) as mock_encoder:
       # The represent_alt_aligned_pileups function checks for shape of the
       # arrays, so mock with actual numpy arrays here.
       arr = np.zeros((100, 221, 6))
       final_pileup = np.zeros((300, 221, 6))
-      mock_encoder.side_effect = [arr] * 9
+
+      # pylint: disable=unused-argument
+      def _build_pileups(alt_allele_combinations, **kwargs):
+        return [arr] * len(alt_allele_combinations)
+
+      mock_encoder.side_effect = _build_pileups
       self.pic._options.alt_aligned_pileup = 'rows'
 
       output = self.pic.create_pileup_images(
@@ -1238,34 +1346,32 @@ class PileupImageCreatorTest(parameterized.TestCase):
       self.assertEqual([x[1].shape for x in output],
                        [x[1].shape for x in expected_output])
 
-      def _expected_ref_based_call(alts):
+      def _expected_ref_based_call(combinations):
         return mock.call(
             dv_call=self.dv_call,
             refbases=self.mock_ref_reader.query.return_value,
             reads_for_samples=[self.mock_sam_reader.query.return_value],
-            alt_alleles=alts)
+            alt_allele_combinations=combinations)
 
-      def _expected_alt_based_call(alts, refbases, reads):
+      def _expected_alt_based_call(combinations, refbases, reads):
         return mock.call(
             dv_call=self.dv_call,
             refbases=refbases,
             reads_for_samples=[reads],
-            alt_alleles=alts,
+            alt_allele_combinations=combinations,
             custom_ref=True)
 
-      self.assertEqual(mock_encoder.call_count, 7)
+      self.assertEqual(mock_encoder.call_count, 3)
       mock_encoder.assert_has_calls(
           [
-              # Pileup for 'C':
-              _expected_ref_based_call(['C']),
-              _expected_alt_based_call(['C'], seq_for_c, 'reads for C'),
-              # Pileup for 'T':
-              _expected_ref_based_call(['T']),
-              _expected_alt_based_call(['T'], seq_for_t, 'reads for T'),
-              # Pileup for 'C/T':
-              _expected_ref_based_call(['C', 'T']),
-              _expected_alt_based_call(['C', 'T'], seq_for_c, 'reads for C'),
-              _expected_alt_based_call(['C', 'T'], seq_for_t, 'reads for T'),
+              # Pileups for 'C', 'T' and 'C/T':
+              _expected_ref_based_call([['C'], ['T'], ['C', 'T']]),
+              # Alt-aligned pileups of the combinations containing 'C':
+              _expected_alt_based_call([['C'], ['C', 'T']], seq_for_c,
+                                       'reads for C'),
+              # Alt-aligned pileups of the combinations containing 'T':
+              _expected_alt_based_call([['T'], ['C', 'T']], seq_for_t,
+                                       'reads for T'),
           ],
           any_order=True)
 
@@ -1275,7 +1381,8 @@ class PileupImageCreatorTest(parameterized.TestCase):
     haplotype_sequences = {'T': 'T' * (self.pic.width + 1)}
     haplotype_alignments = {'T': 'reads for T'}
     with mock.patch.object(
-        self.pic, 'build_pileup', autospec=True) as mock_encoder:
+        self.pic, 'build_pileups', autospec=True) as mock_encoder:
+      mock_encoder.return_value = [np.zeros((100, 221, 6))]
       self.pic._options.alt_aligned_pileup = 'rows'
       output = self.pic.create_pileup_images(
           dv_call=self.dv_call,
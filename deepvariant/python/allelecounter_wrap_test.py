@@ -68,6 +68,27 @@ class WrapAlleleCounterTest(absltest.TestCase):
     counts = allele_counter.counts()
     self.assertLen(counts, size)
 
+  def test_wrap_multi_sample(self):
+    ref = fasta.IndexedFastaReader(testdata.CHR20_FASTA)
+    sam_reader = sam.SamReader(testdata.CHR20_BAM)
+    size = 100
+    region = ranges.make_range('chr20', 10000000, 10000000 + size)
+    options = deepvariant_pb2.AlleleCounterOptions(partition_size=size)
+    reads = list(sam_reader.query(region))
+    allele_counter = _allelecounter.MultiSampleAlleleCounter(
+        ref.c_reader, region, options, ['child', 'parent'])
+    allele_counter.add_reads_for_samples([reads[::2], reads[1::2]])
+
+    self.assertEqual(['child', 'parent'], allele_counter.samples())
+    for sample, sample_reads in [('child', reads[::2]),
+                                 ('parent', reads[1::2])]:
+      expected = _allelecounter.AlleleCounter(ref.c_reader, region, options)
+      for read in sample_reads:
+        expected.add(read, sample)
+      self.assertEqual(expected.counts(), allele_counter.counts(sample))
+      self.assertEqual(expected.summary_counts(),
+                       allele_counter.summary_counts(sample))
+
 
 if __name__ == '__main__':
   absltest.main()
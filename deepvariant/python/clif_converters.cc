@@ -31,6 +31,7 @@
 
 #include "deepvariant/python/clif_converters.h"
 
+#include <cstring>
 #include <memory>
 #include <mutex>
 
@@ -88,6 +89,22 @@ PyObject* Clif_PyObjFrom(std::unique_ptr<ImageRow> img_row,
   return PyArray_Return(res);
 }
 
+PyObject* Clif_PyObjFrom(std::unique_ptr<PileupImage> image,
+                         const clif::py::PostConv& pc) {
+  // Initialize numpy C array API if needed.
+  std::call_once(import_array_flag, call_import_array);
+  if (!image) { Py_RETURN_NONE; }
+
+  npy_intp dims[] { image->height, image->width, image->num_channels };
+  PyArrayObject* res = reinterpret_cast<PyArrayObject*>(
+      PyArray_SimpleNew(3, dims, PyArray_UBYTE));
+  CHECK(res != nullptr);
+  // PileupImage already uses the numpy memory layout, so a single copy of the
+  // pixel buffer is enough.
+  std::memcpy(PyArray_DATA(res), image->data.data(), image->data.size());
+  return PyArray_Return(res);
+}
+
 }  // namespace deepvariant
 }  // namespace genomics
 }  // namespace learning
@@ -47,6 +47,12 @@ namespace deepvariant {
 PyObject* Clif_PyObjFrom(std::unique_ptr<ImageRow> img_row,
                          const ::clif::py::PostConv& pc);
 
+// CLIF use `::learning::genomics::deepvariant::PileupImage` as PileupImage
+
+// Convert a PileupImage to a numpy [height, width, num_channels] uint8 array.
+PyObject* Clif_PyObjFrom(std::unique_ptr<PileupImage> image,
+                         const ::clif::py::PostConv& pc);
+
 }  // namespace deepvariant
 }  // namespace genomics
 }  // namespace learning
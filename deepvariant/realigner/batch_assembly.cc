@@ -0,0 +1,158 @@
+/*
+ * Copyright 2018 Google LLC.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions
+ * are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright
+ *    notice, this list of conditions and the following disclaimer in the
+ *    documentation and/or other materials provided with the distribution.
+ *
+ * 3. Neither the name of the copyright holder nor the names of its
+ *    contributors may be used to endorse or promote products derived from this
+ *    software without specific prior written permission.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+#include "deepvariant/realigner/batch_assembly.h"
+
+#include <algorithm>
+#include <functional>
+#include <memory>
+
+#include "deepvariant/realigner/debruijn_graph.h"
+#include "deepvariant/realigner/fast_pass_aligner.h"
+#include "tensorflow/core/lib/core/threadpool.h"
+#include "tensorflow/core/platform/env.h"
+#include "tensorflow/core/platform/logging.h"
+
+namespace learning {
+namespace genomics {
+namespace deepvariant {
+
+using nucleus::ConstProtoPtr;
+using nucleus::genomics::v1::Range;
+using nucleus::genomics::v1::Read;
+
+namespace {
+
+// Calls fn(i) for each i in [0, n), on up to num_threads threads. Runs on the
+// calling thread if there is only one thread or one call to make.
+void ParallelFor(int n, int num_threads, const std::function<void(int)>& fn) {
+  if (num_threads <= 1 || n <= 1) {
+    for (int i = 0; i < n; ++i) {
+      fn(i);
+    }
+    return;
+  }
+  // The destructor of the pool waits for all of the scheduled calls.
+  tensorflow::thread::ThreadPool pool(tensorflow::Env::Default(),
+                                      "batch_assembly",
+                                      std::min(num_threads, n));
+  for (int i = 0; i < n; ++i) {
+    pool.Schedule([&fn, i]() { fn(i); });
+  }
+}
+
+}  // namespace
+
+std::vector<CandidateHaplotypes> AssembleWindows(
+    const std::vector<Range>& windows, const std::vector<string>& refs,
+    const std::vector<std::vector<ConstProtoPtr<const Read>>>&
+        reads_for_windows,
+    const DeBruijnGraphOptions& options, const int num_threads) {
+  CHECK_EQ(windows.size(), refs.size());
+  CHECK_EQ(windows.size(), reads_for_windows.size());
+
+  // Each window writes only to its own element, so the order of the results
+  // does not depend on the order in which the threads finish.
+  std::vector<std::vector<string>> haplotypes_for_windows(windows.size());
+  ParallelFor(windows.size(), num_threads, [&](int i) {
+    std::unique_ptr<DeBruijnGraph> graph =
+        DeBruijnGraph::Build(refs[i], reads_for_windows[i], options);
+    haplotypes_for_windows[i] = graph ? graph->CandidateHaplotypes()
+                                      : std::vector<string>({refs[i]});
+  });
+
+  std::vector<CandidateHaplotypes> windows_haplotypes;
+  for (size_t i = 0; i < windows.size(); ++i) {
+    const std::vector<string>& haplotypes = haplotypes_for_windows[i];
+    if (haplotypes.empty() ||
+        (haplotypes.size() == 1 && haplotypes[0] == refs[i])) {
+      continue;
+    }
+    CandidateHaplotypes candidate_haplotypes;
+    *candidate_haplotypes.mutable_span() = windows[i];
+    for (const string& haplotype : haplotypes) {
+      candidate_haplotypes.add_haplotypes(haplotype);
+    }
+    windows_haplotypes.push_back(candidate_haplotypes);
+  }
+  return windows_haplotypes;
+}
+
+std::vector<std::vector<Read>> AlignAssembledRegions(
+    const std::vector<AssembledRegionReference>& references,
+    const std::vector<std::vector<ConstProtoPtr<const Read>>>&
+        reads_for_regions,
+    const AlignerOptions& options, const int num_threads) {
+  CHECK_EQ(references.size(), reads_for_regions.size());
+
+  std::vector<std::vector<Read>> realigned_reads_for_regions(
+      references.size());
+  ParallelFor(references.size(), num_threads, [&](int i) {
+    const AssembledRegionReference& reference = references[i];
+    const std::vector<ConstProtoPtr<const Read>>& wrapped_reads =
+        reads_for_regions[i];
+    CHECK(!wrapped_reads.empty()) << "Assembled regions must have reads";
+
+    std::vector<Read> reads;
+    reads.reserve(wrapped_reads.size());
+    for (const auto& wrapped : wrapped_reads) {
+      reads.push_back(*(wrapped.p_));
+    }
+
+    // Read sizes may vary. We need this for aligner initialization and sanity
+    // checks.
+    AlignerOptions region_options = options;
+    region_options.set_read_size(reads[0].aligned_sequence().size());
+    region_options.set_force_alignment(false);
+
+    std::vector<string> haplotypes;
+    haplotypes.reserve(reference.haplotypes_size());
+    for (const string& haplotype : reference.haplotypes()) {
+      haplotypes.push_back(reference.ref_prefix() + haplotype +
+                           reference.ref_suffix());
+    }
+
+    FastPassAligner aligner;
+    aligner.set_options(region_options);
+    aligner.set_reference(reference.ref_prefix() + reference.ref() +
+                          reference.ref_suffix());
+    aligner.set_ref_start(reference.contig(), reference.ref_start());
+    aligner.set_ref_prefix_len(reference.ref_prefix().size());
+    aligner.set_ref_suffix_len(reference.ref_suffix().size());
+    aligner.set_haplotypes(haplotypes);
+    realigned_reads_for_regions[i] = std::move(*aligner.AlignReads(reads));
+  });
+  return realigned_reads_for_regions;
+}
+
+}  // namespace deepvariant
+}  // namespace genomics
+}  // namespace learning
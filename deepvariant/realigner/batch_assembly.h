@@ -0,0 +1,89 @@
+/*
+ * Copyright 2018 Google LLC.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions
+ * are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright
+ *    notice, this list of conditions and the following disclaimer in the
+ *    documentation and/or other materials provided with the distribution.
+ *
+ * 3. Neither the name of the copyright holder nor the names of its
+ *    contributors may be used to endorse or promote products derived from this
+ *    software without specific prior written permission.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+// Assembles and realigns all of the windows of a region with one call each,
+// on a pool of threads. The windows of a region are independent of each
+// other, so dense regions with many windows use several cores instead of
+// assembling and aligning one window after the other.
+
+#ifndef LEARNING_GENOMICS_DEEPVARIANT_REALIGNER_BATCH_ASSEMBLY_H_
+#define LEARNING_GENOMICS_DEEPVARIANT_REALIGNER_BATCH_ASSEMBLY_H_
+
+#include <vector>
+
+#include "deepvariant/protos/realigner.pb.h"
+#include "third_party/nucleus/protos/range.pb.h"
+#include "third_party/nucleus/protos/reads.pb.h"
+#include "third_party/nucleus/util/proto_ptr.h"
+#include "tensorflow/core/platform/types.h"
+
+namespace learning {
+namespace genomics {
+namespace deepvariant {
+
+using tensorflow::string;
+
+// Builds a DeBruijnGraph for each of windows, on up to num_threads threads.
+//
+// windows[i] has the reference bases refs[i] and is overlapped by the reads
+// reads_for_windows[i]. Returns, in the order of windows, the
+// CandidateHaplotypes of each window whose graph has candidate haplotypes
+// other than just its reference bases. A window without a graph has only its
+// reference bases as candidate. This gives the same result as building the
+// graphs one window at a time with DeBruijnGraph::Build.
+std::vector<CandidateHaplotypes> AssembleWindows(
+    const std::vector<nucleus::genomics::v1::Range>& windows,
+    const std::vector<string>& refs,
+    const std::vector<std::vector<
+        nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>>&
+        reads_for_windows,
+    const DeBruijnGraphOptions& options, int num_threads);
+
+// Realigns the reads of each assembled region to its candidate haplotypes
+// with a FastPassAligner, on up to num_threads threads.
+//
+// reads_for_regions[i] are the reads of the region described by
+// references[i], which must not be empty. The read size of the aligner
+// options is set to the length of the first read of each region, and reads
+// are not forced to be realigned. Returns the realigned reads of each region,
+// in the order of references.
+std::vector<std::vector<nucleus::genomics::v1::Read>> AlignAssembledRegions(
+    const std::vector<AssembledRegionReference>& references,
+    const std::vector<std::vector<
+        nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>>&
+        reads_for_regions,
+    const AlignerOptions& options, int num_threads);
+
+}  // namespace deepvariant
+}  // namespace genomics
+}  // namespace learning
+
+#endif  // LEARNING_GENOMICS_DEEPVARIANT_REALIGNER_BATCH_ASSEMBLY_H_
@@ -31,12 +31,14 @@
 
 #include "deepvariant/realigner/fast_pass_aligner.h"
 
+#include <algorithm>
 #include <fstream>
 #include <iostream>
 #include <list>
 #include <set>
 #include <sstream>
 #include <string>
+#include <utility>
 
 #include "absl/memory/memory.h"
 #include "absl/strings/str_cat.h"
@@ -54,6 +56,9 @@ void FastPassAligner::set_reference(const string& reference) {
 }
 
 void FastPassAligner::set_reads(const std::vector<string>& reads) {
+  // kmer_index_ holds views into reads_, so it has to go along with them.
+  this->kmer_index_.clear();
+  this->index_is_built_ = false;
   this->reads_ = reads;
 }
 
@@ -68,6 +73,12 @@ void FastPassAligner::set_haplotypes(const std::vector<string>& haplotypes) {
 }
 
 void FastPassAligner::set_options(const AlignerOptions& options) {
+  const int old_kmer_size = kmer_size_;
+  const uint8_t old_match_score = match_score_;
+  const uint8_t old_mismatch_penalty = mismatch_penalty_;
+  const uint8_t old_gap_opening_penalty = gap_opening_penalty_;
+  const uint8_t old_gap_extending_penalty = gap_extending_penalty_;
+
   // There is no is_set method in proto so we assume that value is set if it is
   // not zero.
   if (options.kmer_size() > 0) {
@@ -101,6 +112,18 @@ void FastPassAligner::set_options(const AlignerOptions& options) {
   CHECK_LE(similarity_threshold_, 1.0);
   CHECK_GE(max_num_of_mismatches_, 0);
   CHECK(kmer_size_ >= 3 && kmer_size_ <= 32);
+
+  // Drop state that was derived from the old options.
+  if (kmer_size_ != old_kmer_size) {
+    kmer_index_.clear();
+    index_is_built_ = false;
+  }
+  if (match_score_ != old_match_score ||
+      mismatch_penalty_ != old_mismatch_penalty ||
+      gap_opening_penalty_ != old_gap_opening_penalty ||
+      gap_extending_penalty_ != old_gap_extending_penalty) {
+    ssw_aligner_.reset();
+  }
 }
 
 void FastPassAligner::CalculateSswAlignmentScoreThreshold() {
@@ -124,21 +147,30 @@ FastPassAligner::AlignReads(
     const std::vector<nucleus::genomics::v1::Read>& reads_param) {
 
   // Copy reads
+  std::vector<string> reads;
+  reads.reserve(reads_param.size());
   for (const auto& read : reads_param) {
-    reads_.push_back(tensorflow::str_util::Uppercase(read.aligned_sequence()));
+    reads.push_back(tensorflow::str_util::Uppercase(read.aligned_sequence()));
   }
 
   CalculateSswAlignmentScoreThreshold();
 
-  // Build index
-  BuildIndex();
+  // Build index. It only depends on the reads, so it is reused when the same
+  // reads are aligned again to different haplotypes.
+  if (!index_is_built_ || reads != reads_) {
+    set_reads(reads);
+    BuildIndex();
+  }
+  read_to_haplotype_alignments_.clear();
 
   // Align reads to haplotypes using reads index. This is O(n) operation per
   // read, where n = read size.
   FastAlignReadsToHaplotypes();
 
   // Initialize ssw library. Set reference.
-  InitSswLib();
+  if (!ssw_aligner_) {
+    InitSswLib();
+  }
 
   // Align haplotypes to the reference.
   AlignHaplotypesToReference();
@@ -512,6 +544,26 @@ void FastPassAligner::RealignReadsToReference(
   }  // for
 }
 
+std::unique_ptr<std::vector<nucleus::genomics::v1::Read>>
+FastPassAligner::AlignReadsInRegion(
+    const std::vector<
+        nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>& reads,
+    const nucleus::genomics::v1::Range& region, int min_read_length) {
+  std::vector<nucleus::genomics::v1::Read> trimmed_reads;
+  trimmed_reads.reserve(reads.size());
+  for (const auto& read : reads) {
+    nucleus::genomics::v1::Read trimmed_read = TrimRead(*read.p_, region);
+    if (trimmed_read.aligned_sequence().size() >= min_read_length) {
+      trimmed_reads.push_back(std::move(trimmed_read));
+    }
+  }
+  if (trimmed_reads.empty()) {
+    return absl::make_unique<std::vector<nucleus::genomics::v1::Read>>();
+  }
+  read_size_ = trimmed_reads.front().aligned_sequence().size();
+  return AlignReads(trimmed_reads);
+}
+
 void FastPassAligner::AddKmerToIndex(tensorflow::StringPiece kmer,
                                      ReadId read_id, KmerOffset pos) {
   kmer_index_[kmer].push_back(KmerOccurrence(read_id, pos));
@@ -531,10 +583,12 @@ void FastPassAligner::AddReadToIndex(const string& read, ReadId read_id) {
 }
 
 void FastPassAligner::BuildIndex() {
+  kmer_index_.clear();
   size_t read_id = 0;
   for (const auto& read : reads_) {
     AddReadToIndex(read, ReadId(read_id++));
   }
+  index_is_built_ = true;
 }
 
 void SetPositionsMap(size_t haplotype_size,
@@ -896,6 +950,105 @@ void FastPassAligner::CalculateReadToRefAlignment(
   }  // while
 }
 
+void TrimCigar(
+    const google::protobuf::RepeatedPtrField<CigarUnit>& cigar,
+    int64_t ref_trim, int64_t ref_length,
+    google::protobuf::RepeatedPtrField<CigarUnit>* new_cigar,
+    int64_t* read_trim, int64_t* new_read_length) {
+  CHECK(new_cigar != nullptr);
+  CHECK(read_trim != nullptr);
+  CHECK(new_read_length != nullptr);
+  // First consume the ref until the trim is covered.
+  int64_t trim_remaining = ref_trim;
+  // Then consume the ref until the ref_length is covered.
+  int64_t ref_to_cover_remaining = ref_length;
+  *read_trim = 0;
+  *new_read_length = 0;
+  new_cigar->Clear();
+  for (const auto& cigar_unit : cigar) {
+    const auto op = cigar_unit.operation();
+    // Each operation moves forward in the ref, the read, or both.
+    const bool advances_ref =
+        op == CigarUnit::ALIGNMENT_MATCH || op == CigarUnit::SEQUENCE_MATCH ||
+        op == CigarUnit::DELETE || op == CigarUnit::SKIP ||
+        op == CigarUnit::SEQUENCE_MISMATCH;
+    const bool advances_read =
+        op == CigarUnit::ALIGNMENT_MATCH || op == CigarUnit::SEQUENCE_MATCH ||
+        op == CigarUnit::INSERT || op == CigarUnit::CLIP_SOFT ||
+        op == CigarUnit::SEQUENCE_MISMATCH;
+    int64_t op_length = cigar_unit.operation_length();
+    int64_t ref_step = advances_ref ? op_length : 0;
+    // First, use up each operation until the trimmed area is covered.
+    if (trim_remaining > 0) {
+      if (ref_step <= trim_remaining) {
+        // Fully apply to the trim.
+        trim_remaining -= ref_step;
+        *read_trim += advances_read ? op_length : 0;
+        continue;
+      } else {
+        // Partially apply to finish the trim.
+        ref_step -= trim_remaining;
+        *read_trim += advances_read ? trim_remaining : 0;
+        op_length = ref_step;
+        trim_remaining = 0;
+      }
+    }
+
+    // Once the trim is done, start applying cigar entries to covering the ref
+    // window.
+    if (ref_step > ref_to_cover_remaining) {
+      // Partially apply to finish the window.
+      op_length = ref_to_cover_remaining;
+    }
+    CigarUnit* new_unit = new_cigar->Add();
+    new_unit->set_operation(op);
+    new_unit->set_operation_length(op_length);
+    *new_read_length += advances_read ? op_length : 0;
+    if (ref_step > ref_to_cover_remaining) {
+      ref_to_cover_remaining = 0;
+      break;
+    }
+    ref_to_cover_remaining -= ref_step;
+  }
+}
+
+nucleus::genomics::v1::Read TrimRead(
+    const nucleus::genomics::v1::Read& read,
+    const nucleus::genomics::v1::Range& region) {
+  CHECK(read.has_alignment()) << "Read must already be aligned.";
+  const int64_t read_start = read.alignment().position().position();
+  const int64_t trim_left = std::max<int64_t>(region.start() - read_start, 0);
+  const int64_t ref_length =
+      region.end() - std::max<int64_t>(region.start(), read_start);
+
+  google::protobuf::RepeatedPtrField<CigarUnit> new_cigar;
+  int64_t read_trim = 0;
+  int64_t new_read_length = 0;
+  TrimCigar(read.alignment().cigar(), trim_left, ref_length, &new_cigar,
+            &read_trim, &new_read_length);
+
+  nucleus::genomics::v1::Read new_read(read);
+  nucleus::genomics::v1::LinearAlignment* alignment =
+      new_read.mutable_alignment();
+  if (trim_left != 0) {
+    alignment->mutable_position()->set_position(region.start());
+  }
+  const int64_t sequence_start = std::min<int64_t>(
+      read_trim, read.aligned_sequence().size());
+  new_read.set_aligned_sequence(
+      read.aligned_sequence().substr(sequence_start, new_read_length));
+  const int64_t quality_start =
+      std::min<int64_t>(read_trim, read.aligned_quality_size());
+  const int64_t quality_end = std::min<int64_t>(
+      read.aligned_quality_size(), read_trim + new_read_length);
+  new_read.mutable_aligned_quality()->Clear();
+  for (int64_t i = quality_start; i < quality_end; ++i) {
+    new_read.add_aligned_quality(read.aligned_quality(i));
+  }
+  alignment->mutable_cigar()->Swap(&new_cigar);
+  return new_read;
+}
+
 }  // namespace deepvariant
 }  // namespace genomics
 }  // namespace learning
@@ -43,7 +43,9 @@
 #include "absl/container/node_hash_map.h"
 #include "absl/memory/memory.h"
 #include "third_party/nucleus/protos/cigar.pb.h"
+#include "third_party/nucleus/protos/range.pb.h"
 #include "third_party/nucleus/protos/reads.pb.h"
+#include "third_party/nucleus/util/proto_ptr.h"
 #include "tensorflow/core/lib/core/stringpiece.h"
 #include "tensorflow/core/lib/hash/hash.h"
 #include "tensorflow/core/platform/types.h"
@@ -215,6 +217,24 @@ void SetPositionsMap(size_t haplotype_size,
 
 void MergeCigarOp(const CigarOp& op, int read_len, std::list<CigarOp>* cigar);
 
+// Trim a cigar to a certain reference length. ref_trim reference bases are
+// trimmed off the beginning and at most ref_length reference bases are kept.
+// Sets read_trim to the number of read bases trimmed off the beginning and
+// new_read_length to the number of read bases left. This is the C++ version
+// of realigner.trim_cigar.
+void TrimCigar(
+    const google::protobuf::RepeatedPtrField<CigarUnit>& cigar,
+    int64_t ref_trim, int64_t ref_length,
+    google::protobuf::RepeatedPtrField<CigarUnit>* new_cigar,
+    int64_t* read_trim, int64_t* new_read_length);
+
+// Returns a copy of read trimmed down to the part that aligns within region.
+// Position, aligned_sequence, aligned_quality and cigar are updated. This is
+// the C++ version of realigner.trim_read.
+nucleus::genomics::v1::Read TrimRead(
+    const nucleus::genomics::v1::Read& read,
+    const nucleus::genomics::v1::Range& region);
+
 using KmerIndexType =
     absl::node_hash_map<tensorflow::StringPiece, std::vector<KmerOccurrence>,
                         tensorflow::StringPieceHasher>;
@@ -268,14 +288,30 @@ class FastPassAligner {
   // then by merging haplotype to reference cigars and reads to haplotype
   // cigars.
   // This function is an entry point for FastPassAligner.
+  // The same aligner may be reused: the k-mer index of the reads and the SSW
+  // aligner are kept between calls and only rebuilt when the reads (or the
+  // options they depend on) change, so realigning the same reads to another
+  // set of haplotypes only redoes the haplotype side of the work.
   std::unique_ptr<std::vector<nucleus::genomics::v1::Read>> AlignReads(
       const std::vector<nucleus::genomics::v1::Read>& reads_param);
 
+  // Trim reads to region, drop the ones that have fewer than min_read_length
+  // bases left and align the rest with AlignReads. The read size used for the
+  // SSW score threshold is the length of the first trimmed read. Reads are
+  // taken by pointer, so each read is copied only once, by TrimRead.
+  std::unique_ptr<std::vector<nucleus::genomics::v1::Read>> AlignReadsInRegion(
+      const std::vector<
+          nucleus::ConstProtoPtr<const nucleus::genomics::v1::Read>>& reads,
+      const nucleus::genomics::v1::Range& region, int min_read_length);
+
   // Build K-mer index for all reads.
   void BuildIndex();
 
   KmerIndexType GetKmerIndex() const { return kmer_index_; }
 
+  // Returns true if the k-mer index is up to date with the current reads.
+  bool is_index_built() const { return index_is_built_; }
+
   // Align all reads to a haplotype using fast pass alignment.
   void FastAlignReadsToHaplotype(
       const string& haplotype, int* haplotype_score,
@@ -356,6 +392,9 @@ class FastPassAligner {
   // Vector of reads that need to be realigned
   std::vector<string> reads_;
 
+  // True if kmer_index_ was built from reads_ with the current kmer_size_.
+  bool index_is_built_ = false;
+
   // K-mer size that is used for indexing input reads
   int kmer_size_ = 32;
 
@@ -44,6 +44,7 @@
 #include "third_party/nucleus/protos/reads.pb.h"
 #include "third_party/nucleus/testing/protocol-buffer-matchers.h"
 #include "third_party/nucleus/testing/test_utils.h"
+#include "third_party/nucleus/util/utils.h"
 
 namespace learning {
 namespace genomics {
@@ -902,6 +903,66 @@ TEST_F(FastPassAlignerTest, Integration_Test) {
                                                    expected_realigned_reads));
 }
 
+// Realigning the same reads with a reused aligner keeps the reads index and
+// gives the same result as a fresh aligner.
+TEST_F(FastPassAlignerTest, ReusedAlignerKeepsIndex_Test) {
+  std::vector<nucleus::genomics::v1::Read> reads =
+      LoadReadProtosFromFile("reads.pbtxt");
+  std::vector<nucleus::genomics::v1::Read> expected_realigned_reads =
+      LoadReadProtosFromFile("realigned_reads.pbtxt");
+  string reference;
+  LoadReferenceFromFile("reference.pbtxt", &reference);
+  std::vector<string> haplotypes;
+  LoadHaplotypesFromFile("haplotypes.pbtxt", &haplotypes);
+
+  AlignerOptions aligner_options;
+  aligner_options.set_read_size(148);
+  aligner_options.set_kmer_size(32);
+  aligner_options.set_realignment_similarity_threshold(0.85);
+  aligner_options.set_max_num_of_mismatches(3);
+  aligner_.set_options(aligner_options);
+  aligner_.set_reference(reference);
+  aligner_.set_ref_start("20", 38091533);
+
+  // First pass against the reference only, then against all haplotypes.
+  aligner_.set_haplotypes({reference});
+  aligner_.AlignReads(reads);
+  EXPECT_TRUE(aligner_.is_index_built());
+  KmerIndexType index = aligner_.GetKmerIndex();
+
+  aligner_.set_haplotypes(haplotypes);
+  std::unique_ptr<std::vector<nucleus::genomics::v1::Read>> realigned_reads =
+      aligner_.AlignReads(reads);
+  EXPECT_EQ(aligner_.GetKmerIndex(), index);
+  EXPECT_THAT(*realigned_reads, testing::Pointwise(::nucleus::EqualsProto(),
+                                                   expected_realigned_reads));
+
+  // A different set of reads invalidates the index.
+  reads.pop_back();
+  aligner_.AlignReads(reads);
+  EXPECT_EQ(aligner_.get_reads().size(), reads.size());
+}
+
+// The read is trimmed on both sides to the region, keeping the deletion that
+// falls inside it.
+TEST(TrimReadTest, TrimsToRegion) {
+  nucleus::genomics::v1::Read read =
+      nucleus::MakeRead("chr1", 8, "ACGTACGTAC", {"4M", "2D", "6M"});
+  nucleus::genomics::v1::Read trimmed =
+      TrimRead(read, nucleus::MakeRange("chr1", 10, 16));
+
+  EXPECT_EQ(trimmed.alignment().position().position(), 10);
+  EXPECT_EQ(trimmed.aligned_sequence(), "GTAC");
+  EXPECT_EQ(trimmed.aligned_quality_size(), 4);
+  ASSERT_EQ(trimmed.alignment().cigar_size(), 3);
+  EXPECT_EQ(trimmed.alignment().cigar(0).operation_length(), 2);
+  EXPECT_EQ(trimmed.alignment().cigar(1).operation(), CigarUnit::DELETE);
+  EXPECT_EQ(trimmed.alignment().cigar(2).operation_length(), 2);
+  // Everything else is carried over and the original read is untouched.
+  EXPECT_EQ(trimmed.fragment_name(), read.fragment_name());
+  EXPECT_EQ(read.aligned_sequence(), "ACGTACGTAC");
+}
+
 // Test that ssw_alignment_score_threshold does not go negative if similarity
 // threshold is less than 0.5.
 TEST_F(FastPassAlignerTest, CalculateSswAlignmentScoreThreshold_Test) {
@@ -0,0 +1,163 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for deepvariant.realigner.python.batch_assembly."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from absl.testing import absltest
+from absl.testing import parameterized
+
+from third_party.nucleus.io import fasta
+from third_party.nucleus.io import sam
+from third_party.nucleus.util import ranges
+from deepvariant import testdata
+from deepvariant.protos import realigner_pb2
+from deepvariant.realigner.python import batch_assembly
+from deepvariant.realigner.python import debruijn_graph
+from deepvariant.realigner.python import fast_pass_aligner
+
+# A window without variants, one with a heterozygous 9 bp deletion of a
+# tandem TGA repeat and one with a heterozygous 10 bp deletion.
+_WINDOWS = [
+    'chr20:10,000,000-10,000,100',
+    'chr20:10,095,379-10,095,500',
+    'chr20:10,046,096-10,046,267',
+]
+
+
+def setUpModule():
+  testdata.init()
+
+
+class BatchAssemblyWrapTest(parameterized.TestCase):
+
+  def setUp(self):
+    self.ref_reader = fasta.IndexedFastaReader(testdata.CHR20_FASTA)
+    self.bam_reader = sam.SamReader(testdata.CHR20_BAM)
+    self.windows = [ranges.parse_literal(w) for w in _WINDOWS]
+    self.refs = [self.ref_reader.query(w) for w in self.windows]
+    self.reads_for_windows = [
+        list(self.bam_reader.query(w)) for w in self.windows
+    ]
+
+  def dbg_options(self):
+    return realigner_pb2.DeBruijnGraphOptions(
+        min_k=10,
+        max_k=101,
+        step_k=1,
+        min_mapq=14,
+        min_base_quality=15,
+        min_edge_weight=2,
+        max_num_paths=256)
+
+  def aln_options(self):
+    return realigner_pb2.AlignerOptions(
+        match=4,
+        mismatch=6,
+        gap_open=8,
+        gap_extend=2,
+        k=23,
+        error_rate=.01,
+        max_num_of_mismatches=2,
+        realignment_similarity_threshold=0.16934,
+        kmer_size=32)
+
+  @parameterized.parameters(0, 1, 2, 8)
+  def test_assemble_windows(self, num_threads):
+    expected = []
+    for window, ref, reads in zip(self.windows, self.refs,
+                                  self.reads_for_windows):
+      graph = debruijn_graph.build(ref, reads, self.dbg_options())
+      haplotypes = graph.candidate_haplotypes() if graph else [ref]
+      if haplotypes and haplotypes != [ref]:
+        expected.append(
+            realigner_pb2.CandidateHaplotypes(
+                span=window, haplotypes=haplotypes))
+
+    actual = batch_assembly.assemble_windows(self.windows, self.refs,
+                                             self.reads_for_windows,
+                                             self.dbg_options(), num_threads)
+
+    # The window without variants has only the reference as haplotype.
+    self.assertLen(expected, 2)
+    self.assertEqual(expected, actual)
+
+  def test_assemble_windows_without_windows(self):
+    self.assertEqual([],
+                     batch_assembly.assemble_windows([], [], [],
+                                                     self.dbg_options(), 4))
+
+  @parameterized.parameters(0, 1, 2, 8)
+  def test_align_assembled_regions(self, num_threads):
+    references = []
+    expected = []
+    for candidate_haplotypes, reads in zip(
+        batch_assembly.assemble_windows(self.windows, self.refs,
+                                        self.reads_for_windows,
+                                        self.dbg_options(), 1),
+        self.reads_for_windows[1:]):
+      window = candidate_haplotypes.span
+      ref_start = window.start - 100
+      ref_prefix = self.ref_reader.query(
+          ranges.make_range(window.reference_name, ref_start, window.start))
+      ref_suffix = self.ref_reader.query(
+          ranges.make_range(window.reference_name, window.end,
+                            window.end + 100))
+      reference = realigner_pb2.AssembledRegionReference(
+          contig=window.reference_name,
+          ref_start=ref_start,
+          ref_prefix=ref_prefix,
+          ref=self.ref_reader.query(window),
+          ref_suffix=ref_suffix,
+          haplotypes=candidate_haplotypes.haplotypes)
+      references.append(reference)
+
+      options = self.aln_options()
+      options.read_size = len(reads[0].aligned_sequence)
+      aligner = fast_pass_aligner.FastPassAligner()
+      aligner.set_options(options)
+      aligner.set_reference(ref_prefix + reference.ref + ref_suffix)
+      aligner.set_ref_start(reference.contig, ref_start)
+      aligner.set_ref_prefix_len(len(ref_prefix))
+      aligner.set_ref_suffix_len(len(ref_suffix))
+      aligner.set_haplotypes(
+          [ref_prefix + h + ref_suffix for h in reference.haplotypes])
+      expected.append(aligner.realign_reads(reads))
+
+    actual = batch_assembly.align_assembled_regions(
+        references, self.reads_for_windows[1:], self.aln_options(),
+        num_threads)
+
+    self.assertEqual(expected, actual)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -39,19 +39,25 @@ from __future__ import print_function
 
 import copy
 import csv
+import hashlib
 import os
 import os.path
+import threading
+import uuid
 
 from absl import flags
 import tensorflow as tf
 
+from deepvariant import resources
 from deepvariant.protos import realigner_pb2
 from deepvariant.realigner import window_selector
+from deepvariant.realigner.python import batch_assembly
 from deepvariant.realigner.python import debruijn_graph
 from deepvariant.realigner.python import fast_pass_aligner
 from deepvariant.vendor import timer
 from google.protobuf import text_format
 from third_party.nucleus.io import sam
+from third_party.nucleus.protos import cigar_pb2
 from third_party.nucleus.util import cigar as cigar_utils
 from third_party.nucleus.util import ranges
 from third_party.nucleus.util import utils
@@ -144,6 +150,17 @@ flags.DEFINE_float(
     'realignment_similarity_threshold', 0.16934,
     'Similarity threshold used in realigner in Smith-Waterman'
     'alignment.')
+flags.DEFINE_integer(
+    'realigner_threads', 0,
+    'If > 1, the windows of a region are assembled and their reads realigned '
+    'on this many threads. Otherwise windows are processed one after the '
+    'other. Ignored when realigner_diagnostics are enabled.')
+flags.DEFINE_string(
+    'assembly_cache_dir', '',
+    'If not empty, the candidate haplotypes of each assembled window are '
+    'stored in this directory and reused when a later run assembles the same '
+    'window from the same reference, reads and de Bruijn graph options. '
+    'Ignored when realigner_diagnostics are enabled.')
 flags.DEFINE_integer('kmer_size', 32,
                      'K-mer size for fast pass alinger reads index.')
 
@@ -282,7 +299,9 @@ def realigner_config(flags_obj):
       ws_config=ws_config,
       dbg_config=dbg_config,
       aln_config=aln_config,
-      diagnostics=diagnostics)
+      diagnostics=diagnostics,
+      num_threads=flags_obj.realigner_threads,
+      assembly_cache_dir=flags_obj.assembly_cache_dir)
 
 
 class DiagnosticLogger(object):
@@ -352,6 +371,58 @@ class DiagnosticLogger(object):
           len(candidate_haplotypes), graph_building_time)
 
 
+class AssemblyCache(object):
+  """An on-disk cache of the candidate haplotypes of assembled windows.
+
+  Each window is keyed by a hash of everything its de Bruijn graph depends on:
+  the window, its reference bases, the bases, base qualities and mapping
+  quality of its reads, and the DeBruijnGraphOptions. The candidate haplotypes
+  of a window are stored as a serialized CandidateHaplotypes, with no
+  haplotypes if the window has only its reference bases as candidate.
+  """
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+
+  @property
+  def enabled(self):
+    return bool(self.cache_dir)
+
+  def key(self, window, ref, reads, dbg_config):
+    """Returns the key of the assembly of window from ref and reads."""
+    key = hashlib.sha256()
+    key.update(dbg_config.SerializeToString(deterministic=True))
+    key.update(ranges.to_literal(window).encode())
+    key.update(ref.encode())
+    for read in reads:
+      key.update(b'\0%d\0' % read.alignment.mapping_quality)
+      key.update(read.aligned_sequence.encode())
+      key.update(bytes(read.aligned_quality))
+    return key.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key)
+
+  def get(self, key):
+    """Returns the CandidateHaplotypes stored under key, or None."""
+    path = self._path(key)
+    if not tf.io.gfile.exists(path):
+      return None
+    with tf.io.gfile.GFile(path, 'rb') as f:
+      return realigner_pb2.CandidateHaplotypes.FromString(f.read())
+
+  def put(self, key, candidate_haplotypes):
+    """Stores candidate_haplotypes under key."""
+    path = self._path(key)
+    tf.io.gfile.makedirs(os.path.dirname(path))
+    # Entries are renamed into place, so processes sharing the cache never
+    # read a partially written entry.
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with tf.io.gfile.GFile(tmp_path, 'wb') as f:
+      f.write(candidate_haplotypes.SerializeToString())
+    tf.io.gfile.rename(tmp_path, path, overwrite=True)
+
+
 class AssemblyRegion(object):
   """A region to assemble, holding the region Range and the reads.
 
@@ -464,22 +535,64 @@ class Realigner(object):
     self.config = config
     self.ref_reader = ref_reader
     self.diagnostic_logger = DiagnosticLogger(self.config.diagnostics)
+    self.assembly_cache = AssemblyCache(self.config.assembly_cache_dir)
     self.shared_header = shared_header
+    # FastPassAligners reused by align_to_haplotype, one per thread, see
+    # haplotype_aligner().
+    self._haplotype_aligners = threading.local()
 
   def call_debruijn_graph(self, windows, reads):
     """Helper function to call debruijn_graph module."""
-    windows_haplotypes = []
-    # Build and process de-Bruijn graph for each window.
     sam_reader = sam.InMemorySamReader(reads)
+    windows = [
+        window for window in windows
+        if window.end - window.start <= self.config.ws_config.max_window_size
+        and self.ref_reader.is_valid(window)
+    ]
+    refs = [self.ref_reader.query(window) for window in windows]
+    reads_for_windows = [list(sam_reader.query(window)) for window in windows]
+
+    # The graphs of cached windows would be missing from the diagnostics.
+    if not self.assembly_cache.enabled or self.config.diagnostics.enabled:
+      return self._assemble_windows(windows, refs, reads_for_windows)
+
+    keys = [
+        self.assembly_cache.key(window, ref, window_reads,
+                                self.config.dbg_config)
+        for window, ref, window_reads in zip(windows, refs, reads_for_windows)
+    ]
+    cached = [self.assembly_cache.get(key) for key in keys]
+    missing = [i for i, haplotypes in enumerate(cached) if haplotypes is None]
+    assembled = {
+        ranges.to_literal(candidate_haplotypes.span): candidate_haplotypes
+        for candidate_haplotypes in self._assemble_windows(
+            [windows[i] for i in missing], [refs[i] for i in missing],
+            [reads_for_windows[i] for i in missing])
+    }
+    for i in missing:
+      # Windows with only their reference bases as candidate are not returned
+      # by _assemble_windows, and are cached without haplotypes.
+      cached[i] = assembled.get(
+          ranges.to_literal(windows[i]),
+          realigner_pb2.CandidateHaplotypes(span=windows[i]))
+      self.assembly_cache.put(keys[i], cached[i])
+    return [
+        candidate_haplotypes for candidate_haplotypes in cached
+        if candidate_haplotypes.haplotypes
+    ]
+
+  def _assemble_windows(self, windows, refs, reads_for_windows):
+    """Returns the CandidateHaplotypes of windows with non-ref haplotypes."""
+    # The graphs are only available to the diagnostics when they are built
+    # one window at a time.
+    if self.config.num_threads > 1 and not self.config.diagnostics.enabled:
+      return batch_assembly.assemble_windows(windows, refs, reads_for_windows,
+                                             self.config.dbg_config,
+                                             self.config.num_threads)
 
-    for window in windows:
-      if window.end - window.start > self.config.ws_config.max_window_size:
-        continue
-      if not self.ref_reader.is_valid(window):
-        continue
-      ref = self.ref_reader.query(window)
-      window_reads = list(sam_reader.query(window))
-
+    windows_haplotypes = []
+    # Build and process de-Bruijn graph for each window.
+    for window, ref, window_reads in zip(windows, refs, reads_for_windows):
       with timer.Timer() as t:
         graph = debruijn_graph.build(ref, window_reads, self.config.dbg_config)
       graph_building_time = t.GetDuration()
@@ -499,11 +612,16 @@ class Realigner(object):
 
     return windows_haplotypes
 
-  def call_fast_pass_aligner(self, assembled_region):
-    """Helper function to call fast pass aligner module."""
-    if not assembled_region.reads:
-      return []
+  def _assembled_region_reference(self, assembled_region):
+    """Returns the reference the reads of assembled_region are aligned to.
 
+    Args:
+      assembled_region: AssemblyRegion. A region with at least one read.
+
+    Returns:
+      realigner_pb2.AssembledRegionReference, or None if the reference after
+      the region cannot be created.
+    """
     contig = assembled_region.region.reference_name
     ref_start = max(
         0,
@@ -514,18 +632,31 @@ class Realigner(object):
         max(assembled_region.read_span.end, assembled_region.region.end) +
         _REF_ALIGN_MARGIN)
 
-    ref_prefix = self.ref_reader.query(
-        ranges.make_range(contig, ref_start, assembled_region.region.start))
-    ref = self.ref_reader.query(assembled_region.region)
+    if ref_end <= assembled_region.region.end:
+      return None
+
+    return realigner_pb2.AssembledRegionReference(
+        contig=contig,
+        ref_start=ref_start,
+        ref_prefix=self.ref_reader.query(
+            ranges.make_range(contig, ref_start,
+                              assembled_region.region.start)),
+        ref=self.ref_reader.query(assembled_region.region),
+        ref_suffix=self.ref_reader.query(
+            ranges.make_range(contig, assembled_region.region.end, ref_end)),
+        haplotypes=assembled_region.haplotypes)
+
+  def call_fast_pass_aligner(self, assembled_region):
+    """Helper function to call fast pass aligner module."""
+    if not assembled_region.reads:
+      return []
 
+    reference = self._assembled_region_reference(assembled_region)
     # If we can't create the ref suffix then return the original alignments.
-    if ref_end <= assembled_region.region.end:
+    if reference is None:
       return assembled_region.reads
-    else:
-      ref_suffix = self.ref_reader.query(
-          ranges.make_range(contig, assembled_region.region.end, ref_end))
-
-    ref_seq = ref_prefix + ref + ref_suffix
+    ref_prefix = reference.ref_prefix
+    ref_suffix = reference.ref_suffix
 
     fast_pass_realigner = fast_pass_aligner.FastPassAligner()
     # Read sizes may vary. We need this for realigner initialization and sanity
@@ -534,8 +665,8 @@ class Realigner(object):
         assembled_region.reads[0].aligned_sequence)
     self.config.aln_config.force_alignment = False
     fast_pass_realigner.set_options(self.config.aln_config)
-    fast_pass_realigner.set_reference(ref_seq)
-    fast_pass_realigner.set_ref_start(contig, ref_start)
+    fast_pass_realigner.set_reference(ref_prefix + reference.ref + ref_suffix)
+    fast_pass_realigner.set_ref_start(reference.contig, reference.ref_start)
     fast_pass_realigner.set_ref_prefix_len(len(ref_prefix))
     fast_pass_realigner.set_ref_suffix_len(len(ref_suffix))
     fast_pass_realigner.set_haplotypes([
@@ -544,7 +675,43 @@ class Realigner(object):
     ])
     return fast_pass_realigner.realign_reads(assembled_region.reads)
 
-  def realign_reads(self, reads, region):
+  def _align_assembled_regions_natively(self, assembled_regions):
+    """Realigns the reads of assembled_regions on config.num_threads threads.
+
+    Args:
+      assembled_regions: list of AssemblyRegion.
+
+    Returns:
+      The same reads, in the same order, as calling call_fast_pass_aligner on
+      each of assembled_regions.
+    """
+    # The reads of each region, with None for those realigned natively.
+    realigned_reads_for_regions = []
+    references = []
+    reads_for_references = []
+    for assembled_region in assembled_regions:
+      if not assembled_region.reads:
+        continue
+      reference = self._assembled_region_reference(assembled_region)
+      if reference is None:
+        realigned_reads_for_regions.append(assembled_region.reads)
+      else:
+        realigned_reads_for_regions.append(None)
+        references.append(reference)
+        reads_for_references.append(assembled_region.reads)
+
+    aligned = iter(
+        batch_assembly.align_assembled_regions(references,
+                                               reads_for_references,
+                                               self.config.aln_config,
+                                               self.config.num_threads))
+    realigned_reads = []
+    for reads in realigned_reads_for_regions:
+      realigned_reads.extend(next(aligned) if reads is None else reads)
+    return realigned_reads
+
+  def realign_reads(self, reads, region, allele_counter=None,
+                    stage_timer=None):
     """Run realigner.
 
     This is the main function that
@@ -564,6 +731,11 @@ class Realigner(object):
         to realign.
       region: A `third_party.nucleus.protos.Range` proto. Specifies the region
         on the genome we should process.
+      allele_counter: AlleleCounter or None. If provided, the counts of reads
+        over window_selector.allele_counting_region() that the window selector
+        uses instead of counting the reads itself.
+      stage_timer: resources.StageTimer or None. If provided, the wall time of
+        window selection, assembly and alignment is added to it.
 
     Returns:
       [realigner_pb2.CandidateHaplotypes]. Information on the list of candidate
@@ -572,38 +744,154 @@ class Realigner(object):
         reads for the region. NOTE THESE READS MAY NO LONGER BE IN THE SAME
         ORDER AS BEFORE.
     """
+    if stage_timer is None:
+      stage_timer = resources.StageTimer()
+
     # Compute the windows where we need to assemble in the region.
-    candidate_windows = window_selector.select_windows(self.config.ws_config,
-                                                       self.ref_reader, reads,
-                                                       region)
+    with stage_timer.time('select_windows'):
+      candidate_windows = window_selector.select_windows(
+          self.config.ws_config,
+          self.ref_reader,
+          reads,
+          region,
+          allele_counter=allele_counter)
+    stage_timer.add('select_windows', count=len(candidate_windows))
 
     # Assemble each of those regions.
-    candidate_haplotypes = self.call_debruijn_graph(candidate_windows, reads)
-    # Create our simple container to store candidate / read mappings.
-    assembled_regions = [AssemblyRegion(ch) for ch in candidate_haplotypes]
-
-    # Our realigned_reads start off with all of the unassigned reads.
-    realigned_reads = assign_reads_to_assembled_regions(assembled_regions,
-                                                        reads)
-
-    # Walk over each region and align the reads in that region, adding them to
-    # our realigned_reads.
-    for assembled_region in assembled_regions:
-      if flags.FLAGS.use_fast_pass_aligner:
-        realigned_reads_copy = self.call_fast_pass_aligner(assembled_region)
-      else:
-        raise ValueError('--use_fast_pass_aligner is always true. '
-                         'The older implementation is deprecated and removed.')
+    with stage_timer.time('assemble'):
+      candidate_haplotypes = self.call_debruijn_graph(candidate_windows, reads)
+    stage_timer.add('assemble', count=len(candidate_haplotypes))
 
-      realigned_reads.extend(realigned_reads_copy)
+    realigned_reads = self._align_to_candidate_haplotypes(
+        candidate_haplotypes, reads, stage_timer)
 
     self.diagnostic_logger.log_realigned_reads(region, realigned_reads,
                                                self.shared_header)
 
     return candidate_haplotypes, realigned_reads
 
-  def align_to_haplotype(self, this_haplotype, haplotypes, prefix, suffix,
-                         reads, contig, ref_start):
+  def realign_reads_jointly(self, reads_by_sample, region, stage_timer=None):
+    """Realigns the reads of several samples against shared haplotypes.
+
+    Candidate windows are selected and assembled once, from the reads of all
+    samples pooled together, and the reads of each sample are then aligned to
+    the same candidate haplotypes. This saves the window selection and
+    assembly of every sample but the first, and gives all samples the same
+    haplotypes, so an allele assembled from the reads of one sample is also
+    available to align the reads of the others.
+
+    Args:
+      reads_by_sample: list of [`third_party.nucleus.protos.Read` protos]. The
+        input reads of each sample.
+      region: A `third_party.nucleus.protos.Range` proto. Specifies the region
+        on the genome we should process.
+      stage_timer: resources.StageTimer or None. If provided, the wall time of
+        window selection, assembly and alignment is added to it.
+
+    Returns:
+      [realigner_pb2.CandidateHaplotypes]. The candidate haplotypes shared by
+        all samples.
+      A list with the realigned reads of each sample, in the order of
+        reads_by_sample. NOTE THESE READS MAY NO LONGER BE IN THE SAME ORDER
+        AS BEFORE.
+    """
+    if stage_timer is None:
+      stage_timer = resources.StageTimer()
+    reads_by_sample = [list(reads) for reads in reads_by_sample]
+    pooled_reads = [read for reads in reads_by_sample for read in reads]
+
+    with stage_timer.time('select_windows'):
+      candidate_windows = window_selector.select_windows(
+          self.config.ws_config, self.ref_reader, pooled_reads, region)
+    stage_timer.add('select_windows', count=len(candidate_windows))
+
+    with stage_timer.time('assemble'):
+      candidate_haplotypes = self.call_debruijn_graph(candidate_windows,
+                                                      pooled_reads)
+    stage_timer.add('assemble', count=len(candidate_haplotypes))
+
+    realigned_reads_by_sample = [
+        self._align_to_candidate_haplotypes(candidate_haplotypes, reads,
+                                            stage_timer)
+        for reads in reads_by_sample
+    ]
+
+    self.diagnostic_logger.log_realigned_reads(
+        region, [read for reads in realigned_reads_by_sample for read in reads],
+        self.shared_header)
+
+    return candidate_haplotypes, realigned_reads_by_sample
+
+  def _align_to_candidate_haplotypes(self, candidate_haplotypes, reads,
+                                     stage_timer):
+    """Returns reads, with those in an assembled window realigned."""
+    with stage_timer.time('align'):
+      # Create our simple container to store candidate / read mappings.
+      assembled_regions = [AssemblyRegion(ch) for ch in candidate_haplotypes]
+
+      # Our realigned_reads start off with all of the unassigned reads.
+      realigned_reads = assign_reads_to_assembled_regions(
+          assembled_regions, reads)
+
+      # Walk over each region and align the reads in that region, adding them
+      # to our realigned_reads.
+      if self.config.num_threads > 1 and flags.FLAGS.use_fast_pass_aligner:
+        realigned_reads.extend(
+            self._align_assembled_regions_natively(assembled_regions))
+      else:
+        for assembled_region in assembled_regions:
+          if flags.FLAGS.use_fast_pass_aligner:
+            realigned_reads_copy = self.call_fast_pass_aligner(
+                assembled_region)
+          else:
+            raise ValueError('--use_fast_pass_aligner is always true. '
+                             'The older implementation is deprecated and '
+                             'removed.')
+
+          realigned_reads.extend(realigned_reads_copy)
+    stage_timer.add(
+        'align', count=sum(len(r.reads) for r in assembled_regions))
+    return realigned_reads
+
+  def haplotype_aligner(self, read_size):
+    """Returns the aligner session used to align reads to haplotypes.
+
+    The same FastPassAligner is kept for all align_to_haplotype calls made by
+    this Realigner on a thread. It holds on to the k-mer index of the reads and
+    to its SSW aligner, so aligning the same reads to each alt allele of a
+    candidate only redoes the haplotype side of the work. Each thread gets its
+    own aligner, since an aligner cannot be shared by concurrent calls.
+
+    Args:
+      read_size: int. Expected read length used for the SSW score threshold,
+        or 0 to leave it to the aligner.
+
+    Returns:
+      fast_pass_aligner.FastPassAligner configured for forced alignment.
+    """
+    aligner = getattr(self._haplotype_aligners, 'aligner', None)
+    if aligner is None:
+      aligner = fast_pass_aligner.FastPassAligner()
+      self._haplotype_aligners.aligner = aligner
+    # Work on a copy so that the shared aln_config used for regular
+    # realignment is left untouched.
+    aln_config = realigner_pb2.AlignerOptions()
+    aln_config.CopyFrom(self.config.aln_config)
+    aln_config.read_size = read_size
+    aln_config.force_alignment = True
+    aligner.set_options(aln_config)
+    return aligner
+
+  def align_to_haplotype(self,
+                         this_haplotype,
+                         haplotypes,
+                         prefix,
+                         suffix,
+                         reads,
+                         contig,
+                         ref_start,
+                         trim_region=None,
+                         min_read_length=0):
     """Align reads to a given haplotype, not necessarily the reference.
 
     Align reads to a graph of haplotypes, reporting the alignments relative
@@ -621,17 +909,23 @@ class Realigner(object):
       contig: string. Name of the 'reference' to report in read alignments.
       ref_start: integer. Start position of the region to report in read
         alignments. This should mark the beginning of the prefix sequence.
+      trim_region: optional nucleus.genomics.v1.Range. If given, reads are
+        trimmed to this region natively before alignment, as trim_read would,
+        without copying them in Python.
+      min_read_length: integer. With trim_region, reads with fewer bases left
+        after trimming are not aligned.
 
     Returns:
       Reads. Realigned and reported relative to the chosen haplotype.
     """
     if not reads:
       return []
-    fast_pass_realigner = fast_pass_aligner.FastPassAligner()
-    aln_config = self.config.aln_config
-    aln_config.read_size = len(reads[0].aligned_sequence)
-    aln_config.force_alignment = True
-    fast_pass_realigner.set_options(aln_config)
+    if trim_region is None:
+      read_size = len(reads[0].aligned_sequence)
+    else:
+      # The aligner takes the read size from the first trimmed read.
+      read_size = 0
+    fast_pass_realigner = self.haplotype_aligner(read_size)
     fast_pass_realigner.set_reference(prefix + this_haplotype + suffix)
     fast_pass_realigner.set_ref_start(contig, ref_start)
 
@@ -646,6 +940,9 @@ class Realigner(object):
     fast_pass_realigner.set_ref_suffix_len(len(suffix) - central_allele_margin)
     extended_haplotypes = [prefix + target + suffix for target in haplotypes]
     fast_pass_realigner.set_haplotypes(extended_haplotypes)
+    if trim_region is not None:
+      return fast_pass_realigner.realign_reads_in_region(
+          reads, trim_region, min_read_length)
     return fast_pass_realigner.realign_reads(reads)
 
 
@@ -675,7 +972,9 @@ def trim_cigar(cigar, ref_trim, ref_length):
   new_cigar = []
   new_read_length = 0
   for cigar_unit in cigar:
-    c = copy.deepcopy(cigar_unit)
+    c = cigar_pb2.CigarUnit(
+        operation=cigar_unit.operation,
+        operation_length=cigar_unit.operation_length)
     # Each operation moves forward in the ref, the read, or both.
     advances_ref = c.operation in cigar_utils.REF_ADVANCING_OPS
     advances_read = c.operation in cigar_utils.READ_ADVANCING_OPS
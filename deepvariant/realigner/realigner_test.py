@@ -39,6 +39,7 @@ if 'google' in sys.modules and 'google.protobuf' not in sys.modules:
 import csv
 import itertools
 import os
+import threading
 
 
 from absl import flags
@@ -52,6 +53,7 @@ from deepvariant import testdata
 from deepvariant.protos import realigner_pb2
 from deepvariant.realigner import realigner
 from deepvariant.realigner import utils
+from deepvariant.realigner.python import fast_pass_aligner
 from deepvariant.testing import flagsaver
 from third_party.nucleus.io import fasta
 from third_party.nucleus.io import sam
@@ -355,6 +357,93 @@ class RealignerTest(parameterized.TestCase):
           ref_pos >= variant.end):
         self.assertTrue(has_variant)
 
+  def test_realign_reads_jointly(self):
+    region = ranges.parse_literal('chr20:10,046,080-10,046,307')
+    reads = _get_reads(region)
+    reads_by_sample = [reads[::2], reads[1::2]]
+
+    windows_haplotypes, realigned_reads_by_sample = (
+        self.reads_realigner.realign_reads_jointly(reads_by_sample, region))
+
+    # The haplotypes are assembled from the reads of both samples.
+    expected_haplotypes, _ = self.reads_realigner.realign_reads(reads, region)
+    self.assertEqual([w.span for w in expected_haplotypes],
+                     [w.span for w in windows_haplotypes])
+    for expected, actual in zip(expected_haplotypes, windows_haplotypes):
+      self.assertCountEqual(expected.haplotypes, actual.haplotypes)
+    # Each sample gets back its own reads, and only those.
+    self.assertLen(realigned_reads_by_sample, 2)
+    for sample_reads, realigned_reads in zip(reads_by_sample,
+                                             realigned_reads_by_sample):
+      self.assertCountEqual([r.fragment_name for r in sample_reads],
+                            [r.fragment_name for r in realigned_reads])
+
+  @parameterized.parameters(
+      'chr20:10,095,379-10,095,500',
+      'chr20:10,046,080-10,046,307',
+  )
+  def test_realign_reads_on_threads(self, region_literal):
+    region = ranges.parse_literal(region_literal)
+    reads = _get_reads(region)
+    expected_haplotypes, expected_reads = self.reads_realigner.realign_reads(
+        reads, region)
+
+    self.config.num_threads = 4
+    threaded_realigner = realigner.Realigner(self.config, self.ref_reader)
+    windows_haplotypes, realigned_reads = threaded_realigner.realign_reads(
+        reads, region)
+
+    self.assertNotEmpty(windows_haplotypes)
+    self.assertEqual(expected_haplotypes, windows_haplotypes)
+    self.assertEqual(expected_reads, realigned_reads)
+
+  def test_realign_reads_with_assembly_cache(self):
+    region = ranges.parse_literal('chr20:10,046,080-10,046,307')
+    reads = _get_reads(region)
+    expected_haplotypes, expected_reads = self.reads_realigner.realign_reads(
+        reads, region)
+
+    self.config.assembly_cache_dir = test_utils.test_tmpfile('assembly_cache')
+    cached_realigner = realigner.Realigner(self.config, self.ref_reader)
+    # The first run assembles the windows and stores them in the cache.
+    windows_haplotypes, realigned_reads = cached_realigner.realign_reads(
+        reads, region)
+    self.assertEqual(expected_haplotypes, windows_haplotypes)
+    self.assertEqual(expected_reads, realigned_reads)
+
+    window = windows_haplotypes[0].span
+    cache = cached_realigner.assembly_cache
+    key = cache.key(window, self.ref_reader.query(window),
+                    list(sam.InMemorySamReader(reads).query(window)),
+                    self.config.dbg_config)
+    self.assertEqual(windows_haplotypes[0], cache.get(key))
+
+    # Later runs use the cached haplotypes instead of assembling the window.
+    cache.put(
+        key,
+        realigner_pb2.CandidateHaplotypes(span=window, haplotypes=['ACGT']))
+    windows_haplotypes = cached_realigner.call_debruijn_graph([window], reads)
+    self.assertEqual(['ACGT'], list(windows_haplotypes[0].haplotypes))
+
+  def test_assembly_cache_key(self):
+    cache = realigner.AssemblyCache(test_utils.test_tmpfile('key_cache'))
+    window = ranges.parse_literal('chr20:10,046,096-10,046,267')
+    ref = self.ref_reader.query(window)
+    reads = _get_reads(window)
+    key = cache.key(window, ref, reads, self.config.dbg_config)
+
+    self.assertEqual(key, cache.key(window, ref, reads, self.config.dbg_config))
+    dbg_config = realigner_pb2.DeBruijnGraphOptions()
+    dbg_config.CopyFrom(self.config.dbg_config)
+    dbg_config.min_k += 1
+    self.assertNotEqual(key, cache.key(window, ref, reads, dbg_config))
+    self.assertNotEqual(
+        key, cache.key(window, ref, reads[1:], self.config.dbg_config))
+    reads[0].aligned_quality[0] += 1
+    self.assertNotEqual(
+        key, cache.key(window, ref, reads, self.config.dbg_config))
+    self.assertIsNone(cache.get(key))
+
   def test_realigner_doesnt_create_invalid_intervals(self):
     """Tests that read sets don't result in a crash in reference_fai.cc."""
     region = ranges.parse_literal('chr20:63,025,320-63,025,520')
@@ -538,6 +627,70 @@ class RealignerTest(parameterized.TestCase):
         ref_start=1)
     self.assertEqual(aligned_reads, [])
 
+  def test_align_to_haplotype_with_trim_region(self):
+    prefix = 'AGTGATCTAGTCCTTTTTGTTGTGCAAAAGGAAGTGCTAAAATCAGAATGAGAACCATGG'
+    suffix = 'ATCCATGTTCAAGTACTAATTCTGGGCAAGACACTGTTCTAAGTGCTATGAATATATTACC'
+    haplotypes = ['CATCATCAT', '']
+    reads = [
+        test_utils.make_read(
+            'GGAAGTGCTAAAATCAGAATGAGAACCATGGATCCATGTTCAAGTACTAATTCTGGGC',
+            start=30,
+            quals=[30] * 58),
+        # Too short once trimmed to the region.
+        test_utils.make_read('AGTGATCTAGTCCTTTTTGTTG', start=1),
+    ]
+    region = ranges.make_range('test', 30, 100)
+    trimmed_reads = [
+        r for r in (realigner.trim_read(r, region) for r in reads)
+        if len(r.aligned_sequence) >= 15
+    ]
+    self.assertLen(trimmed_reads, 1)
+    for hap in haplotypes:
+      expected = self.reads_realigner.align_to_haplotype(
+          hap, haplotypes, prefix, suffix, trimmed_reads, 'test', 1)
+      actual = self.reads_realigner.align_to_haplotype(
+          hap,
+          haplotypes,
+          prefix,
+          suffix,
+          reads,
+          'test',
+          1,
+          trim_region=region,
+          min_read_length=15)
+      self.assertEqual(actual, expected)
+
+  def test_align_to_haplotype_reuses_aligner(self):
+    reads = [test_utils.make_read('AAAAAAAAAAGGGGGGGGGGATTTTTTTTTTTTTCCCCC')]
+    original_aln_config = realigner_pb2.AlignerOptions()
+    original_aln_config.CopyFrom(self.reads_realigner.config.aln_config)
+    for hap in ['A', '']:
+      self.reads_realigner.align_to_haplotype(
+          this_haplotype=hap,
+          haplotypes=['A', ''],
+          prefix='AAAAAAAAAAGGGGGGGGGG',
+          suffix='TTTTTTTTTTTTTCCCCCCCCCCCCCCC',
+          reads=reads,
+          contig='test',
+          ref_start=1)
+    aligner = self.reads_realigner.haplotype_aligner(
+        len(reads[0].aligned_sequence))
+    self.assertIs(aligner, self.reads_realigner.haplotype_aligner(10))
+    # The shared options used for regular realignment are not modified.
+    self.assertEqual(self.reads_realigner.config.aln_config,
+                     original_aln_config)
+
+  def test_haplotype_aligner_per_thread(self):
+    aligner = self.reads_realigner.haplotype_aligner(10)
+    other_thread_aligners = []
+    thread = threading.Thread(
+        target=lambda: other_thread_aligners.append(
+            self.reads_realigner.haplotype_aligner(10)))
+    thread.start()
+    thread.join()
+    self.assertLen(other_thread_aligners, 1)
+    self.assertIsNot(aligner, other_thread_aligners[0])
+
 
 class RealignerIntegrationTest(absltest.TestCase):
 
@@ -735,6 +888,11 @@ class TrimTest(parameterized.TestCase):
         output.aligned_quality,
         expected_read_length,
         msg='Wrong  length of aligned_quality for case: {}'.format(comment))
+    # The native version trims the read the same way.
+    self.assertEqual(
+        fast_pass_aligner.trim_read(read, region),
+        output,
+        msg='Native trim_read differs for case: {}'.format(comment))
 
 
 if __name__ == '__main__':
@@ -40,7 +40,30 @@ from deepvariant.python import allelecounter
 from deepvariant.realigner.python import window_selector as cpp_window_selector
 
 
-def _candidates_from_reads(config, ref_reader, reads, region):
+def allele_counting_region(config, ref_reader, region):
+  """Returns the region over which alleles are counted to select windows.
+
+  Args:
+    config: learning.genomics.deepvariant.realigner.WindowSelectorOptions
+      options determining the behavior of this window selector.
+    ref_reader: GenomeReference. Indexed reference genome to query bases.
+    region: nucleus.protos.Range. The region we are processing.
+
+  Returns:
+    A nucleus.protos.Range. region expanded by config.region_expansion_in_bp on
+    both sides, clipped to the bounds of its contig.
+  """
+  return ranges.expand(
+      region,
+      config.region_expansion_in_bp,
+      contig_map=ranges.contigs_dict(ref_reader.header.contigs))
+
+
+def _candidates_from_reads(config,
+                           ref_reader,
+                           reads,
+                           region,
+                           allele_counter=None):
   """Returns a list of candidate positions.
 
   Args:
@@ -50,6 +73,10 @@ def _candidates_from_reads(config, ref_reader, reads, region):
     reads: list[nucleus.protos.Read]. The reads we are processing into candidate
       positions.
     region: nucleus.protos.Range. The region we are processing.
+    allele_counter: AlleleCounter or None. If provided, an AlleleCounter
+      spanning allele_counting_region(config, ref_reader, region) that already
+      holds the counts for reads, which is used instead of counting reads
+      again.
 
   Returns:
     A list. The elements are reference positions within region.
@@ -58,32 +85,28 @@ def _candidates_from_reads(config, ref_reader, reads, region):
     ValueError: if config.window_selector_model.model_type isn't a valid enum
     name in realigner_pb2.WindowSelectorModel.ModelType.
   """
-  allele_counter_options = deepvariant_pb2.AlleleCounterOptions(
-      read_requirements=reads_pb2.ReadRequirements(
-          min_mapping_quality=config.min_mapq,
-          min_base_quality=config.min_base_quality))
-
-  expanded_region = ranges.expand(
-      region,
-      config.region_expansion_in_bp,
-      contig_map=ranges.contigs_dict(ref_reader.header.contigs))
-
-  allele_counter = allelecounter.AlleleCounter(ref_reader.c_reader,
-                                               expanded_region,
-                                               allele_counter_options)
-
-  for read in reads:
-    allele_counter.add(read, 'dummy_sample_id')
+  counted_region = allele_counting_region(config, ref_reader, region)
+
+  if allele_counter is None:
+    allele_counter_options = deepvariant_pb2.AlleleCounterOptions(
+        read_requirements=reads_pb2.ReadRequirements(
+            min_mapping_quality=config.min_mapq,
+            min_base_quality=config.min_base_quality))
+    allele_counter = allelecounter.AlleleCounter(ref_reader.c_reader,
+                                                 counted_region,
+                                                 allele_counter_options)
+    for read in reads:
+      allele_counter.add(read, 'dummy_sample_id')
 
   model_type = config.window_selector_model.model_type
   if model_type == realigner_pb2.WindowSelectorModel.VARIANT_READS:
     return _variant_reads_threshold_selector(
         allele_counter, config.window_selector_model.variant_reads_model,
-        expanded_region)
+        counted_region)
   elif model_type == realigner_pb2.WindowSelectorModel.ALLELE_COUNT_LINEAR:
     return _allele_count_linear_selector(
         allele_counter, config.window_selector_model.allele_count_linear_model,
-        expanded_region)
+        counted_region)
   else:
     raise ValueError('Unknown enum option "{}" for '
                      'WindowSelectorModel.model_type'.format(
@@ -213,7 +236,7 @@ def _candidates_to_windows(config, candidate_pos, ref_name):
   return sorted(windows, key=ranges.as_tuple)
 
 
-def select_windows(config, ref_reader, reads, region):
+def select_windows(config, ref_reader, reads, region, allele_counter=None):
   """"Process reads to determine candidate windows for local assembly.
 
   Windows are within range of
@@ -225,6 +248,10 @@ def select_windows(config, ref_reader, reads, region):
     ref_reader: GenomeReference. Indexed reference genome to query bases.
     reads: A list of genomics.Read records.
     region: nucleus.protos.Range. The region we are processing.
+    allele_counter: AlleleCounter or None. If provided, the counts of reads
+      over allele_counting_region(config, ref_reader, region) to select windows
+      from, instead of building a new AlleleCounter using config's read
+      requirements.
 
   Returns:
     A list of nucleus.protos.Range protos sorted by their genomic position.
@@ -234,5 +261,6 @@ def select_windows(config, ref_reader, reads, region):
   if not reads:
     return []
 
-  candidates = _candidates_from_reads(config, ref_reader, reads, region)
+  candidates = _candidates_from_reads(
+      config, ref_reader, reads, region, allele_counter=allele_counter)
   return _candidates_to_windows(config, candidates, region.reference_name)
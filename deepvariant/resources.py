@@ -35,12 +35,23 @@ something like:
   with ResourceMonitor() as monitor:
     ... do work ...
     metrics = monitor.metrics()
+
+It also exposes the StageTimer class, which breaks the wall time of a piece of
+work down by named stages:
+
+  stage_timer = StageTimer()
+  with stage_timer.time('query_reads'):
+    reads = ...
+  stage_timer.add('query_reads', count=len(reads))
+  metrics = stage_timer.metrics()
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
 import platform
 import resource
 import time
@@ -128,6 +139,43 @@ class ResourceMonitor(object):
     return self.metrics_pb
 
 
+class StageTimer(object):
+  """Accumulates wall time and item counts for named stages of some work."""
+
+  def __init__(self):
+    """Constructs a StageTimer with no stages."""
+    self._stages = collections.OrderedDict()
+
+  @contextlib.contextmanager
+  def time(self, stage):
+    """Context manager adding the wall time of its body to stage."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(stage, wall_time_seconds=time.time() - start)
+
+  def add(self, stage, wall_time_seconds=0.0, count=0):
+    """Adds wall time and an item count to stage, creating it if needed."""
+    if stage not in self._stages:
+      self._stages[stage] = resources_pb2.StageMetrics(stage=stage)
+    self._stages[stage].wall_time_seconds += wall_time_seconds
+    self._stages[stage].count += count
+
+  def merge(self, stage_metrics):
+    """Adds an iterable of StageMetrics protos to the stages of this timer."""
+    for metrics in stage_metrics:
+      self.add(metrics.stage, metrics.wall_time_seconds, metrics.count)
+
+  def metrics(self):
+    """Returns a list of StageMetrics protos, in the order stages were added."""
+    return [
+        resources_pb2.StageMetrics(
+            stage=m.stage, wall_time_seconds=m.wall_time_seconds, count=m.count)
+        for m in self._stages.values()
+    ]
+
+
 # ------------------------------------------------------------------------------
 # Simple functions for getting host_name, cpu count, etc. Isolated here to make
 # them mockable.
@@ -153,5 +153,34 @@ class ResourcesTest(absltest.TestCase):
         self.assertEqual(monitor.metrics().physical_core_count, 0)
 
 
+class StageTimerTest(absltest.TestCase):
+
+  def test_time_and_counts_accumulate_per_stage(self):
+    with mock.patch.object(resources.time, 'time', side_effect=[1.0, 3.5]):
+      stage_timer = resources.StageTimer()
+      with stage_timer.time('query_reads'):
+        pass
+    stage_timer.add('query_reads', count=10)
+    stage_timer.add('call_candidates', wall_time_seconds=1.0, count=2)
+    stage_timer.add('query_reads', wall_time_seconds=0.5, count=5)
+
+    metrics = stage_timer.metrics()
+    self.assertEqual([m.stage for m in metrics],
+                     ['query_reads', 'call_candidates'])
+    self.assertEqual(metrics[0].wall_time_seconds, 3.0)
+    self.assertEqual(metrics[0].count, 15)
+    self.assertEqual(metrics[1].wall_time_seconds, 1.0)
+    self.assertEqual(metrics[1].count, 2)
+
+  def test_merge(self):
+    first = resources.StageTimer()
+    first.add('encode_pileups', wall_time_seconds=2.0, count=4)
+    totals = resources.StageTimer()
+    totals.merge(first.metrics())
+    totals.merge(first.metrics())
+    self.assertEqual(totals.metrics()[0].wall_time_seconds, 4.0)
+    self.assertEqual(totals.metrics()[0].count, 8)
+
+
 if __name__ == '__main__':
   absltest.main()
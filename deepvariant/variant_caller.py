@@ -336,7 +336,7 @@ class VariantCaller(object):
               end=elt.summary_counts.position + 1,
               calls=[call])
 
-  def calls_and_gvcfs(self, allele_counter, include_gvcfs):
+  def calls_and_gvcfs(self, allele_counter, include_gvcfs, region=None):
     """Gets variant calls and gvcf records for all sites in allele_counter.
 
     Args:
@@ -344,6 +344,10 @@ class VariantCaller(object):
         to find candidate variants and create gvcf records.
       include_gvcfs: boolean. If True, we will compute gVCF records for all of
         the AlleleCounts in AlleleCounter.
+      region: nucleus.genomics.v1.Range or None. If provided, only candidates
+        starting in region and gVCF records for sites in region are returned.
+        This allows allele_counter to span a larger interval than the region
+        being called.
 
     Returns:
       Two values. The first is a list of DeepVariantCall protos containing our
@@ -351,9 +355,20 @@ class VariantCaller(object):
       format, if include_gvcfs is True. If False, an empty list is returned.
     """
     candidates = self.get_candidates(allele_counter)
+    if region is not None:
+      candidates = [
+          candidate for candidate in candidates
+          if region.start <= candidate.variant.start < region.end
+      ]
     gvcfs = []
     if include_gvcfs:
-      gvcfs = list(self.make_gvcfs(allele_counter.summary_counts()))
+      summary_counts = allele_counter.summary_counts()
+      if region is not None:
+        summary_counts = [
+            summary for summary in summary_counts
+            if region.start <= summary.position < region.end
+        ]
+      gvcfs = list(self.make_gvcfs(summary_counts))
     return candidates, gvcfs
 
   @abc.abstractmethod
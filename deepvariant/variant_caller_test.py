@@ -45,6 +45,8 @@ import numpy as np
 import numpy.testing as npt
 import six
 
+from third_party.nucleus.protos import variants_pb2
+from third_party.nucleus.util import ranges
 from third_party.nucleus.util import variant_utils
 from third_party.nucleus.util import variantcall_utils
 from deepvariant import testdata
@@ -454,6 +456,25 @@ class VariantCallerTests(parameterized.TestCase):
     else:
       self.assertEmpty(gvcfs)
 
+  def test_calls_and_gvcfs_restricted_to_region(self):
+    counts = [(0, 0, 'A'), (10, 10, 'G'), (0, 0, 'G'), (0, 0, 'G'),
+              (10, 10, 'T')]
+    caller = DummyVariantCaller(0.01, 100)
+    allele_counter = self.fake_allele_counter(10, counts)
+    candidates = [
+        deepvariant_pb2.DeepVariantCall(
+            variant=variants_pb2.Variant(
+                reference_name='chr1', start=start, end=start + 1))
+        for start in [10, 11, 14]
+    ]
+    region = ranges.make_range('chr1', 11, 14)
+    with mock.patch.object(caller, 'get_candidates', return_value=candidates):
+      calls, gvcfs = caller.calls_and_gvcfs(
+          allele_counter, include_gvcfs=True, region=region)
+    self.assertEqual([call.variant.start for call in calls], [11])
+    self.assertEqual([(gvcf.start, gvcf.end) for gvcf in gvcfs], [(11, 12),
+                                                                   (12, 14)])
+
 
 _CACHE_COVERAGE = 20  # Outside class so we can refer to it in @Parameters.
 
@@ -128,6 +128,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
+
+import numpy as np
+
 from third_party.nucleus.io import genomics_reader
 from third_party.nucleus.io import genomics_writer
 from third_party.nucleus.io.python import sam_reader
@@ -137,6 +141,13 @@ from third_party.nucleus.util import ranges
 from third_party.nucleus.util import utils
 
 
+def _reads_starting_at(reads, min_start):
+  """Yields the reads whose alignment starts at or after min_start."""
+  for read in reads:
+    if read.alignment.position.position >= min_start:
+      yield read
+
+
 class NativeSamReader(genomics_reader.GenomicsReader):
   """Class for reading from native SAM/BAM/CRAM files.
 
@@ -240,9 +251,67 @@ class NativeSamReader(genomics_reader.GenomicsReader):
     """Returns an iterable of Read protos in the file."""
     return self._reader.iterate()
 
-  def query(self, region):
-    """Returns an iterator for going through the reads in the region."""
-    return self._reader.query(region)
+  def query(self, region, max_reads=None, random_seed=None):
+    """Returns an iterator for going through the reads in the region.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to query.
+      max_reads: None or int >= 0. If set, a uniform random sample of at most
+        this many reads is returned instead of all of them. The sample is
+        taken natively while decoding, so only the sampled reads are converted
+        to Python protos, and it is the same as
+        utils.reservoir_sample(query(region), max_reads,
+        np.random.RandomState(random_seed)).
+      random_seed: int in [0, 2**32). The seed of the sample. Required if
+        max_reads is set.
+
+    Raises:
+      ValueError: if max_reads is set without random_seed.
+    """
+    if max_reads is None:
+      return self._reader.query(region)
+    if random_seed is None:
+      raise ValueError('random_seed is required with max_reads')
+    if hasattr(self._reader, 'sample_query'):
+      return iter(self._reader.sample_query(region, max_reads, random_seed))
+    return iter(
+        utils.reservoir_sample(
+            self._reader.query(region), max_reads,
+            np.random.RandomState(random_seed)))
+
+  def query_starting_at(self, region, min_start):
+    """Returns an iterator for the reads in region starting from min_start.
+
+    Reads starting before min_start are skipped without being decoded into Read
+    protos, so this is cheaper than filtering the output of query.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to query.
+      min_start: int. Only reads whose alignment starts at or after this
+        position are returned.
+    """
+    if hasattr(self._reader, 'query_starting_at'):
+      return self._reader.query_starting_at(region, min_start)
+    return _reads_starting_at(self._reader.query(region), min_start)
+
+  def estimate_num_reads(self, region):
+    """Estimates the number of reads overlapping region from the index.
+
+    The estimate is computed from the BAM index alone, without decoding any
+    read, and is only as precise as the smallest index bins (16 kb). It is 0
+    only if there are no reads overlapping region.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to estimate.
+
+    Returns:
+      int. The estimated number of mapped reads overlapping region.
+
+    Raises:
+      ValueError: if the reads are not an indexed BAM file, or if the index has
+        no mapped read counts.
+    """
+    return self._reader.estimate_num_reads(region)
 
   def __exit__(self, exit_type, exit_value, exit_traceback):
     self._reader.__exit__(exit_type, exit_value, exit_traceback)
@@ -257,6 +326,65 @@ class SamReader(genomics_reader.DispatchingGenomicsReader):
   def _record_proto(self):
     return reads_pb2.Read
 
+  def query(self, region, max_reads=None, random_seed=None):
+    """Returns an iterator for going through the reads in the region.
+
+    See NativeSamReader.query.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to query.
+      max_reads: None or int >= 0. If set, a uniform random sample of at most
+        this many reads is returned instead of all of them.
+      random_seed: int in [0, 2**32). The seed of the sample. Required if
+        max_reads is set.
+
+    Raises:
+      ValueError: if max_reads is set without random_seed.
+    """
+    if max_reads is None:
+      return self._reader.query(region)
+    if isinstance(self._reader, NativeSamReader):
+      return self._reader.query(region, max_reads, random_seed)
+    if random_seed is None:
+      raise ValueError('random_seed is required with max_reads')
+    return iter(
+        utils.reservoir_sample(
+            self._reader.query(region), max_reads,
+            np.random.RandomState(random_seed)))
+
+  def query_starting_at(self, region, min_start):
+    """Returns an iterator for the reads in region starting from min_start.
+
+    See NativeSamReader.query_starting_at.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to query.
+      min_start: int. Only reads whose alignment starts at or after this
+        position are returned.
+    """
+    if hasattr(self._reader, 'query_starting_at'):
+      return self._reader.query_starting_at(region, min_start)
+    return _reads_starting_at(self._reader.query(region), min_start)
+
+  def estimate_num_reads(self, region):
+    """Estimates the number of reads overlapping region from the index.
+
+    See NativeSamReader.estimate_num_reads.
+
+    Args:
+      region: nucleus.genomics.v1.Range. The region to estimate.
+
+    Returns:
+      int. The estimated number of mapped reads overlapping region.
+
+    Raises:
+      ValueError: if the reads are not an indexed BAM file, or if the index has
+        no mapped read counts.
+    """
+    if not hasattr(self._reader, 'estimate_num_reads'):
+      raise ValueError('Read count estimates are only supported for BAM files')
+    return self._reader.estimate_num_reads(region)
+
 
 class NativeSamWriter(genomics_writer.GenomicsWriter):
   """Class for writing to native SAM/BAM/CRAM files.
@@ -299,6 +427,10 @@ class SamWriter(genomics_writer.DispatchingGenomicsWriter):
 class InMemorySamReader(object):
   """Python interface class for in-memory SAM/BAM/CRAM reader.
 
+  Reads are indexed by contig and alignment start whenever they are replaced,
+  so query() only visits reads that can overlap the query region instead of
+  scanning every read. Results are returned in the original order of reads.
+
   Attributes:
     reads: list[nucleus.genomics.v1.Read]. The list of in-memory reads.
     is_sorted: bool, True if reads are sorted.
@@ -311,6 +443,20 @@ class InMemorySamReader(object):
     """Replace the reads stored by this reader."""
     self.reads = reads
     self.is_sorted = is_sorted
+    self._index = self._build_index(reads)
+
+  @staticmethod
+  def _build_index(reads):
+    """Returns a dict from contig name to a _ContigIndex over reads."""
+    spans_by_contig = {}
+    for i, read in enumerate(reads):
+      read_range = utils.read_range(read)
+      spans_by_contig.setdefault(read_range.reference_name, []).append(
+          (read_range.start, read_range.end, i))
+    return {
+        contig: _ContigIndex(spans)
+        for contig, spans in spans_by_contig.items()
+    }
 
   def iterate(self):
     """Iterate over all records in the reads.
@@ -329,6 +475,37 @@ class InMemorySamReader(object):
     Returns:
       An iterator over nucleus.genomics.v1.Read protos.
     """
-    # redacted
-    return (
-        read for read in self.reads if utils.read_overlaps_region(read, region))
+    contig_index = self._index.get(region.reference_name)
+    if contig_index is None:
+      return iter([])
+    return (self.reads[i] for i in contig_index.overlapping(region))
+
+
+class _ContigIndex(object):
+  """Sorted interval index over the reads aligned to a single contig.
+
+  Reads are kept sorted by alignment start together with the longest alignment
+  span on the contig, which bounds how far to the left of a query a read can
+  start and still overlap it. Lookups cost O(log n + k) where k is the number
+  of reads starting within that bound.
+  """
+
+  def __init__(self, spans):
+    """Creates a _ContigIndex.
+
+    Args:
+      spans: list of (start, end, read_index) tuples, one per read.
+    """
+    spans.sort()
+    self._starts = [start for start, _, _ in spans]
+    self._ends = [end for _, end, _ in spans]
+    self._read_indices = [i for _, _, i in spans]
+    self._max_span = max(end - start for start, end, _ in spans)
+
+  def overlapping(self, region):
+    """Returns the sorted read indices of reads overlapping region."""
+    lo = bisect.bisect_left(self._starts, region.start - self._max_span)
+    hi = bisect.bisect_left(self._starts, region.end)
+    return sorted(self._read_indices[i]
+                  for i in range(lo, hi)
+                  if self._ends[i] > region.start)
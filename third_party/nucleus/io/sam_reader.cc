@@ -36,6 +36,8 @@
 #include <errno.h>
 #include <stdint.h>
 
+#include <algorithm>
+#include <limits>
 #include <map>
 #include <utility>
 #include <vector>
@@ -56,6 +58,7 @@
 #include "third_party/nucleus/protos/position.pb.h"
 #include "third_party/nucleus/protos/range.pb.h"
 #include "third_party/nucleus/protos/reads.pb.h"
+#include "third_party/nucleus/util/samplers.h"
 #include "third_party/nucleus/util/utils.h"
 #include "tensorflow/core/lib/core/errors.h"
 #include "tensorflow/core/lib/core/status.h"
@@ -84,6 +87,23 @@ bool FileTypeIsIndexable(htsFormat format) {
   return format.format == bam || format.format == cram;
 }
 
+// Returns the number of compressed bytes in the index chunks of the alignments
+// on tid overlapping [beg, end), or -1 if the interval is invalid.
+int64 IndexChunkBytes(const hts_idx_t* idx, int tid, int64 beg, int64 end) {
+  hts_itr_t* iter = sam_itr_queryi(idx, tid, beg, end);
+  if (iter == nullptr) return -1;
+  int64 bytes = 0;
+  for (int i = 0; i < iter->n_off; ++i) {
+    // The upper 48 bits of a virtual file offset are the offset of the
+    // compressed BGZF block, so a chunk within a single block counts as 1.
+    const int64 block_bytes = static_cast<int64>(iter->off[i].v >> 16) -
+                              static_cast<int64>(iter->off[i].u >> 16);
+    bytes += std::max<int64>(1, block_bytes);
+  }
+  hts_itr_destroy(iter);
+  return bytes;
+}
+
 void AddHeaderLineToHeader(const string& line, SamHeader& header) {
   int tagLen = 3;
 
@@ -576,16 +596,19 @@ class SamQueryIterable : public SamIterableBase {
   virtual int next_sam_record();
 
  public:
-  // Constructor will be invoked via SamReader::Query.
+  // Constructor will be invoked via SamReader::Query. Records starting before
+  // min_start are skipped.
   SamQueryIterable(const SamReader* reader,
                    htsFile* fp,
                    bam_hdr_t* header,
-                   hts_itr_t* iter);
+                   hts_itr_t* iter,
+                   int64 min_start);
 
   ~SamQueryIterable() override;
 
  private:
   hts_itr_t* iter_;
+  const int64 min_start_;
 };
 
 SamReader::SamReader(const string& reads_path, const SamReaderOptions& options,
@@ -733,6 +756,11 @@ StatusOr<std::shared_ptr<SamIterable>> SamReader::Iterate() const {
 
 StatusOr<std::shared_ptr<SamIterable>> SamReader::Query(
     const Range& region) const {
+  return QueryStartingAt(region, std::numeric_limits<int64>::min());
+}
+
+StatusOr<std::shared_ptr<SamIterable>> SamReader::QueryStartingAt(
+    const Range& region, int64 min_start) const {
   if (fp_ == nullptr)
     return tf::errors::FailedPrecondition("Cannot Query a closed SamReader.");
   if (!HasIndex()) {
@@ -756,9 +784,86 @@ StatusOr<std::shared_ptr<SamIterable>> SamReader::Query(
   }
 
     return StatusOr<std::shared_ptr<SamIterable>>(
-        MakeIterable<SamQueryIterable>(this, fp_, header_, iter));
+        MakeIterable<SamQueryIterable>(this, fp_, header_, iter, min_start));
 }
 
+StatusOr<vector<Read>> SamReader::SampleQuery(const Range& region,
+                                              int64 max_reads,
+                                              uint32 random_seed) const {
+  if (max_reads < 0) {
+    return tf::errors::InvalidArgument("max_reads must be nonnegative, got ",
+                                       max_reads);
+  }
+  StatusOr<std::shared_ptr<SamIterable>> iterable = Query(region);
+  TF_RETURN_IF_ERROR(iterable.status());
+
+  ReservoirSampler sampler(max_reads, random_seed);
+  vector<Read> sample;
+  Read read;
+  while (true) {
+    StatusOr<bool> more = iterable.ValueOrDie()->Next(&read);
+    TF_RETURN_IF_ERROR(more.status());
+    if (!more.ValueOrDie()) break;
+    const int64 slot = sampler.Slot();
+    if (slot == static_cast<int64>(sample.size())) {
+      sample.emplace_back();
+      sample.back().Swap(&read);
+    } else if (slot >= 0) {
+      sample[slot].Swap(&read);
+    }
+  }
+  return sample;
+}
+
+StatusOr<int64> SamReader::EstimateNumReads(const Range& region) const {
+  if (fp_ == nullptr)
+    return tf::errors::FailedPrecondition(
+        "Cannot EstimateNumReads on a closed SamReader.");
+  if (!HasIndex()) {
+    return tf::errors::FailedPrecondition(
+        "Cannot estimate read counts without an index");
+  }
+  if (fp_->format.format != bam) {
+    return tf::errors::Unimplemented(
+        "Read count estimates are only supported for BAM files");
+  }
+
+  const int tid = bam_name2id(header_, region.reference_name().c_str());
+  if (tid < 0) {
+    return tf::errors::NotFound(
+        "Unknown reference_name ", region.ShortDebugString());
+  }
+
+  const int64 bytes =
+      IndexChunkBytes(idx_, tid, region.start(), region.end());
+  if (bytes < 0) {
+    return tf::errors::NotFound(
+        "region '", region.ShortDebugString(),
+        "' specifies an unknown reference interval");
+  }
+  // Contigs without reads may have no read counts in the index at all.
+  if (bytes == 0) return 0;
+
+  if (reads_per_byte_.empty()) reads_per_byte_.resize(header_->n_targets, -1);
+  if (reads_per_byte_[tid] < 0) {
+    uint64_t mapped = 0, unmapped = 0;
+    if (hts_idx_get_stat(idx_, tid, &mapped, &unmapped) < 0) {
+      return tf::errors::Unimplemented(
+          "The index has no mapped read counts for ",
+          region.reference_name());
+    }
+    const int64 contig_bytes =
+        IndexChunkBytes(idx_, tid, 0, header_->target_len[tid]);
+    reads_per_byte_[tid] = contig_bytes > 0
+                               ? static_cast<double>(mapped) / contig_bytes
+                               : 0.0;
+  }
+
+  if (reads_per_byte_[tid] == 0.0) return 0;
+  // Any chunk may hold reads overlapping region, so never round them to 0.
+  return std::max<int64>(
+      1, static_cast<int64>(bytes * reads_per_byte_[tid] + 0.5));
+}
 
 tf::Status SamReader::Close() {
   if (HasIndex()) {
@@ -824,7 +929,11 @@ SamFullFileIterable::SamFullFileIterable(const SamReader* reader,
 
 
 int SamQueryIterable::next_sam_record() {
-  return sam_itr_next(fp_, iter_, bam1_);
+  int code;
+  do {
+    code = sam_itr_next(fp_, iter_, bam1_);
+  } while (code >= 0 && bam1_->core.pos < min_start_);
+  return code;
 }
 
 SamQueryIterable::~SamQueryIterable() {
@@ -834,8 +943,9 @@ SamQueryIterable::~SamQueryIterable() {
 SamQueryIterable::SamQueryIterable(const SamReader* reader,
                                    htsFile* fp,
                                    bam_hdr_t* header,
-                                   hts_itr_t* iter)
-    : SamIterableBase(reader, fp, header), iter_(iter)
+                                   hts_itr_t* iter,
+                                   int64 min_start)
+    : SamIterableBase(reader, fp, header), iter_(iter), min_start_(min_start)
 {}
 
 }  // namespace nucleus
@@ -35,6 +35,7 @@
 
 #include <memory>
 #include <string>
+#include <vector>
 
 #include "htslib/hts.h"
 #include "htslib/sam.h"
@@ -146,6 +147,42 @@ class SamReader : public Reader {
   StatusOr<std::shared_ptr<SamIterable>> Query(
       const nucleus::genomics::v1::Range& region) const;
 
+  // Gets the reads that overlap any bases in region and whose alignment starts
+  // at or after min_start.
+  //
+  // This is Query without the reads starting before min_start, which are
+  // skipped before being converted to Read protos. It lets a client that
+  // already has the reads of an abutting region avoid decoding the reads
+  // spanning the boundary again. Reads skipped this way are not counted by
+  // the downsampling of options.downsample_fraction.
+  StatusOr<std::shared_ptr<SamIterable>> QueryStartingAt(
+      const nucleus::genomics::v1::Range& region, int64 min_start) const;
+
+  // Gets a uniform random sample of at most max_reads of the reads that
+  // overlap any bases in region.
+  //
+  // The sample is taken while iterating over the reads, so only max_reads
+  // reads are kept in memory at once. It is identical to reservoir sampling
+  // the output of Query with nucleus.util.utils.reservoir_sample and
+  // numpy.random.RandomState(random_seed), including the order of the reads.
+  StatusOr<std::vector<nucleus::genomics::v1::Read>> SampleQuery(
+      const nucleus::genomics::v1::Range& region, int64 max_reads,
+      uint32 random_seed) const;
+
+  // Estimates the number of mapped reads that overlap region from the index
+  // alone, without decoding any read.
+  //
+  // The estimate is the compressed size of the index chunks that overlap
+  // region, converted to reads with the mapped read count and compressed size
+  // of the whole contig. It is only as precise as the smallest index bins
+  // (16 kb for a .bai), so it is best used on regions at least that large. The
+  // estimate is 0 only if the index has no reads overlapping region.
+  //
+  // Only BAM files with an index that records mapped read counts are
+  // supported; other inputs return a non-OK status.
+  StatusOr<int64> EstimateNumReads(
+      const nucleus::genomics::v1::Range& region) const;
+
   // Returns True if this SamReader loaded an index file.
   bool HasIndex() const { return idx_ != nullptr; }
 
@@ -192,6 +229,10 @@ class SamReader : public Reader {
 
   // For downsampling reads.
   mutable FractionalSampler sampler_;
+
+  // Mapped reads per compressed byte of each contig, indexed by tid. Filled
+  // lazily by EstimateNumReads, with negative values for contigs not yet seen.
+  mutable std::vector<double> reads_per_byte_;
 };
 
 }  // namespace nucleus
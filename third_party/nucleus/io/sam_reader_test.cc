@@ -59,6 +59,7 @@ using nucleus::proto::Partially;
 using std::vector;
 using ::testing::Eq;
 using ::testing::IsEmpty;
+using ::testing::Not;
 using ::testing::Pointwise;
 using ::testing::SizeIs;
 
@@ -204,6 +205,90 @@ TEST(SamReaderTest, TestBamSampleExtraction) {
   EXPECT_THAT(header.comments(), IsEmpty());
 }
 
+TEST(SamReaderTest, TestQueryStartingAtSkipsEarlierReads) {
+  std::unique_ptr<SamReader> reader = std::move(
+      SamReader::FromFile(GetTestData(kBamTestFilename), SamReaderOptions())
+          .ValueOrDie());
+  const Range region = MakeRange("chr20", 10000000, 10000100);
+  vector<Read> expected;
+  for (const Read& read : as_vector(reader->Query(region))) {
+    if (read.alignment().position().position() >= 10000050)
+      expected.push_back(read);
+  }
+  EXPECT_THAT(expected, Not(IsEmpty()));
+  EXPECT_THAT(as_vector(reader->QueryStartingAt(region, 10000050)),
+              Pointwise(EqualsProto(), expected));
+}
+
+TEST(SamReaderTest, TestSampleQueryKeepsAtMostMaxReads) {
+  std::unique_ptr<SamReader> reader = std::move(
+      SamReader::FromFile(GetTestData(kBamTestFilename), SamReaderOptions())
+          .ValueOrDie());
+  const Range region = MakeRange("chr20", 10000000, 10000100);
+  const vector<Read> all_reads = as_vector(reader->Query(region));
+  ASSERT_THAT(all_reads, SizeIs(106));
+
+  // Asking for more reads than there are returns all of them in order.
+  EXPECT_THAT(reader->SampleQuery(region, 1000, 1).ValueOrDie(),
+              Pointwise(EqualsProto(), all_reads));
+  EXPECT_THAT(reader->SampleQuery(region, 0, 1).ValueOrDie(), IsEmpty());
+
+  const vector<Read> sample = reader->SampleQuery(region, 10, 1).ValueOrDie();
+  EXPECT_THAT(sample, SizeIs(10));
+  for (const Read& read : sample) {
+    EXPECT_THAT(all_reads, ::testing::Contains(EqualsProto(read)));
+  }
+  // The same seed gives the same sample.
+  EXPECT_THAT(reader->SampleQuery(region, 10, 1).ValueOrDie(),
+              Pointwise(EqualsProto(), sample));
+  EXPECT_THAT(reader->SampleQuery(region, -1, 1),
+              IsNotOKWithCodeAndMessage(tensorflow::error::INVALID_ARGUMENT,
+                                        "max_reads must be nonnegative"));
+}
+
+TEST(SamReaderTest, TestEstimateNumReadsFromIndex) {
+  std::unique_ptr<SamReader> reader = std::move(
+      SamReader::FromFile(GetTestData(kBamTestFilename), SamReaderOptions())
+          .ValueOrDie());
+  // All 106 reads of test.bam are on chr20 between 9,999,911 and 10,000,093,
+  // so a region spanning all of them gets exactly the mapped read count.
+  EXPECT_THAT(reader->EstimateNumReads(MakeRange("chr20", 9990000, 10010000))
+                  .ValueOrDie(),
+              Eq(106));
+  EXPECT_THAT(reader->EstimateNumReads(MakeRange("chr20", 9999911, 9999912))
+                  .ValueOrDie(),
+              ::testing::Gt(0));
+  EXPECT_THAT(reader->EstimateNumReads(MakeRange("chr20", 20000000, 20100000))
+                  .ValueOrDie(),
+              Eq(0));
+  EXPECT_THAT(
+      reader->EstimateNumReads(MakeRange("chr1", 0, 100000)).ValueOrDie(),
+      Eq(0));
+  EXPECT_THAT(reader->EstimateNumReads(MakeRange("chrFoo", 0, 100)),
+              IsNotOKWithCodeAndMessage(tensorflow::error::NOT_FOUND,
+                                        "Unknown reference_name"));
+}
+
+TEST(SamReaderTest, TestEstimateNumReadsRequiresIndexedBam) {
+  std::unique_ptr<SamReader> unindexed = std::move(
+      SamReader::FromFile(GetTestData("unindexed.bam"), SamReaderOptions())
+          .ValueOrDie());
+  EXPECT_THAT(unindexed->EstimateNumReads(MakeRange("chr20", 0, 100)),
+              IsNotOKWithCodeAndMessage(
+                  tensorflow::error::FAILED_PRECONDITION,
+                  "Cannot estimate read counts without an index"));
+
+  std::unique_ptr<SamReader> cram = std::move(
+      SamReader::FromFile(
+          GetTestData("test_cram.embed_ref_1_version_3.0.cram"),
+          SamReaderOptions())
+          .ValueOrDie());
+  EXPECT_THAT(cram->EstimateNumReads(MakeRange("chr20", 0, 100)),
+              IsNotOKWithCodeAndMessage(
+                  tensorflow::error::UNIMPLEMENTED,
+                  "only supported for BAM files"));
+}
+
 TEST(SamReaderTest, TestHeaderlessSamIsNotOkay) {
   StatusOr<std::unique_ptr<SamReader>> status = SamReader::FromFile(
       GetTestData("headerless.sam"), SamReaderOptions());
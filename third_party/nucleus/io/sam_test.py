@@ -41,6 +41,7 @@ import itertools
 from absl.testing import absltest
 from absl.testing import parameterized
 
+import numpy as np
 import six
 
 from tensorflow.python.platform import gfile
@@ -50,6 +51,7 @@ from third_party.nucleus.protos import reads_pb2
 from third_party.nucleus.protos import reference_pb2
 from third_party.nucleus.testing import test_utils
 from third_party.nucleus.util import ranges
+from third_party.nucleus.util import utils
 
 
 class SamReaderTests(parameterized.TestCase):
@@ -86,6 +88,40 @@ class SamReaderTests(parameterized.TestCase):
         with reader.query(interval) as iterable:
           self.assertEqual(test_utils.iterable_len(iterable), n_expected)
 
+  @parameterized.parameters((0, 1), (10, 2928130004), (50, 7), (1000, 7))
+  def test_query_with_max_reads(self, max_reads, random_seed):
+    region = ranges.parse_literal('chr20:10,000,001-10,000,100')
+    with sam.SamReader(test_utils.genomics_core_testdata('test.bam')) as reader:
+      expected = utils.reservoir_sample(
+          list(reader.query(region)), max_reads,
+          np.random.RandomState(random_seed))
+      actual = list(
+          reader.query(region, max_reads=max_reads, random_seed=random_seed))
+    self.assertLen(actual, min(max_reads, 106))
+    self.assertEqual(expected, actual)
+
+  def test_query_with_max_reads_requires_random_seed(self):
+    region = ranges.parse_literal('chr20:10,000,001-10,000,100')
+    with sam.SamReader(test_utils.genomics_core_testdata('test.bam')) as reader:
+      with self.assertRaises(ValueError):
+        reader.query(region, max_reads=10)
+
+  @parameterized.parameters(
+      ('chr20:10,000,001-10,000,100', 10000000),
+      ('chr20:10,000,001-10,000,100', 10000050),
+      ('chr20:10,000,001-10,000,100', 0),
+  )
+  def test_query_starting_at(self, region_literal, min_start):
+    region = ranges.parse_literal(region_literal)
+    with sam.SamReader(test_utils.genomics_core_testdata('test.bam')) as reader:
+      expected = [
+          read for read in reader.query(region)
+          if read.alignment.position.position >= min_start
+      ]
+      actual = list(reader.query_starting_at(region, min_start))
+    self.assertNotEmpty(expected)
+    self.assertEqual(expected, actual)
+
   def test_sam_query_alternate_index_name(self):
     reader = sam.SamReader(
         test_utils.genomics_core_testdata('test_alternate_index.bam'))
@@ -96,6 +132,25 @@ class SamReaderTests(parameterized.TestCase):
         with reader.query(interval) as iterable:
           self.assertEqual(test_utils.iterable_len(iterable), n_expected)
 
+  @parameterized.parameters(
+      ('chr20:9,990,001-10,010,000', 106),
+      ('chr20:20,000,001-20,100,000', 0),
+      ('chr1:1-100,000', 0),
+  )
+  def test_estimate_num_reads(self, region_literal, expected):
+    reader = sam.SamReader(test_utils.genomics_core_testdata('test.bam'))
+    with reader:
+      self.assertEqual(
+          reader.estimate_num_reads(ranges.parse_literal(region_literal)),
+          expected)
+
+  @parameterized.parameters('test.sam', 'unindexed.bam')
+  def test_estimate_num_reads_raises_without_bam_index(self, filename):
+    reader = sam.SamReader(test_utils.genomics_core_testdata(filename))
+    with reader:
+      with self.assertRaises(ValueError):
+        reader.estimate_num_reads(ranges.parse_literal('chr20:1-100'))
+
   @parameterized.parameters(('\t'.join(x[0] for x in items), {
       k: v for t in items for k, v in t[1].items()
   }) for r in [1, 2] for items in itertools.permutations(
@@ -250,6 +305,40 @@ class SamReaderTests(parameterized.TestCase):
       self.assertEqual(test_utils.iterable_len(reads_iter), expected_n_reads)
 
 
+class InMemorySamReaderTests(parameterized.TestCase):
+  """Test the query functionality provided by sam.InMemorySamReader."""
+
+  def setUp(self):
+    super(InMemorySamReaderTests, self).setUp()
+    with sam.SamReader(test_utils.genomics_core_testdata('test.bam')) as reader:
+      self.reads = list(reader.iterate())
+
+  @parameterized.parameters(
+      'chr20:10,000,000-10,000,100',
+      'chr20:10,000,000-10,000,000',
+      'chr20:10,000,050-10,000,060',
+      'chr20:9,000,000-9,000,100',
+      'chr1:10,000,000-10,000,100',
+  )
+  def test_query_matches_linear_scan(self, region_literal):
+    region = ranges.parse_literal(region_literal)
+    expected = [
+        read for read in self.reads
+        if ranges.ranges_overlap(region, utils.read_range(read))
+    ]
+    reader = sam.InMemorySamReader(self.reads)
+    self.assertEqual(list(reader.query(region)), expected)
+
+  def test_replace_reads_rebuilds_index(self):
+    region = ranges.parse_literal('chr20:10,000,000-10,000,100')
+    reader = sam.InMemorySamReader([])
+    self.assertEqual(list(reader.query(region)), [])
+    reader.replace_reads(self.reads)
+    self.assertLen(list(reader.query(region)), 106)
+    reader.replace_reads(self.reads[:10])
+    self.assertEqual(list(reader.query(region)), self.reads[:10])
+
+
 # Note that CRAM version 2.1 files work with Nucleus but they cannot be used in
 # our test here because CRAM 2.1 embeds an exact path to the reference file
 # which LEAKR flags as leaking internal google paths.
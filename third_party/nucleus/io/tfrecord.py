@@ -64,6 +64,18 @@ def Writer(path, compression_type=None):
   """A convenience wrapper around genomics_writer.TFRecordWriter."""
   return genomics_writer.TFRecordWriter(
       path, compression_type=compression_type)
+
+
+def ParallelWriter(path,
+                   compression_type=None,
+                   compression_level=6,
+                   num_threads=4):
+  """A convenience wrapper around genomics_writer.ParallelTFRecordWriter."""
+  return genomics_writer.ParallelTFRecordWriter(
+      path,
+      compression_type=compression_type,
+      compression_level=compression_level,
+      num_threads=num_threads)
 # pylint: enable=invalid-name
 
 
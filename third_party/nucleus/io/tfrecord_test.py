@@ -42,6 +42,7 @@ import types
 from absl.testing import absltest
 from absl.testing import parameterized
 
+from third_party.nucleus.io import genomics_writer
 from third_party.nucleus.io import tfrecord
 
 from third_party.nucleus.protos import reference_pb2
@@ -73,6 +74,49 @@ class IOTest(parameterized.TestCase):
     else:
       self.assertEqual(protos, list(reader))
 
+  @parameterized.parameters(
+      ('foo.tfrecord.gz', None, 6),
+      ('foo.tfrecord.gz', None, 1),
+      ('foo.tfrecord.gz', None, 0),
+      ('foo.tfrecord.gz', None, -1),
+      ('foo.tfrecord', 'ZLIB', 9),
+      ('foo.tfrecord', None, 6),
+  )
+  def test_parallel_writer(self, filename, compression_type, level):
+    protos = [
+        reference_pb2.ContigInfo(name=str(i) * (i % 50), n_bases=i)
+        for i in range(1000)
+    ]
+    path = test_utils.test_tmpfile(filename)
+    # A small block_size spreads the records over many blocks.
+    with genomics_writer.ParallelTFRecordWriter(
+        path,
+        compression_type=compression_type,
+        compression_level=level,
+        num_threads=3,
+        block_size=1000) as writer:
+      for proto in protos:
+        writer.write(proto)
+
+    self.assertEqual(
+        protos,
+        list(
+            tfrecord.read_tfrecords(
+                path,
+                reference_pb2.ContigInfo,
+                compression_type=compression_type)))
+
+  def test_parallel_writer_without_records(self):
+    path = test_utils.test_tmpfile('empty.tfrecord.gz')
+    with tfrecord.ParallelWriter(path):
+      pass
+    self.assertEmpty(list(tfrecord.read_tfrecords(path)))
+
+  def test_parallel_writer_rejects_bad_level(self):
+    with self.assertRaisesRegex(ValueError, 'compression_level'):
+      tfrecord.ParallelWriter(
+          test_utils.test_tmpfile('foo.tfrecord.gz'), compression_level=10)
+
   @parameterized.parameters((filename, max_records)
                             for max_records in [None, 0, 1, 3, 100]
                             for filename in ['foo.tfrecord', 'foo@2.tfrecord'])
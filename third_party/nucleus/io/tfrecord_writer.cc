@@ -32,6 +32,8 @@
 
 #include "third_party/nucleus/io/tfrecord_writer.h"
 #include "absl/memory/memory.h"
+#include "tensorflow/core/lib/core/coding.h"
+#include "tensorflow/core/lib/hash/crc32c.h"
 #include "tensorflow/core/lib/io/record_writer.h"
 #include "tensorflow/core/platform/logging.h"
 
@@ -98,4 +100,25 @@ bool TFRecordWriter::Close() {
   return true;
 }
 
+std::string EncodeTFRecord(const std::string& record) {
+  // The layout written by tensorflow::io::RecordWriter::WriteRecord.
+  char header[sizeof(tensorflow::uint64) + sizeof(tensorflow::uint32)];
+  tensorflow::core::EncodeFixed64(header, record.size());
+  tensorflow::core::EncodeFixed32(
+      header + sizeof(tensorflow::uint64),
+      tensorflow::crc32c::Mask(
+          tensorflow::crc32c::Value(header, sizeof(tensorflow::uint64))));
+  char footer[sizeof(tensorflow::uint32)];
+  tensorflow::core::EncodeFixed32(
+      footer, tensorflow::crc32c::Mask(
+                  tensorflow::crc32c::Value(record.data(), record.size())));
+
+  std::string encoded;
+  encoded.reserve(sizeof(header) + record.size() + sizeof(footer));
+  encoded.append(header, sizeof(header));
+  encoded.append(record);
+  encoded.append(footer, sizeof(footer));
+  return encoded;
+}
+
 }  // namespace nucleus
@@ -80,6 +80,11 @@ class TFRecordWriter {
   std::unique_ptr<tensorflow::io::RecordWriter> writer_;
 };
 
+// Returns record framed as it is stored in an uncompressed TFRecord file:
+// its length and the masked CRC32C of the length, followed by record and its
+// own masked CRC32C. Compressed TFRecord files hold the same bytes, compressed.
+std::string EncodeTFRecord(const std::string& record);
+
 }  // namespace nucleus
 
 #endif  // THIRD_PARTY_NUCLEUS_IO_TFRECORD_WRITER_H_
@@ -78,6 +78,71 @@ class FractionalSampler {
   mutable std::uniform_real_distribution<> uniform_;
 };
 
+// Helper class for reservoir sampling k values of a stream with uniform
+// probability (Algorithm R).
+//
+// The random numbers are drawn exactly like nucleus.util.utils.reservoir_sample
+// draws them from numpy.random.RandomState(random_seed), so both keep the same
+// values of the same stream.
+//
+// Keeping k values of a vector<int> x is:
+//
+// ReservoirSampler sampler(k, seed_uint);
+// vector<int> reservoir;
+// for (int v : x) {
+//   const int64 slot = sampler.Slot();
+//   if (slot == static_cast<int64>(reservoir.size())) {
+//     reservoir.push_back(v);
+//   } else if (slot >= 0) {
+//     reservoir[slot] = v;
+//   }
+// }
+//
+class ReservoirSampler {
+ public:
+  // Creates a new ReservoirSampler keeping at most k values.
+  ReservoirSampler(int64 k, uint32 random_seed)
+      : k_(k), n_seen_(0), generator_(random_seed) {
+    CHECK_GE(k, 0) << "k must be nonnegative";
+  }
+
+  // Returns the slot of the reservoir where the next value of the stream goes,
+  // replacing the value there, or -1 if it is not kept. The first k values go
+  // to slots 0, ..., k - 1 in order.
+  int64 Slot() {
+    const uint64 i = n_seen_++;
+    if (i < static_cast<uint64>(k_)) return i;
+    const uint64 j = UniformInt(i);
+    return j < static_cast<uint64>(k_) ? j : -1;
+  }
+
+ private:
+  // Returns a uniform integer in [0, max] like numpy's legacy
+  // RandomState.randint(0, max + 1): by rejection sampling of masked 32-bit
+  // draws, or 64-bit draws if max needs them, without any draw if max is 0.
+  uint64 UniformInt(uint64 max) {
+    if (max == 0) return 0;
+    uint64 mask = max;
+    for (int shift = 1; shift <= 32; shift *= 2) mask |= mask >> shift;
+    uint64 value;
+    do {
+      if (max <= 0xFFFFFFFFULL) {
+        value = generator_() & mask;
+      } else {
+        const uint64 upper = generator_();
+        value = ((upper << 32) | generator_()) & mask;
+      }
+    } while (value > max);
+    return value;
+  }
+
+  const int64 k_;
+  // The number of calls to Slot() so far.
+  uint64 n_seen_;
+  // numpy's RandomState uses the 32-bit Mersenne Twister with this seeding.
+  std::mt19937 generator_;
+};
+
 }  // namespace nucleus
 
 #endif  // THIRD_PARTY_NUCLEUS_UTIL_SAMPLERS_H_
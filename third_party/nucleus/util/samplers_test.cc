@@ -32,6 +32,8 @@
 
 #include "third_party/nucleus/util/samplers.h"
 
+#include <vector>
+
 #include "third_party/nucleus/testing/test_utils.h"
 
 #include "tensorflow/core/platform/test.h"
@@ -39,6 +41,8 @@
 namespace nucleus {
 
 using ::testing::DoubleNear;
+using ::testing::ElementsAre;
+using ::testing::IsEmpty;
 
 void VerifySampler(const FractionalSampler& sampler, double fraction) {
   int n_kept = 0;
@@ -65,4 +69,27 @@ TEST_P(FractionalSamplerTest, TestFractionalSampler) {
 INSTANTIATE_TEST_CASE_P(FractionalSamplerTest1, FractionalSamplerTest,
                         ::testing::Values(0.9, 0.1, 0.01, 0.05));
 
+std::vector<int> ReservoirSample(int n, int64 k, uint32 seed) {
+  ReservoirSampler sampler(k, seed);
+  std::vector<int> reservoir;
+  for (int v = 0; v < n; ++v) {
+    const int64 slot = sampler.Slot();
+    if (slot == static_cast<int64>(reservoir.size())) {
+      reservoir.push_back(v);
+    } else if (slot >= 0) {
+      reservoir[slot] = v;
+    }
+  }
+  return reservoir;
+}
+
+TEST(ReservoirSamplerTest, MatchesNumpyReservoirSample) {
+  // Expected values are from nucleus.util.utils.reservoir_sample(range(n), k,
+  // numpy.random.RandomState(seed)).
+  EXPECT_THAT(ReservoirSample(100, 10, 2928130004),
+              ElementsAre(66, 30, 46, 48, 10, 15, 33, 23, 80, 9));
+  EXPECT_THAT(ReservoirSample(5, 10, 1), ElementsAre(0, 1, 2, 3, 4));
+  EXPECT_THAT(ReservoirSample(100, 0, 1), IsEmpty());
+}
+
 }  // namespace nucleus